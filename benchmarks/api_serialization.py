@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the API response serialization.
+
+Seeds the database with a synthetic affiliation task (by default 100000 records) and compares
+the former serialization (BaseModel.to_dict with the dashed key rewrite, JSONEncoder.default
+for the dates and the pure-Python YAML dumper) with the column-projected row serializer
+(models.RowSerializer) and the streamed JSON/YAML encoding. Everything runs in a transaction
+that gets rolled back:
+
+    DATABASE_URL=postgresql://orcidhub@localhost:5432/orcidhub python benchmarks/api_serialization.py -n 100000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yaml  # noqa: E402
+from yaml.dumper import Dumper  # noqa: E402
+
+from orcid_hub import app, db  # noqa: E402
+from orcid_hub.apis import SafeRepresenterWithISODate, YamlDumper, iter_json_array, iter_yaml_list  # noqa: E402
+from orcid_hub.models import (AffiliationRecord, Organisation, PartialDate, RowSerializer, Task,  # noqa: E402
+                              User, chunks, create_tables)
+
+
+def seed(record_count):
+    """Seed the affiliation task with the records."""
+    org = Organisation.create(name="BENCHMARK ORGANISATION", tuakiri_name="BENCHMARK ORGANISATION")
+    admin = User.create(email="admin@benchmark.edu", name="BENCHMARK ADMIN", organisation=org)
+    task = Task.create(org=org, created_by=admin, filename="benchmark.csv", task_type=0)
+    processed_at = datetime.utcnow()
+    for chunk in chunks(range(record_count), 1000):
+        AffiliationRecord.insert_many(
+            dict(task=task, is_active=True, processed_at=processed_at, status="The record was processed.",
+                 first_name=f"FIRST NAME #{n}", last_name=f"LAST NAME #{n}", email=f"researcher{n}@benchmark.edu",
+                 orcid=f"0000-0001-{n // 10000:04d}-{n % 10000:04d}", organisation="BENCHMARK ORGANISATION",
+                 affiliation_type="staff", role="Researcher", department="Research",
+                 start_date=PartialDate(2000 + n % 18, n % 12 + 1), city="Auckland", country="NZ")
+            for n in chunk).execute()
+    return task
+
+
+def measure(title, serialize):
+    """Run the serialization and print its execution time and the length of the output."""
+    started_at = time.perf_counter()
+    output = serialize()
+    print(f"{title:<60} {(time.perf_counter() - started_at) * 1000:10.1f}ms {len(output):12d}")
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", type=int, default=100000, help="The number of the affiliation records to seed.")
+    args = parser.parse_args()
+
+    yaml.add_representer(datetime, SafeRepresenterWithISODate.represent_datetime, Dumper=Dumper)
+    create_tables()
+    with db.atomic() as transaction:
+        started_at = time.perf_counter()
+        task = seed(args.n)
+        print(f"Seeded {args.n} records in {time.perf_counter() - started_at:.1f}s "
+              f"(the libyaml dumper is {'' if YamlDumper is not Dumper else 'NOT '}available)\n")
+        query = task.affiliation_records.order_by(AffiliationRecord.id)
+
+        def former_records():
+            return [r.to_dict(recurse=False, to_dashes=True, exclude=[AffiliationRecord.task]) for r in query]
+
+        measure("to_dict", former_records)
+        measure("to_dict + JSONEncoder", lambda: json.dumps(former_records(), cls=app.json_encoder))
+        measure("to_dict + YAML Dumper", lambda: yaml.dump(former_records(), Dumper=Dumper))
+
+        serializer = RowSerializer(AffiliationRecord, exclude=[AffiliationRecord.task])
+        json_serializer = RowSerializer(AffiliationRecord, exclude=[AffiliationRecord.task], dates_as_text=True)
+        measure("RowSerializer", lambda: list(serializer.serialize(query)))
+        measure("RowSerializer + streamed JSON", lambda: ''.join(iter_json_array(json_serializer.serialize(query))))
+        measure("RowSerializer + streamed YAML", lambda: ''.join(iter_yaml_list(serializer.serialize(query))))
+        transaction.rollback()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Benchmark of the query plans of the work invitee batch selection.
+
+Seeds a PostgreSQL database with a synthetic dataset (by default a million work invitees)
+and compares the plans and the execution times of the former single query (with the OR-join
+on the user email or ORCID iD and the LIKE match of the token scope) and the UNION based
+selection (utils.select_invitee_batch). Everything runs in a transaction that gets rolled back:
+
+    DATABASE_URL=postgresql://orcidhub@localhost:5432/orcidhub python benchmarks/invitee_selection.py -n 1000000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from peewee import JOIN  # noqa: E402
+
+from orcid_hub import db  # noqa: E402
+from orcid_hub.models import (OrcidToken, Organisation, RecordOutcome, Task, User, WorkInvitees,  # noqa: E402
+                              WorkRecord, chunks, create_tables)
+from orcid_hub.utils import select_invitee_batch, select_invitee_candidates  # noqa: E402
+
+INVITEES_PER_RECORD = 10
+
+
+def seed(invitee_count):
+    """Seed the dataset: a user per two invitees, every other user with a token."""
+    org = Organisation.create(name="BENCHMARK ORGANISATION", tuakiri_name="BENCHMARK ORGANISATION")
+    admin = User.create(email="admin@benchmark.edu", name="BENCHMARK ADMIN", organisation=org)
+    user_count = invitee_count // 2
+    for chunk in chunks(range(user_count), 1000):
+        User.insert_many(
+            dict(email=f"researcher{n}@benchmark.edu", orcid=f"0000-0001-{n // 10000:04d}-{n % 10000:04d}",
+                 name=f"RESEARCHER #{n}", organisation=org) for n in chunk).execute()
+    user_ids = [u.id for u in User.select(User.id).where(User.email.startswith("researcher"))]
+    for chunk in chunks(user_ids[::2], 1000):
+        OrcidToken.insert_many(
+            dict(user=user_id, org=org, scope="/read-limited,/activities/update", can_update_activities=True,
+                 access_token=f"TOKEN-{user_id}") for user_id in chunk).execute()
+
+    task = Task.create(org=org, created_by=admin, filename="benchmark.json", task_type=2)
+    record_count = invitee_count // INVITEES_PER_RECORD
+    for chunk in chunks(range(record_count), 1000):
+        WorkRecord.insert_many(
+            dict(task=task, title=f"WORK #{n}", citation_type="bibtex", citation_value="", is_active=True)
+            for n in chunk).execute()
+    record_ids = [r.id for r in WorkRecord.select(WorkRecord.id).where(WorkRecord.task == task)]
+    for chunk in chunks(range(invitee_count), 1000):
+        # every 3rd invitee is matched by the ORCID iD only, every 5th is already invited:
+        WorkInvitees.insert_many(
+            dict(work_record=record_ids[n // INVITEES_PER_RECORD],
+                 email=f"researcher{n % user_count}@benchmark.edu" if n % 3 else f"other{n}@benchmark.edu",
+                 orcid=f"0000-0001-{n % user_count // 10000:04d}-{n % user_count % 10000:04d}",
+                 outcome=RecordOutcome.INVITED if n % 5 == 0 else RecordOutcome.PENDING)
+            for n in chunk).execute()
+    for table in ("user", "orcidtoken", "task", "work_record", "work_invitees"):
+        db.execute_sql(f'ANALYZE "{table}"')
+
+
+def former_selection(max_rows):
+    """Select the batch with the former single query."""
+    return (Task.select(Task, WorkRecord, WorkInvitees, User, OrcidToken).where(
+        WorkRecord.processed_at.is_null(), WorkInvitees.processed_at.is_null(), WorkRecord.is_active,
+        (OrcidToken.id.is_null(False) | (WorkInvitees.outcome != RecordOutcome.INVITED))).join(
+            WorkRecord, on=(Task.id == WorkRecord.task_id)).join(
+                WorkInvitees, on=(WorkRecord.id == WorkInvitees.work_record_id)).join(
+                    User, JOIN.LEFT_OUTER,
+                    on=((User.email == WorkInvitees.email) | (User.orcid == WorkInvitees.orcid))).join(
+                        Organisation, JOIN.LEFT_OUTER, on=(Organisation.id == Task.org_id)).join(
+                            OrcidToken, JOIN.LEFT_OUTER,
+                            on=((OrcidToken.user_id == User.id) & (OrcidToken.org_id == Organisation.id)
+                                & (OrcidToken.scope.contains("/activities/update")))).limit(max_rows))
+
+
+def explain(query):
+    """Print the execution plan of the query."""
+    sql, params = query.sql()
+    for row in db.execute_sql("EXPLAIN (ANALYZE, BUFFERS) " + sql, params):
+        print(row[0])
+
+
+def main():
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", type=int, default=1000000, help="The number of the work invitees to seed.")
+    parser.add_argument("-b", type=int, default=20, help="The batch size.")
+    args = parser.parse_args()
+
+    create_tables()
+    with db.atomic() as transaction:
+        started_at = time.perf_counter()
+        seed(args.n)
+        print(f"Seeded {args.n} invitees in {time.perf_counter() - started_at:.1f}s\n")
+
+        print("*** The former selection (the OR-join and the LIKE match):")
+        explain(former_selection(args.b))
+
+        started_at = time.perf_counter()
+        tasks = select_invitee_batch(WorkRecord, WorkInvitees, args.b)
+        print(f"\n*** The UNION based selection ({len(tasks)} rows in "
+              f"{(time.perf_counter() - started_at) * 1000:.1f}ms including the user lookups):")
+        explain(select_invitee_candidates(WorkRecord, WorkInvitees).limit(args.b))
+        transaction.rollback()
+
+
+if __name__ == "__main__":
+    main()
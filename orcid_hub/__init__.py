@@ -33,14 +33,14 @@ from playhouse.shortcuts import RetryOperationalError
 from raven.contrib.flask import Sentry
 
 from . import config
-from .failover import PgDbWithFailover
+from .failover import PgDbWithFailover, ServerSideCursorMixin
 from flask_admin import Admin
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 
 
 # http://docs.peewee-orm.com/en/latest/peewee/database.html#automatic-reconnect
-class ReconnectablePostgresqlDatabase(RetryOperationalError, PostgresqlDatabase):
+class ReconnectablePostgresqlDatabase(RetryOperationalError, ServerSideCursorMixin, PostgresqlDatabase):
     """Support for reconnecting closed DB connectios."""
 
     pass
@@ -65,11 +65,12 @@ DATABASE_URL = app.config.get("DATABASE_URL")
 
 # TODO: implement connection factory
 db_url.register_database(PgDbWithFailover, "pg+failover", "postgres+failover")
-db_url.PostgresqlDatabase = ReconnectablePostgresqlDatabase
+db_url.register_database(ReconnectablePostgresqlDatabase, "postgres", "postgresql")
 if DATABASE_URL.startswith("sqlite"):
     db = db_url.connect(DATABASE_URL, autorollback=True)
 else:
-    db = db_url.connect(DATABASE_URL, autorollback=True, connect_timeout=3)
+    db = db_url.connect(
+        DATABASE_URL, autorollback=True, connect_timeout=3, itersize=app.config["DB_CURSOR_ITERSIZE"])
 
 
 class JSONEncoder(_JSONEncoder):
@@ -178,7 +179,7 @@ from .oauth import *  # noqa: F401,F403
 from .reports import *  # noqa: F401,F403
 
 
-from .utils import process_records  # noqa: E402
+from .utils import dispatch_mail, process_records  # noqa: E402
 if app.testing:
     from .mocks import mocks
     app.register_blueprint(mocks)
@@ -228,6 +229,17 @@ def initdb(create=False, drop=False, force=False, audit=True, verbose=False):
         models.create_tables()
     except Exception:
         app.logger.exception("Failed to create tables...")
+    else:
+        # backfill the record counters of the tasks created before the counters were introduced:
+        models.Task.refresh_all_counts(models.Task.select().where(models.Task.record_count == 0))
+        # mark the pending invitees invited before the outcome was recorded (so they don't get re-invited):
+        for model in (models.AffiliationRecord, models.FundingInvitees, models.PeerReviewInvitee,
+                      models.WorkInvitees):
+            model.update(outcome=models.RecordOutcome.INVITED).where(
+                model.processed_at.is_null(), model.outcome == models.RecordOutcome.PENDING,
+                model.status ** "%invitation%sent at%").execute()
+        # backfill the digests of the URLs shortened before the digests were introduced:
+        models.Url.refresh_url_hashes()
 
     if audit:
         app.logger.info("Creating audit tables...")
@@ -302,6 +314,21 @@ def process(n):
     process_records(n)
 
 
+@app.cli.command("refresh_task_counts")
+def refresh_task_counts_command():
+    """Recalculate the record counters of the tasks (backfill of the existing tasks)."""
+    count = models.Task.refresh_all_counts()
+    click.echo(f"Refreshed the counters of {count} tasks")
+
+
+@app.cli.command("dispatch_mail")
+@click.option("-n", default=1000, help="Max number of messages to send.")
+def dispatch_mail_command(n):
+    """Send the email messages queued in the outbox."""
+    count = dispatch_mail(n)
+    click.echo(f"Sent {count} messages")
+
+
 if os.environ.get("ENV") == "dev0":
     # This allows us to use a plain HTTP callback
     os.environ['DEBUG'] = "1"
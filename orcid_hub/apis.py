@@ -1,6 +1,11 @@
 """HUB API."""
 
+import copy
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from datetime import datetime
+from functools import lru_cache
+from hashlib import md5
 from urllib.parse import unquote, urlencode
 
 import jsonschema
@@ -13,15 +18,18 @@ from flask.views import MethodView
 from flask_login import current_user, login_user
 from flask_restful import Resource, reqparse
 from flask_swagger import swagger
+from peewee import JOIN, fn
+from playhouse.shortcuts import case
 from yaml.dumper import Dumper
 from yaml.representer import SafeRepresenter
 
-from . import api, app, db, models, oauth
+from . import __version__, api, app, db, models, oauth
 from .login_provider import roles_required
-from .models import (ORCID_ID_REGEX, AffiliationRecord, Client, OrcidToken, PartialDate, Role,
-                     Task, TaskType, User, UserOrg, validate_orcid_id)
+from .models import (BULK_CHUNK_SIZE, ORCID_ID_REGEX, AffiliationRecord, Client, OrcidToken,
+                     PartialDate, Role, RowSerializer, Task, TaskStatus, TaskType, User, UserOrg,
+                     chunks, validate_orcid_id)
 from .schemas import affiliation_task_schema
-from .utils import is_valid_url, register_orcid_webhook
+from .utils import is_valid_url, queue_task_file, register_orcid_webhook, task_progress_response
 
 
 def prefers_yaml():
@@ -70,20 +78,43 @@ class AppResource(Resource):
         return "%s, %02d %s %04d %02d:%02d:%02d GMT" % (weekday, dt.day, month, dt.year, dt.hour,
                                                         dt.minute, dt.second)
 
+    def is_not_modified(self, etag, last_modified=None):
+        """Test if the representation cached by the client (If-None-Match/If-Modified-Since) is still current."""
+        if request.if_none_match:
+            return request.if_none_match.contains(etag)
+        if last_modified and request.if_modified_since:
+            return last_modified.replace(microsecond=0) <= request.if_modified_since.replace(tzinfo=None)
+        return False
+
+    def not_modified_response(self, etag, last_modified=None):
+        """Create '304 Not Modified' response."""
+        resp = make_response('', 304)
+        resp.set_etag(etag)
+        if last_modified:
+            resp.headers["Last-Modified"] = self.httpdate(last_modified)
+        return resp
+
     @property
     def is_yaml_request(self):
         """Test if the requst body content type is YAML."""
         return request.content_type in ["text/yaml", "application/x-yaml"]
 
 
-def changed_path(name, value):
-    """Create query stirng with a new paremeter value."""
-    link = request.path
-    if request.args:
-        link += '&' + urlencode(
-            {k: v if k != name else value
-                for k, v in request.args.items()})
-    return link
+def changed_path(name, value, *removed):
+    """Create query stirng with a new paremeter value (and without the removed parameters)."""
+    args = {k: v for k, v in request.args.items() if k not in removed}
+    args[name] = value
+    return request.path + '?' + urlencode(args)
+
+
+def encode_cursor(last_id):
+    """Encode the position after the last row of the page into an opaque cursor."""
+    return urlsafe_b64encode(json.dumps({"id": last_id}).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decode the cursor into the ID of the last row of the previous page."""
+    return int(json.loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))["id"])
 
 
 class AppResourceList(AppResource):
@@ -105,6 +136,11 @@ class AppResourceList(AppResource):
         except:
             return 20
 
+    @models.lazy_property
+    def is_paged(self):
+        """Test if the page is requested by its number (OFFSET/LIMIT), otherwise the cursor gets used."""
+        return "page" in request.args
+
     @models.lazy_property
     def next_link(self):
         """Get the next page link of the requsted resource."""
@@ -123,20 +159,55 @@ class AppResourceList(AppResource):
         return changed_path("page", 1)
 
     def api_response(self, query, exclude=None):
-        """Create and return API response with pagination likns."""
-        query = query.paginate(self.page, self.page_size)
-        records = [r.to_dict(recurse=False, to_dashes=True, exclude=exclude) for r in query]
-        resp = yamlfy(records) if prefers_yaml() else jsonify(records)
-        resp.headers["Pagination-Page"] = self.page
+        """Create and return API response with pagination likns.
+
+        The rows are ordered by the ID. Unless the page is requested by its number, the keyset
+        pagination is used: the next page link holds an opaque cursor with the ID of the last
+        row of the page and the next page starts right after it (an index range scan however
+        deep the page is).
+        """
+        model = query.model_class
+        etag = md5(repr((request.full_path, prefers_yaml(), self.get_state(query))).encode()).hexdigest()
+        if self.is_not_modified(etag):
+            return self.not_modified_response(etag)
+
+        query = query.order_by(model.id)
+        if self.is_paged:
+            query = query.paginate(self.page, self.page_size)
+        else:
+            cursor = request.args.get("cursor")
+            if cursor:
+                try:
+                    query = query.where(model.id > decode_cursor(cursor))
+                except Exception:
+                    return jsonify({"error": "Invalid cursor.", "message": f"Failed to decode: {cursor}"}), 422
+            query = query.limit(self.page_size)
+        serializer = RowSerializer(model, exclude=exclude, dates_as_text=not prefers_yaml())
+        records = list(serializer.serialize(query))
+        resp = stream_yaml(records) if prefers_yaml() else stream_json(records)
+        if self.is_paged:
+            resp.headers["Pagination-Page"] = self.page
         resp.headers["Pagination-Page-Size"] = self.page_size
         resp.headers["Pagination-Count"] = len(records)
         resp.headers["Link"] = f'<{request.full_path}>;rel="self"'
-        if self.previous_link:
+        if self.is_paged and self.previous_link:
             resp.headers["Link"] += f', <{self.previous_link}>;rel="prev"'
-        if len(records) == self.page_size and self.next_link:
-            resp.headers["Link"] += f', <{self.next_link}>;rel="next"'
+        if len(records) == self.page_size:
+            next_link = self.next_link if self.is_paged else changed_path(
+                "cursor", encode_cursor(records[-1]["id"]), "page")
+            resp.headers["Link"] += f', <{next_link}>;rel="next"'
+        resp.set_etag(etag)
         return resp
 
+    def get_state(self, query):
+        """Get the aggregated state of the listed rows that changes if any of them changes.
+
+        It's used for the entity tag of the list that gets checked before fetching the rows.
+        """
+        model = query.model_class
+        return query.select(fn.COUNT(model.id), fn.MAX(model.id), fn.MAX(model.updated_at)).order_by().scalar(
+            as_tuple=True)
+
 
 class TaskResource(AppResource):
     """Common task ralated reource."""
@@ -157,7 +228,12 @@ class TaskResource(AppResource):
         return super().dispatch_request(*args, **kwargs)
 
     def jsonify_task(self, task):
-        """Create JSON response with the task payload."""
+        """Create JSON response with the task payload.
+
+        The task records don't get fetched if the task representation cached by
+        the client is still current (a conditional GET/HEAD request). Otherwise
+        the records get serialized and streamed out row by row.
+        """
         if isinstance(task, int):
             login_user(request.oauth.user)
             try:
@@ -166,25 +242,28 @@ class TaskResource(AppResource):
                 return jsonify({"error": "The task doesn't exist."}), 404
             if task.created_by != current_user:
                 return jsonify({"error": "Access denied."}), 403
+        last_modified = task.updated_at or task.created_at
+        if request.method in ("GET", "HEAD") and self.is_not_modified(task.etag, last_modified):
+            return self.not_modified_response(task.etag, last_modified)
         if request.method != "HEAD":
             task_dict = task.to_dict(
                 recurse=False,
                 to_dashes=True,
                 exclude=[Task.created_by, Task.updated_by, Task.org, Task.task_type])
             task_dict["task-type"] = TaskType(task.task_type).name
+            task_dict["status"] = TaskStatus(task.status).name
             if TaskType(task.task_type) == TaskType.AFFILIATION:
-                # import pdb; pdb.set_trace()
                 records = task.affiliation_records
             else:
                 records = task.funding_records
-            task_dict["records"] = [
-                r.to_dict(to_dashes=True, recurse=False, exclude=[AffiliationRecord.task])
-                for r in records
-            ]
-            resp = jsonify(task_dict)
+            serializer = RowSerializer(
+                records.model_class, exclude=[AffiliationRecord.task], dates_as_text=True)
+            resp = stream_json(
+                task_dict, records=serializer.serialize(records.order_by(records.model_class.id)))
         else:
             resp = jsonify({"updated-at": task.updated_at})
-        resp.headers["Last-Modified"] = self.httpdate(task.updated_at or task.created_at)
+        resp.headers["Last-Modified"] = self.httpdate(last_modified)
+        resp.set_etag(task.etag)
         return resp
 
     def delete_task(self, task_id):
@@ -246,14 +325,26 @@ class TaskResource(AppResource):
                 if request.method == "POST" and task_id:
                     AffiliationRecord.delete().where(AffiliationRecord.task_id == task_id).execute()
 
-                record_fields = AffiliationRecord._meta.fields.keys()
+                record_fields = AffiliationRecord._meta.fields
+                is_update = request.method in ["PUT", "PATCH"]
+                # Fetch all the referenced records at once:
+                ids = [row["id"] for row in data["records"] if "id" in row] if is_update else None
+                records = {
+                    r.id: r
+                    for r in AffiliationRecord.select().where(AffiliationRecord.task_id == task.id,
+                                                              AffiliationRecord.id << ids)
+                } if ids else {}
+
+                new_records, changes = [], {}
                 for row in data["records"]:
-                    if "id" in row and request.method in ["PUT", "PATCH"]:
-                        rec = AffiliationRecord.get(id=row["id"])
+                    if "id" in row and is_update:
+                        rec = records.get(row["id"])
+                        if rec is None:
+                            raise AffiliationRecord.DoesNotExist(
+                                f"Instance matching query does not exist: id = {row['id']}")
                     else:
                         rec = AffiliationRecord(task=task)
 
-                    # import pdb; pdb.set_trace()
                     for k, v in row.items():
                         if k == "id":
                             continue
@@ -261,8 +352,31 @@ class TaskResource(AppResource):
                         if k in record_fields and rec._data.get(k) != v:
                             rec._data[k] = PartialDate.create(v) if k.endswith("date") else v
                             rec._dirty.add(k)
-                    if rec.is_dirty():
-                        rec.save()
+                    if rec.id is None:
+                        new_records.append(rec)
+                    elif rec.is_dirty():
+                        for k in rec._dirty:
+                            changes.setdefault(k, {})[rec.id] = rec._data[k]
+
+                if new_records:
+                    columns = [n for n in record_fields if n != "id"]
+                    for chunk in chunks(new_records, BULK_CHUNK_SIZE // len(columns)):
+                        AffiliationRecord.insert_many(
+                            [{n: r._data.get(n) for n in columns} for r in chunk]).execute()
+                # A single UPDATE per changed column in one go for all the records:
+                for name, values in changes.items():
+                    field = record_fields[name]
+                    for chunk in chunks(list(values.items()), BULK_CHUNK_SIZE // 2):
+                        AffiliationRecord.update(**{
+                            name: case(AffiliationRecord.id, [(i, field.db_value(v)) for i, v in chunk], field)
+                        }).where(AffiliationRecord.id << [i for i, _ in chunk]).execute()
+                if (request.method == "POST" and task_id) or {"processed_at", "status", "outcome"} & changes.keys():
+                    task.refresh_counts()
+                elif new_records:
+                    task.record_count += len(new_records)
+                if new_records or changes:
+                    task.updated_at = datetime.utcnow()
+                    task.save()
 
             except Exception as ex:
                 db.rollback()
@@ -328,6 +442,10 @@ class TaskList(TaskResource, AppResourceList):
             type: integer
             minimum: 0
             default: 20
+          - in: query
+            name: cursor
+            description: The opaque cursor of the next page (from the "next" link of the previous page)
+            type: string
         responses:
           200:
             description: "successful operation"
@@ -343,6 +461,13 @@ class TaskList(TaskResource, AppResourceList):
             Task.select().where(Task.org_id == current_user.organisation_id),
             exclude=[Task.created_by, Task.updated_by, Task.org])
 
+    def get_state(self, query):
+        """Get the aggregated state of the listed tasks including the record counters."""
+        return query.select(
+            fn.COUNT(Task.id), fn.MAX(Task.id), fn.MAX(Task.updated_at), fn.MAX(Task.completed_at),
+            fn.SUM(Task.record_count), fn.SUM(Task.processed_count),
+            fn.SUM(Task.error_count)).order_by().scalar(as_tuple=True)
+
 
 class AffiliationListAPI(TaskResource):
     """Affiliation list API."""
@@ -382,6 +507,25 @@ class AffiliationListAPI(TaskResource):
               completed-at:
                 type: string
                 format: date-time
+              status:
+                type: string
+                description: "The loading status of the task file."
+                enum:
+                - LOADED
+                - LOADING
+                - FAILED
+              record-count:
+                type: integer
+                description: "The number of the loaded records."
+              processed-count:
+                type: integer
+                description: "The number of the processed records."
+              error-count:
+                type: integer
+                description: "The number of the records processed with errors."
+              load-error:
+                type: string
+                description: "The reason why the loading of the task file failed."
               records:
                 type: array
                 items:
@@ -464,11 +608,19 @@ class AffiliationListAPI(TaskResource):
             description: "successful operation"
             schema:
               $ref: "#/definitions/AffiliationTask"
+          202:
+            description: "The large CSV/TSV file is accepted and it is being loaded in the background"
+            schema:
+              $ref: "#/definitions/AffiliationTask"
           403:
             description: "Access Denied"
         """
         login_user(request.oauth.user)
         if request.content_type in ["text/csv", "text/tsv"]:
+            if (request.content_length or 0) >= app.config["UPLOAD_ASYNC_THRESHOLD"]:
+                filename = self.filename or datetime.utcnow().isoformat(timespec="seconds")
+                task = queue_task_file(request.stream, filename=filename)
+                return self.jsonify_task(task), 202
             task = Task.load_from_csv(request.data.decode("utf-8"), filename=self.filename)
             return self.jsonify_task(task)
         return self.handle_affiliation_task()
@@ -656,7 +808,47 @@ class AffiliationAPI(TaskResource):
         return self.jsonify_task(task_id)
 
 
+class TaskProgressAPI(TaskResource):
+    """Task progress event stream."""
+
+    def get(self, task_id):
+        """
+        Stream the processing progress of the task.
+
+        ---
+        tags:
+          - "tasks"
+        summary: "Stream the processing progress of the task."
+        description: "Stream the processing progress of the task as Server-Sent Events: 'progress' events with
+          the task record counters whenever they change and the 'completed' event once the task is completed."
+        produces:
+          - "text/event-stream"
+        parameters:
+          - name: "task_id"
+            in: "path"
+            description: "Task ID."
+            required: true
+            type: "integer"
+        responses:
+          200:
+            description: "Successful operation"
+          403:
+            description: "Access Denied"
+          404:
+            description: "The task doesn't exist"
+        """
+        login_user(request.oauth.user)
+        try:
+            task = Task.get(id=task_id)
+        except Task.DoesNotExist:
+            return jsonify({"error": "The task doesn't exist."}), 404
+        if task.created_by != current_user:
+            return jsonify({"error": "Access denied."}), 403
+        return task_progress_response(task.id)
+
+
 api.add_resource(TaskList, "/api/v1.0/tasks")
+api.add_resource(TaskProgressAPI, "/api/v1.0/tasks/<int:task_id>/progress")
 api.add_resource(AffiliationListAPI, "/api/v1.0/affiliations")
 api.add_resource(AffiliationAPI, "/api/v1.0/affiliations/<int:task_id>")
 
@@ -698,6 +890,10 @@ class UserListAPI(AppResourceList):
             minimum: 0
             default: 20
             description: The size of the data page
+          - in: query
+            name: cursor
+            type: string
+            description: The opaque cursor of the next page (from the "next" link of the previous page)
         responses:
           200:
             description: "successful operation"
@@ -814,6 +1010,146 @@ class UserAPI(AppResource):
 api.add_resource(UserAPI, "/api/v1.0/users/<identifier>")
 
 
+class UserLookupAPI(AppResource):
+    """Bulk user lookup service."""
+
+    def post(self):
+        """
+        Resolve the list of identifiers (emails, ORCID iDs or eppns) into the users.
+
+        ---
+        tags:
+          - "users"
+        summary: "Look up the users by their emails, ORCID iDs or eppns in bulk."
+        description: "Look up the users of the organisation by the list of the identifiers. The result holds
+          an entry per identifier (in the same order) indicating if the user was found and if the user
+          has linked the ORCID account with the organisation."
+        consumes:
+          - "application/json"
+          - "text/yaml"
+        produces:
+          - "application/json"
+          - "text/yaml"
+        parameters:
+          - in: body
+            name: identifiers
+            description: "The list of the identifiers (emails, ORCID iDs or eppns)."
+            required: true
+            schema:
+              type: array
+              items:
+                type: string
+        responses:
+          200:
+            description: "successful operation"
+            schema:
+              id: UserLookupApiResponse
+              type: array
+              items:
+                type: "object"
+                properties:
+                  identifier:
+                    type: "string"
+                  found:
+                    type: "boolean"
+                  linked:
+                    type: "boolean"
+                    description: "The user has linked the ORCID account with the organisation"
+                  orcid:
+                    type: "string"
+                  email:
+                    type: "string"
+                  eppn:
+                    type: "string"
+                  error:
+                    type: "string"
+                    description: "Invalid identifier"
+          415:
+            description: "Invalid request format"
+          422:
+            description: "Too many identifiers"
+        """
+        try:
+            data = yaml.safe_load(request.data) if self.is_yaml_request else request.get_json()
+        except Exception as ex:
+            return jsonify({"error": "Invalid request format.", "message": str(ex)}), 415
+        if isinstance(data, dict):
+            data = data.get("identifiers")
+        if not isinstance(data, list) or not all(isinstance(i, str) for i in data):
+            return jsonify({"error": "Invalid request format. Expected a list of the identifiers."}), 415
+        max_count = app.config["USER_LOOKUP_MAX_IDENTIFIERS"]
+        if len(data) > max_count:
+            return jsonify({
+                "error": f"Too many identifiers: {len(data)}. At most {max_count} can be looked up at once."
+            }), 422
+
+        results = self.lookup(request.oauth.client.org, data)
+        return yamlfy(results) if prefers_yaml() else jsonify(results)
+
+    @staticmethod
+    def lookup(org, identifiers):
+        """Resolve the identifiers into the users of the organisation with a few set-based queries.
+
+        The users are looked up by the emails and eppns and by the ORCID iDs in chunks
+        and only the users of the organisation (or affiliated with it) are considered.
+        """
+        identifiers = [i.strip() for i in identifiers]
+        names, orcids, errors = set(), set(), {}
+        for identifier in identifiers:
+            if validators.email(identifier):
+                names.add(identifier)
+            elif ORCID_ID_REGEX.match(identifier):
+                try:
+                    validate_orcid_id(identifier)
+                    orcids.add(identifier)
+                except Exception as ex:
+                    errors[identifier] = f"Incorrect identifier value '{identifier}': {ex}"
+            else:
+                names.add(identifier)
+
+        def select_users(*where):
+            return User.select().join(
+                UserOrg, JOIN.LEFT_OUTER, on=((UserOrg.user_id == User.id) & (UserOrg.org_id == org.id))).where(
+                    (User.organisation_id == org.id) | UserOrg.id.is_null(False), *where).distinct()
+
+        users = {}
+        for chunk in chunks(sorted(names), BULK_CHUNK_SIZE // 2):
+            for u in select_users((User.email << chunk) | (User.eppn << chunk)):
+                if u.eppn in names:
+                    users.setdefault(u.eppn, u)
+                if u.email in names:
+                    users[u.email] = u
+        for chunk in chunks(sorted(orcids), BULK_CHUNK_SIZE):
+            for u in select_users(User.orcid << chunk):
+                users.setdefault(u.orcid, u)
+
+        linked_user_ids = set()
+        for chunk in chunks(list({u.id for u in users.values()}), BULK_CHUNK_SIZE):
+            linked_user_ids.update(user_id for (user_id, ) in OrcidToken.select(OrcidToken.user_id).where(
+                OrcidToken.org_id == org.id, OrcidToken.user_id << chunk).distinct().tuples())
+
+        results = []
+        for identifier in identifiers:
+            user = users.get(identifier)
+            if identifier in errors:
+                results.append({"identifier": identifier, "found": False, "error": errors[identifier]})
+            elif user is None:
+                results.append({"identifier": identifier, "found": False})
+            else:
+                results.append({
+                    "identifier": identifier,
+                    "found": True,
+                    "linked": user.id in linked_user_ids,
+                    "orcid": user.orcid,
+                    "email": user.email,
+                    "eppn": user.eppn,
+                })
+        return results
+
+
+api.add_resource(UserLookupAPI, "/api/v1.0/users/lookup")
+
+
 class TokenAPI(MethodView):
     """ORCID access token service."""
 
@@ -909,9 +1245,15 @@ app.add_url_rule(
     ])
 
 
+@lru_cache(maxsize=4)
+def get_swagger(app, version):
+    """Collect the API swagger specification from the views (once per process and app version)."""
+    return swagger(app)
+
+
 def get_spec(app):
     """Build API swagger scecifiction."""
-    swag = swagger(app)
+    swag = copy.deepcopy(get_swagger(app, __version__))
     swag["info"]["version"] = "1.0"
     swag["info"]["title"] = "ORCID HUB API"
     # swag["basePath"] = "/api/v1.0"
@@ -947,33 +1289,57 @@ def get_spec(app):
     return swag
 
 
+@lru_cache(maxsize=32)
+def render_spec(url_root, spec_type, version):
+    """Render the API specification and its entity tag.
+
+    The rendered specification is cached per process and it's keyed by the root URL (the host
+    and the scheme are a part of the specification) and by the app version.
+    """
+    swag = get_spec(app)
+    if spec_type == "yaml":
+        data = yaml.dump(swag, Dumper=YamlDumper) + '\n'
+    else:
+        data = json.dumps(swag, cls=app.json_encoder)
+    return data, md5(data.encode()).hexdigest()
+
+
+def spec_response(spec_type):
+    """Create the API specification response that can be cached by the clients."""
+    data, etag = render_spec(request.url_root, spec_type, __version__)
+    resp = Response(data, mimetype="text/yaml" if spec_type == "yaml" else "application/json")
+    resp.set_etag(etag)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = app.config["SPEC_CACHE_MAX_AGE"]
+    return resp.make_conditional(request)
+
+
 @app.route("/spec.json")
 def json_spec():
     """Return the specification of the API."""
-    swag = get_spec(app)
-    return jsonify(swag)
+    return spec_response("json")
 
 
 @app.route("/spec.yml")
 @app.route("/spec.yaml")
 def yaml_spec():
     """Return the specification of the API."""
-    swag = get_spec(app)
-    return yamlfy(swag)
+    return spec_response("yaml")
 
 
 @app.route("/spec")
 def spec():
     """Return the specification of the API."""
-    swag = get_spec(app)
     best = request.accept_mimetypes.best_match(["text/yaml", "application/x-yaml"])
     if (best in (
             "text/yaml",
             "application/x-yaml",
     ) and request.accept_mimetypes[best] > request.accept_mimetypes["application/json"]):
-        return yamlfy(swag)
+        resp = spec_response("yaml")
     else:
-        return jsonify(swag)
+        resp = spec_response("json")
+    resp.vary.add("Accept")
+    return resp
 
 
 @app.route("/api-docs")
@@ -993,9 +1359,57 @@ class SafeRepresenterWithISODate(SafeRepresenter):
         return self.represent_scalar('tag:yaml.org,2002:timestamp', value)
 
 
+# libyaml based dumper if PyYAML is built with it (an order of magnitude faster):
+YamlDumper = getattr(yaml, "CDumper", Dumper)
+yaml.add_representer(datetime, SafeRepresenterWithISODate.represent_datetime, Dumper=YamlDumper)
+
+
+def iter_json_array(items, encoder=None):
+    """Encode the items into a JSON array in batches of the rows."""
+    encode = (encoder or app.json_encoder(separators=(',', ':'))).encode
+    yield '['
+    for n, chunk in enumerate(chunks(items, BULK_CHUNK_SIZE)):
+        yield (',' if n else '') + ','.join(encode(i) for i in chunk)
+    yield ']'
+
+
+def iter_yaml_list(items):
+    """Encode the items into a YAML list in batches of the rows."""
+    has_items = False
+    for chunk in chunks(items, BULK_CHUNK_SIZE):
+        has_items = True
+        yield yaml.dump(chunk, Dumper=YamlDumper)
+    if not has_items:
+        yield "[]\n"
+
+
+def stream_json(data, **arrays):
+    """Create streamed JSON response, the arrays (iterables) get encoded and sent out in batches.
+
+    If the data is a dict, the arrays are added to it as the values of the keyword argument names.
+    """
+    encoder = app.json_encoder(separators=(',', ':'))
+
+    def generate():
+        if arrays:
+            yield encoder.encode(data)[:-1]
+            for n, (key, items) in enumerate(arrays.items()):
+                yield (',' if n or data else '') + encoder.encode(key) + ':'
+                yield from iter_json_array(items, encoder)
+            yield '}'
+        else:
+            yield from iter_json_array(data, encoder)
+
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+
+def stream_yaml(items):
+    """Create streamed YAML response with the list of the items (iterable)."""
+    return Response(stream_with_context(iter_yaml_list(items)), mimetype="text/yaml")
+
+
 def yamlfy(*args, **kwargs):
     """Create respose in YAML just like jsonify does it for JSON."""
-    yaml.add_representer(datetime, SafeRepresenterWithISODate.represent_datetime, Dumper=Dumper)
     if args and kwargs:
         raise TypeError('yamlfy() behavior undefined when passed both args and kwargs')
     elif len(args) == 1:  # single args are passed directly to dumps()
@@ -1003,7 +1417,7 @@ def yamlfy(*args, **kwargs):
     else:
         data = args or kwargs
 
-    return current_app.response_class((yaml.dump(data), '\n'), mimetype="text/yaml")
+    return current_app.response_class((yaml.dump(data, Dumper=YamlDumper), '\n'), mimetype="text/yaml")
 
 
 @app.route("/orcid/api/<path:path>", methods=["GET", "POST", "PUT", "DELETE"])
@@ -43,6 +43,8 @@ if not DATABASE_URL:
     if POSTGRES_PASSWORD:
         DATABASE_URL += ':' + POSTGRES_PASSWORD
     DATABASE_URL += "@" + DB_HOSTNAME + ":5432/" + DB_NAME
+# The number of the rows fetched at once iterating over the large results with the server-side cursors:
+DB_CURSOR_ITERSIZE = int(getenv("DB_CURSOR_ITERSIZE", 2000))
 
 # NB! Disable in production
 if ENV in ("dev0", ):
@@ -63,6 +65,24 @@ MAIL_PORT = int(getenv("MAIL_PORT", 25))
 MAIL_SUPPRESS_SEND = False
 MAIL_DEFAULT_SENDER = getenv("MAIL_DEFAULT_SENDER", "no-reply@orcidhub.org.nz")
 MAIL_SERVER = getenv("MAIL_SERVER", "gateway")
+# Idle time (in seconds) after which a pooled SMTP connection is considered to be closed by the server:
+MAIL_IDLE_TIMEOUT = int(getenv("MAIL_IDLE_TIMEOUT", 60))
+# Mail outbox dispatcher: concurrent SMTP connections, the maximum number of messages
+# sent to a recipient domain per minute and the maximum number of delivery attempts:
+MAIL_DISPATCH_WORKERS = int(getenv("MAIL_DISPATCH_WORKERS", 4))
+MAIL_DOMAIN_RATE_LIMIT = int(getenv("MAIL_DOMAIN_RATE_LIMIT", 60))
+MAIL_MAX_ATTEMPTS = int(getenv("MAIL_MAX_ATTEMPTS", 5))
+# In-memory cache of the short URLs: the maximum number of entries and
+# the time-to-live (in seconds) of the entries and the redirect responses:
+SHORT_URL_CACHE_SIZE = int(getenv("SHORT_URL_CACHE_SIZE", 4096))
+SHORT_URL_CACHE_TTL = int(getenv("SHORT_URL_CACHE_TTL", 300))
+# Task progress event stream: the polling interval (if Redis isn't available) and the stream lifetime in seconds:
+TASK_PROGRESS_INTERVAL = int(getenv("TASK_PROGRESS_INTERVAL", 15))
+TASK_PROGRESS_TIMEOUT = int(getenv("TASK_PROGRESS_TIMEOUT", 300))
+# The maximum number of the identifiers looked up at once with the bulk user lookup API:
+USER_LOOKUP_MAX_IDENTIFIERS = int(getenv("USER_LOOKUP_MAX_IDENTIFIERS", 10000))
+# The time (in seconds) the clients can cache the API specification for (it's revalidated with ETag):
+SPEC_CACHE_MAX_AGE = int(getenv("SPEC_CACHE_MAX_AGE", 3600))
 
 MEMBER_API_FORM_BASE_URL = "https://orcid.org/content/register-client-application-sandbox" \
     if ENV != "prod" else "https://orcid.org/content/register-client-application-production-trusted-party"
@@ -135,6 +155,18 @@ DEFAULT_EMAIL_TEMPLATE = """<!DOCTYPE html>
 </html>
 """
 
+# Batch task files bigger than the threshold (in bytes) get loaded in the background:
+UPLOAD_ASYNC_THRESHOLD = int(getenv("UPLOAD_ASYNC_THRESHOLD", 1024 * 1024))
+UPLOAD_BATCH_SIZE = int(getenv("UPLOAD_BATCH_SIZE", 500))  # Records committed at once
+# NB! The folder should be shared by the application and the workers
+UPLOAD_FOLDER = getenv("UPLOAD_FOLDER", path.join(path.dirname(path.dirname(path.abspath(__file__))), "data",
+                                                  "uploads"))
+# The exports of the batch tasks with at least that many records get built in the background:
+EXPORT_ASYNC_THRESHOLD = int(getenv("EXPORT_ASYNC_THRESHOLD", 1000))
+# NB! The folder should be shared by the application and the workers
+EXPORT_FOLDER = getenv("EXPORT_FOLDER", path.join(path.dirname(path.dirname(path.abspath(__file__))), "data",
+                                                  "exports"))
+
 DKIP_KEY_PATH = path.join(path.dirname(path.relpath(path.relpath(__file__))), ".keys", "dkim.key")
 
 # RQ
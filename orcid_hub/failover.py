@@ -2,12 +2,68 @@
 """Failover DB connection."""
 
 import logging
+from uuid import uuid4
 
 from peewee import DatabaseError, InterfaceError, PostgresqlDatabase
 from psycopg2 import OperationalError
 
 
-class PgDbWithFailover(PostgresqlDatabase):
+class ServerSideCursor:
+    """Named cursor wrapper for the peewee query result wrappers.
+
+    The result wrappers fetch the rows one by one, and so would a named cursor
+    (a round trip per row). Iterating the named cursor fetches 'itersize' rows at once.
+    """
+
+    def __init__(self, cursor):
+        """Wrap the named cursor."""
+        self.cursor = cursor
+        self.rows = iter(cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+    def fetchone(self):
+        """Fetch the next row (from the batch fetched in advance)."""
+        return next(self.rows, None)
+
+
+class ServerSideCursorMixin:
+    """Iteration over the large query results through named (server-side) PostgreSQL cursors.
+
+    Only 'itersize' rows get held in the client memory at a time.
+    """
+
+    def __init__(self, *args, itersize=2000, **kwargs):
+        """Set up the number of the rows fetched at once through the named cursors."""
+        self.itersize = itersize
+        super().__init__(*args, **kwargs)
+
+    def get_server_side_cursor(self, sql, params=None, itersize=None):
+        """Declare a named cursor for the statement.
+
+        The cursor is declared WITH HOLD, so it survives the commits of the other statements
+        executed while iterating over it (e.g., saving the fetched rows), and it has to be closed.
+        """
+        cursor = self.get_conn().cursor(name=f"cursor_{uuid4().hex}", withhold=True)
+        cursor.itersize = itersize or self.itersize
+        with self.exception_wrapper:
+            cursor.execute(sql, params)
+        return cursor
+
+    def iterate(self, query, itersize=None):
+        """Iterate over the model instances (or the tuples, dicts...) of the select query."""
+        sql, params = query.sql()
+        cursor = self.get_server_side_cursor(sql, params, itersize=itersize)
+        try:
+            result_wrapper = query._get_result_wrapper()
+            yield from result_wrapper(
+                query.model_class, ServerSideCursor(cursor), query.get_query_meta()).iterator()
+        finally:
+            cursor.close()
+
+
+class PgDbWithFailover(ServerSideCursorMixin, PostgresqlDatabase):
     """Postgres DB connection with a failover server."""
 
     def __init__(self, *args, failover_host=None, **kwargs):
@@ -56,3 +112,11 @@ class PgDbWithFailover(PostgresqlDatabase):
         except (DatabaseError, InterfaceError):
             self.connect()
             return super().execute_sql(sql, params=params, require_commit=False)
+
+    def get_server_side_cursor(self, sql, params=None, itersize=None):
+        """Attempt to declare a named cursor. If it fails try to fail over ..."""
+        try:
+            return super().get_server_side_cursor(sql, params=params, itersize=itersize)
+        except (DatabaseError, InterfaceError):
+            self.connect()
+            return super().get_server_side_cursor(sql, params=params, itersize=itersize)
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 """Application models."""
 
+import codecs
 import copy
 import csv
 import json
@@ -9,13 +10,15 @@ import random
 import re
 import secrets
 import string
+import threading
 import uuid
 import validators
-from collections import namedtuple
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
 from datetime import datetime
 from hashlib import md5
 from io import StringIO
-from itertools import zip_longest
+from itertools import islice, zip_longest
 from urllib.parse import urlencode
 
 import yaml
@@ -24,7 +27,7 @@ from peewee import BooleanField as BooleanField_
 from peewee import (JOIN, BlobField, CharField, DateTimeField, DeferredRelation, Field,
                     FixedCharField, ForeignKeyField, IntegerField, Model, OperationalError,
                     PostgresqlDatabase, ProgrammingError, SmallIntegerField, TextField, fn)
-from playhouse.shortcuts import model_to_dict
+from playhouse.shortcuts import case, model_to_dict
 from pycountry import countries
 from pykwalify.core import Core
 from pykwalify.errors import SchemaError
@@ -35,6 +38,8 @@ from .config import DEFAULT_COUNTRY, ENV
 
 ORCID_ID_REGEX = re.compile(r"^([X\d]{4}-?){3}[X\d]{4}$")
 PARTIAL_DATE_REGEX = re.compile(r"\d+([/\-]\d+){,2}")
+# The maximum number of the query parameters in a single bulk statement (SQLite limit is 999):
+BULK_CHUNK_SIZE = 900
 
 
 AFFILIATION_TYPES = (
@@ -332,6 +337,50 @@ class BaseModel(Model):
         only_save_dirty = True
 
 
+class RowSerializer:
+    """Column-projected serializer of the query rows into dictionaries with dashed keys.
+
+    The field map (the keys and the value converters) gets computed once and only the projected
+    columns get fetched as tuples, so no model instances get created. The result is the same as
+    of `to_dict(recurse=False, to_dashes=True)`. If `dates_as_text` is set, the dates and timestamps
+    get converted into ISO format strings right away (e.g., for JSON serialization).
+    """
+
+    def __init__(self, model, exclude=None, only=None, dates_as_text=False):
+        """Compute the field map of the model."""
+        # the fields get matched by the name (the field comparison makes a query expression):
+        exclude = {f.name for f in exclude or ()}
+        only = {f.name for f in only or ()}
+        self.fields = [
+            f for f in model._meta.sorted_fields if f.name not in exclude and (not only or f.name in only)
+        ]
+        self.keys = [f.name.replace('_', '-') for f in self.fields]
+        self.converters = [self.get_converter(f, dates_as_text) for f in self.fields]
+
+    @staticmethod
+    def get_converter(field, dates_as_text=False):
+        """Get the field value converter (or None if the value can be used as it is)."""
+        if isinstance(field, PartialDateField):
+            return str
+        if dates_as_text and isinstance(field, DateTimeField):
+            return lambda v: v.isoformat(timespec="seconds")
+
+    def __call__(self, row):
+        """Convert a row tuple into a dictionary."""
+        return {
+            k: v if c is None or v is None else c(v)
+            for k, c, v in zip(self.keys, self.converters, row)
+        }
+
+    def select(self, query):
+        """Project the query onto the serialized columns."""
+        return query.select(*self.fields).tuples()
+
+    def serialize(self, query):
+        """Iterate over the query rows as dictionaries."""
+        return map(self, self.select(query))
+
+
 class ModelDeferredRelation(DeferredRelation):
     """Fixed DefferedRelation to allow inheritance and mixins."""
 
@@ -589,7 +638,7 @@ class User(BaseModel, UserMixin, AuditMixin):
     email = CharField(max_length=120, unique=True, null=True)
     eppn = CharField(max_length=120, unique=True, null=True)
     # ORCiD:
-    orcid = OrcidIdField(null=True, verbose_name="ORCID iD", help_text="User's ORCID iD")
+    orcid = OrcidIdField(null=True, index=True, verbose_name="ORCID iD", help_text="User's ORCID iD")
     confirmed = BooleanField(default=False)
     # Role bit-map:
     roles = SmallIntegerField(default=0)
@@ -722,6 +771,10 @@ class User(BaseModel, UserMixin, AuditMixin):
         """Generate UUID for the user basee on the the primary email."""
         return uuid.uuid5(uuid.NAMESPACE_URL, "mailto:" + (self.email or self.eppn))
 
+    class Meta:  # noqa: D101,D106
+        # keyset pagination of the organisation users (the API user list):
+        indexes = ((("organisation", "id"), False), )
+
 
 DeferredUser.set_model(User)
 
@@ -801,6 +854,8 @@ class OrcidToken(BaseModel, AuditMixin):
     user = ForeignKeyField(User, null=True, index=True)  # TODO: add validation for 3-legged authorization tokens
     org = ForeignKeyField(Organisation, index=True, verbose_name="Organisation")
     scope = TextField(null=True, db_column="scope")  # TODO impomenet property
+    can_update_activities = BooleanField(
+        default=False, help_text="The scope includes '/activities/update' (maintained on saving the token).")
     access_token = CharField(max_length=36, unique=True, null=True)
     issue_time = DateTimeField(default=datetime.utcnow)
     refresh_token = CharField(max_length=36, unique=True, null=True)
@@ -808,6 +863,12 @@ class OrcidToken(BaseModel, AuditMixin):
     created_by = ForeignKeyField(DeferredUser, on_delete="SET NULL", null=True)
     updated_by = ForeignKeyField(DeferredUser, on_delete="SET NULL", null=True)
 
+    def save(self, *args, **kwargs):  # noqa: D102
+        can_update_activities = bool(self.scope and "/activities/update" in self.scope)
+        if self.can_update_activities != can_update_activities:
+            self.can_update_activities = can_update_activities
+        return super().save(*args, **kwargs)
+
     @property
     def scopes(self):  # noqa: D102
         if self.scope:
@@ -891,20 +952,26 @@ class Task(BaseModel, AuditMixin):
     task_type = SmallIntegerField(default=0)
     expires_at = DateTimeField(null=True)
     expiry_email_sent_at = DateTimeField(null=True)
+    status = SmallIntegerField(default=0, help_text="Loading status: 0 - loaded, 1 - loading, 2 - failed.")
+    load_error = TextField(null=True, help_text="The reason why the loading of the task file failed.")
+    record_count = IntegerField(default=0, help_text="The number of the loaded records.")
+    processed_count = IntegerField(default=0, help_text="The number of the processed records.")
+    error_count = IntegerField(default=0, help_text="The number of the records processed with errors.")
+    orcid_rec_count = IntegerField(default=0, help_text="The number of the affected ORCID records.")
 
     def __repr__(self):
         return self.filename or f"{TaskType(self.task_type).name.capitalize()} record processing task #{self.id}"
 
+    @property
+    def is_loading(self):
+        """Test if the task file is still being loaded in the background."""
+        return self.status == TaskStatus.LOADING
+
     @property
     def is_expiry_email_sent(self):
         """Test if the expiry email is sent ot not."""
         return bool(self.expiry_email_sent_at)
 
-    @lazy_property
-    def record_count(self):
-        """Get count of the loaded recoreds."""
-        return self.records.count()
-
     @property
     def record_model(self):
         """Get record model class."""
@@ -917,17 +984,112 @@ class Task(BaseModel, AuditMixin):
         """Get all task record query."""
         return getattr(self, TaskType(self.task_type).name.lower() + "_records")
 
+    def refresh_counts(self):
+        """Recalculate the record counters of the task, e.g., after a reset or bulk changes."""
+        model = self.record_model
+        record_count, processed_count, error_count = model.select(
+            fn.COUNT(model.id), fn.COUNT(model.processed_at),
+            fn.COUNT(case(None, [(model.error_condition(), 1)]))).where(
+                model.task_id == self.id).scalar(as_tuple=True)
+        counts = dict(
+            record_count=record_count, processed_count=processed_count, error_count=error_count)
+        if self.task_type == TaskType.AFFILIATION:
+            counts["orcid_rec_count"] = model.select(model.orcid).where(
+                model.task_id == self.id, model.orcid.is_null(False)).distinct().count()
+        Task.update(**counts).where(Task.id == self.id).execute()
+        # NB! not marked 'dirty' in order not to overwrite concurrent changes on saving
+        self._data.update(counts)
+
+    @classmethod
+    def refresh_all_counts(cls, query=None):
+        """Recalculate the record counters of all the tasks (e.g., the tasks created before the counters)."""
+        count = 0
+        for task in iterate(cls.select() if query is None else query):
+            task.refresh_counts()
+            count += 1
+        return count
+
+    @classmethod
+    def add_counts(cls, task_id, record_count=0, processed_count=0, error_count=0):
+        """Increment (or decrement) the record counters of the task in a single statement."""
+        cls.update(
+            record_count=cls.record_count + record_count,
+            processed_count=cls.processed_count + processed_count,
+            error_count=cls.error_count + error_count).where(cls.id == task_id).execute()
+
+    @classmethod
+    def count_processed(cls, record_model, record_ids):
+        """Add up the newly processed records to the counters of their tasks.
+
+        The records are expected to be unprocessed before the processing of the batch.
+        """
+        if not record_ids:
+            return
+        for task_id, processed_count, error_count in record_model.select(
+                record_model.task_id, fn.COUNT(record_model.id),
+                fn.COUNT(case(None, [(record_model.error_condition(), 1)]))).where(
+                    record_model.id << list(record_ids),
+                    record_model.processed_at.is_null(False)).group_by(record_model.task_id).tuples():
+            cls.add_counts(task_id, processed_count=processed_count, error_count=error_count)
+
+    def check_completed(self):
+        """Test if all the records are processed and if so, mark the task completed.
+
+        The records get checked only if the counters indicate that all of them are processed,
+        and the final counts get recalculated once the task is completed.
+        """
+        if self.processed_count < self.record_count:
+            return False
+        model = self.record_model
+        if model.select().where(model.task_id == self.id, model.processed_at.is_null()).exists():
+            return False
+        self.refresh_counts()
+        self.completed_at = datetime.utcnow()
+        self.save()
+        return True
+
     @property
-    def error_count(self):
-        """Get error count encountered during processing batch task."""
-        q = self.records
-        _, models = q.get_query_meta()
-        model, = models.keys()
-        return self.records.where(self.record_model.status ** "%error%").count()
+    def etag(self):
+        """Get the entity tag of the task state for the conditional API requests.
+
+        The records get saved touching the task and the bulk changes update the counters,
+        so the task row alone is enough to tell if the task has changed.
+        """
+        return md5(repr((self.id, self.updated_at, self.completed_at, self.status, self.record_count,
+                         self.processed_count, self.error_count)).encode()).hexdigest()
+
+    @property
+    def export_version(self):
+        """Get the content version of the task records (e.g., to key the cached exports of the task).
+
+        The version changes whenever the task gets touched, the records get (de)activated
+        or a processing event gets logged for the records or their invitees.
+        """
+        model = self.record_model
+        state = list(Task.select(
+            Task.updated_at, Task.completed_at, Task.record_count, Task.processed_count,
+            Task.error_count).where(Task.id == self.id).tuples().get())
+        record_ids = model.select(model.id).where(model.task_id == self.id)
+        state.extend(model.select(fn.COUNT(model.id), fn.COUNT(case(None, [(model.is_active, 1)]))).where(
+            model.task_id == self.id).scalar(as_tuple=True))
+        state.append(RecordEvent.select(fn.MAX(RecordEvent.id)).where(
+            RecordEvent.record_type == model._meta.db_table, RecordEvent.record_id << record_ids).scalar())
+        for fk in model._meta.reverse_rel.values():
+            if issubclass(fk.model_class, StatusLogMixin):
+                invitee_model = fk.model_class
+                state.append(RecordEvent.select(fn.MAX(RecordEvent.id)).where(
+                    RecordEvent.record_type == invitee_model._meta.db_table,
+                    RecordEvent.record_id << invitee_model.select(invitee_model.id).where(
+                        fk << record_ids)).scalar())
+        return md5(repr(state).encode()).hexdigest()[:16]
 
     @classmethod
-    def load_from_csv(cls, source, filename=None, org=None):
-        """Load affiliation record data from CSV/TSV file or a string."""
+    def load_from_csv(cls, source, filename=None, org=None, task=None, batch_size=None):
+        """Load affiliation record data from CSV/TSV file or a string.
+
+        If the task is given (e.g., created in advance for the background loading), the records get
+        added to it. If the batch size is given, the loaded records are committed in batches.
+        """
         if isinstance(source, str):
             source = StringIO(source)
         reader = csv.reader(source)
@@ -982,9 +1144,11 @@ class Task(BaseModel, AuditMixin):
                 v = row[idxs[i]].strip()
                 return default if v == '' else v
 
-        with db.atomic():
+        with db.atomic() as transaction:
             try:
-                task = cls.create(org=org, filename=filename)
+                if task is None:
+                    task = cls.create(org=org, filename=filename)
+                record_count = 0
                 for row_no, row in enumerate(reader):
                     # skip empty lines:
                     if len(row) == 0:
@@ -1052,6 +1216,13 @@ class Task(BaseModel, AuditMixin):
                     if not validator.validate():
                         raise ModelException(f"Invalid record: {validator.errors}")
                     af.save()
+                    record_count += 1
+                    if batch_size and record_count % batch_size == 0:
+                        task.record_count = record_count
+                        task.save()
+                        transaction.commit()
+                task.record_count = record_count
+                task.save()
             except Exception:
                 db.rollback()
                 app.logger.exception("Failed to load affiliation file.")
@@ -1061,6 +1232,8 @@ class Task(BaseModel, AuditMixin):
 
     class Meta:  # noqa: D101,D106
         table_alias = "t"
+        # keyset pagination of the organisation tasks (the API task list):
+        indexes = ((("org", "id"), False), )
 
 
 class UserInvitation(BaseModel, AuditMixin):
@@ -1102,20 +1275,213 @@ class UserInvitation(BaseModel, AuditMixin):
         db_table = "user_invitation"
 
 
-class RecordModel(BaseModel):
+class RecordEvent(BaseModel):
+    """Append-only log of the processing events of the task records and the invitees."""
+
+    record_type = CharField(max_length=40, help_text="The table name of the record.")
+    record_id = IntegerField()
+    created_at = DateTimeField(default=datetime.utcnow)
+    code = CharField(max_length=40, null=True)
+    message = TextField(null=True)
+
+    @classmethod
+    def log(cls, model, record_ids, message, code=None):
+        """Log the same event for all the given records with bulk inserts."""
+        record_type, created_at = model._meta.db_table, datetime.utcnow()
+        for chunk in chunks(record_ids, BULK_CHUNK_SIZE // 5):
+            cls.insert_many([
+                dict(record_type=record_type, record_id=record_id, created_at=created_at, code=code,
+                     message=message) for record_id in chunk
+            ]).execute()
+
+    def __str__(self):
+        return self.created_at.isoformat(timespec="seconds") + ": " + (self.message or '')
+
+    class Meta:  # noqa: D101,D106
+        db_table = "record_event"
+        table_alias = "re"
+        indexes = ((("record_type", "record_id"), False), )
+
+
+class StatusLogMixin(Model):
+    """Mixin for logging the processing progress of the records into the record event log.
+
+    The record 'status' holds only the latest status line and the whole history
+    gets appended to the record event log.
+    """
+
+    def save(self, *args, **kwargs):  # noqa: D102
+        result = super().save(*args, **kwargs)
+        events = self.__dict__.pop("_pending_events", None)
+        if events:
+            RecordEvent.insert_many([
+                dict(e, record_type=self._meta.db_table, record_id=self.id) for e in events
+            ]).execute()
+        return result
+
+    @classmethod
+    def select_logged(cls, code, *fields):
+        """Select the records that have an event with the given code logged."""
+        return cls.select(*fields).join(
+            RecordEvent,
+            on=((RecordEvent.record_type == cls._meta.db_table) & (RecordEvent.record_id == cls.id))).where(
+                RecordEvent.code == code)
+
+    def add_status_line(self, line, code=None):
+        """Set the current status, the event gets logged on saving the record."""
+        ts = datetime.utcnow()
+        self.status = ts.isoformat(timespec="seconds") + ": " + line
+        self.__dict__.setdefault("_pending_events", []).append(
+            dict(created_at=ts, code=code, message=line))
+
+    @classmethod
+    def update_status(cls, status, *where, code=None, **fields):
+        """Set the status of the matching records in bulk and log it into their event logs.
+
+        The tasks of the records (or of the parent records of the invitees) get touched.
+        Returns the number of updated records.
+        """
+        fk = next((f for f in cls._meta.sorted_fields
+                   if isinstance(f, ForeignKeyField) and "task" in f.rel_model._meta.fields), None)
+        if "task" in cls._meta.fields:
+            query = cls.select(cls.id, cls.task_id)
+        elif fk:
+            query = cls.select(cls.id, fk.rel_model.task_id).join(fk.rel_model, on=(fk == fk.rel_model.id))
+        else:
+            query = cls.select(cls.id)
+        rows = list(query.where(*where).tuples())
+        if rows:
+            cls.update(status=status, **fields).where(*where).execute()
+            RecordEvent.log(cls, [r[0] for r in rows], status, code=code)
+            for task_id in {r[1] for r in rows if len(r) > 1 and r[1]}:
+                touch_task(task_id)
+        return len(rows)
+
+    @property
+    def events(self):
+        """Query the processing event log of the record."""
+        return RecordEvent.select().where(RecordEvent.record_type == self._meta.db_table,
+                                          RecordEvent.record_id == self.id).order_by(RecordEvent.id)
+
+    @property
+    def status_log(self):
+        """Render the full processing log of the record (fetched on demand)."""
+        return "\n".join(str(e) for e in self.events)
+
+
+_task_touches = threading.local()
+
+
+def touch_task(task_id):
+    """Bump the task 'updated_at' timestamp.
+
+    Within a unit of work (see defer_task_touches) the touch gets deferred
+    until the end of it.
+    """
+    task_ids = getattr(_task_touches, "task_ids", None)
+    if task_ids is None:
+        _touch_tasks([task_id])
+    else:
+        task_ids.add(task_id)
+
+
+def _touch_tasks(task_ids):
+    """Update the timestamps of the tasks in a single statement."""
+    fields = dict(updated_at=datetime.utcnow())
+    if current_user and hasattr(current_user, "id"):
+        fields["updated_by"] = current_user.id
+    Task.update(**fields).where(Task.id << sorted(task_ids)).execute()
+
+
+def begin_task_touches():
+    """Start deferring and coalescing the task touches.
+
+    Returns False if the task touches are already being deferred.
+    """
+    if getattr(_task_touches, "task_ids", None) is not None:
+        return False
+    _task_touches.task_ids = set()
+    return True
+
+
+def end_task_touches():
+    """Stop deferring the task touches and flush the pending ones."""
+    task_ids, _task_touches.task_ids = getattr(_task_touches, "task_ids", None), None
+    if task_ids:
+        _touch_tasks(task_ids)
+
+
+@contextmanager
+def defer_task_touches():
+    """Unit of work for the task touches (e.g., a processing batch).
+
+    The parent task touches of the saved records get deduplicated and flushed
+    in one statement at the end. Can be used as a decorator.
+    """
+    started = begin_task_touches()
+    try:
+        yield
+    finally:
+        if started:
+            end_task_touches()
+
+
+class IdentityMap:
+    """Batch-scoped identity map of the model instances.
+
+    The rows referenced by the foreign keys of a batch get fetched at once
+    (a query per model and chunk of the IDs) and attached to the instances,
+    so that the access to the related objects makes no more lazy lookups.
+    """
+
+    def __init__(self):
+        """Create an empty identity map."""
+        self._instances = defaultdict(dict)
+
+    def load(self, model, ids):
+        """Fetch the instances of the given IDs that are not in the map yet and return the model's map."""
+        instances = self._instances[model]
+        missing = {i for i in ids if i is not None} - instances.keys()
+        for chunk in chunks(missing, BULK_CHUNK_SIZE):
+            instances.update((o.id, o) for o in model.select().where(model.id << chunk))
+        return instances
+
+    def get(self, model, id):
+        """Get the instance by its ID (fetched if it is not in the map yet)."""
+        return self.load(model, [id]).get(id)
+
+    def attach(self, instances, *field_names):
+        """Preload and attach the objects referenced by the given foreign key fields of the instances."""
+        instances = [i for i in instances if i is not None]
+        if not instances:
+            return
+        for name in field_names:
+            related = self.load(
+                instances[0]._meta.fields[name].rel_model, (i._data.get(name) for i in instances))
+            for i in instances:
+                related_id = i._data.get(name)
+                if related_id in related:
+                    i._obj_cache[name] = related[related_id]
+
+
+class RecordModel(BaseModel, StatusLogMixin):
     """Commond model bits of the task records."""
 
     def save(self, *args, **kwargs):
         """Update related batch task when changing the record."""
-        if self.is_dirty() and hasattr(self, "task"):
-            self.task.updated_at = datetime.utcnow()
-            self.task.save()
+        if self.is_dirty() and "task" in self._meta.fields:
+            touch_task(self.task_id)
         return super().save(*args, **kwargs)
 
-    def add_status_line(self, line):
-        """Add a text line to the status for logging processing progress."""
-        ts = datetime.utcnow().isoformat(timespec="seconds")
-        self.status = (self.status + "\n" if self.status else '') + ts + ": " + line
+    @classmethod
+    def error_condition(cls):
+        """Get the condition matching the records that failed to get processed."""
+        return cls.status ** "%error%"
+
+    @property
+    def has_error(self):
+        """Test if the record failed to get processed."""
+        return bool(self.status) and "error" in self.status.lower()
 
 
 class GroupIdRecord(RecordModel):
@@ -1183,6 +1549,18 @@ class AffiliationRecord(RecordModel):
         null=True, max_length=20, verbose_name="Disambiguated Organization Identifier")
     disambiguation_source = CharField(
         null=True, max_length=100, verbose_name="Disambiguation Source")
+    outcome = SmallIntegerField(default=0, help_text="Record processing outcome (see RecordOutcome).")
+    error_code = CharField(null=True, max_length=40, help_text="The code of the last processing error.")
+
+    @classmethod
+    def error_condition(cls):
+        """Get the condition matching the records that failed to get processed."""
+        return cls.outcome == RecordOutcome.ERROR
+
+    @property
+    def has_error(self):
+        """Test if the record failed to get processed."""
+        return self.outcome == RecordOutcome.ERROR
 
     class Meta:  # noqa: D101,D106
         db_table = "affiliation_record"
@@ -1208,6 +1586,45 @@ class TaskType(IntFlag):
         return hash(self.name)
 
 
+class TaskStatus(IntFlag):
+    """Enum used to represent the loading status of a batch task."""
+
+    LOADED = 0
+    LOADING = 1  # The task file is being loaded in the background
+    FAILED = 2
+
+    def __eq__(self, other):
+        if isinstance(other, TaskStatus):
+            return self.value == other.value
+        elif isinstance(other, int):
+            return self.value == other
+        return (self.name == other or self.name == getattr(other, "name", None))
+
+    def __hash__(self):
+        return hash(self.name)
+
+
+class RecordOutcome(IntFlag):
+    """Enum used to represent the outcome of the processing of a task record (or an invitee)."""
+
+    PENDING = 0
+    INVITED = 1  # The invitation was sent to the researcher
+    CREATED = 2  # The entry was created in the ORCID profile
+    UPDATED = 3
+    UNCHANGED = 4
+    ERROR = 5
+
+    def __eq__(self, other):
+        if isinstance(other, RecordOutcome):
+            return self.value == other.value
+        elif isinstance(other, int):
+            return self.value == other
+        return (self.name == other or self.name == getattr(other, "name", None))
+
+    def __hash__(self):
+        return hash(self.name)
+
+
 class FundingRecord(RecordModel):
     """Funding record loaded from Json file for batch processing."""
 
@@ -1234,27 +1651,26 @@ class FundingRecord(RecordModel):
     status = TextField(null=True, help_text="Record processing status.")
 
     @classmethod
-    def load_from_json(cls, source, filename=None, org=None):
-        """Load data from json file or a string."""
-        if isinstance(source, str):
-            # import data from file based on its extension; either it is yaml or json
-            funding_data_list = load_yaml_json(filename=filename, source=source)
+    def load_from_json(cls, source, filename=None, org=None, task=None, batch_size=None):
+        """Load data from a JSON or YAML file, a string or a text stream.
 
-            for funding_data in funding_data_list:
-                validation_source_data = copy.deepcopy(funding_data)
-                validation_source_data = del_none(validation_source_data)
-
-                # Adding schema valdation for funding
-                validator = Core(
-                    source_data=validation_source_data, schema_files=["funding_schema.yaml"])
-                validator.validate(raise_exception=True)
-
-            try:
-                if org is None:
-                    org = current_user.organisation if current_user else None
-                task = Task.create(org=org, filename=filename, task_type=TaskType.FUNDING)
-
-                for funding_data in funding_data_list:
+        The records are parsed, validated and stored one by one as they are read up,
+        so the whole file never has to be loaded into the memory. If the batch size is given,
+        the loaded records are committed in batches.
+        """
+        try:
+            if org is None:
+                org = current_user.organisation if current_user else None
+            with db.atomic() as transaction:
+                if task is None:
+                    task = Task.create(org=org, filename=filename, task_type=TaskType.FUNDING)
+
+                n = 0
+                for n, funding_data in enumerate(iter_yaml_json(filename=filename, source=source), 1):
+                    validator = Core(
+                        source_data=del_none(copy.deepcopy(funding_data)),
+                        schema_files=["funding_schema.yaml"])
+                    validator.validate(raise_exception=True)
 
                     title = get_val(funding_data, "title", "title", "value")
                     translated_title = get_val(funding_data, "title", "translated-title", "value")
@@ -1350,12 +1766,18 @@ class FundingRecord(RecordModel):
                                 relationship=relationship)
                     else:
                         raise SchemaError(u"Schema validation failed:\n - An external identifier is required")
-                return task
+                    if batch_size and n % batch_size == 0:
+                        task.record_count = n
+                        task.save()
+                        transaction.commit()
+                task.record_count = n
+                task.save()
 
-            except Exception:
-                db.rollback()
-                app.logger.exception("Failed to load funding file.")
-                raise
+            return task
+
+        except Exception:
+            app.logger.exception("Failed to load funding file.")
+            raise
 
     class Meta:  # noqa: D101,D106
         db_table = "funding_record"
@@ -1394,25 +1816,26 @@ class PeerReviewRecord(RecordModel):
     status = TextField(null=True, help_text="Record processing status.")
 
     @classmethod
-    def load_from_json(cls, source, filename=None, org=None):
-        """Load data from JSON file or a string."""
-        if isinstance(source, str):
-            # import data from file based on its extension; either it is yaml or json
-            peer_review_data_list = load_yaml_json(filename=filename, source=source)
-
-            for peer_review_data in peer_review_data_list:
-                validation_source_data = copy.deepcopy(peer_review_data)
-                validation_source_data = del_none(validation_source_data)
+    def load_from_json(cls, source, filename=None, org=None, task=None, batch_size=None):
+        """Load data from a JSON or YAML file, a string or a text stream.
 
-                validator = Core(source_data=validation_source_data, schema_files=["peer_review_schema.yaml"])
-                validator.validate(raise_exception=True)
-
-            try:
-                if org is None:
-                    org = current_user.organisation if current_user else None
-                task = Task.create(org=org, filename=filename, task_type=TaskType.PEER_REVIEW)
-
-                for peer_review_data in peer_review_data_list:
+        The records are parsed, validated and stored one by one as they are read up,
+        so the whole file never has to be loaded into the memory. If the batch size is given,
+        the loaded records are committed in batches.
+        """
+        try:
+            if org is None:
+                org = current_user.organisation if current_user else None
+            with db.atomic() as transaction:
+                if task is None:
+                    task = Task.create(org=org, filename=filename, task_type=TaskType.PEER_REVIEW)
+
+                n = 0
+                for n, peer_review_data in enumerate(iter_yaml_json(filename=filename, source=source), 1):
+                    validator = Core(
+                        source_data=del_none(copy.deepcopy(peer_review_data)),
+                        schema_files=["peer_review_schema.yaml"])
+                    validator.validate(raise_exception=True)
 
                     review_group_id = peer_review_data.get("review-group-id") if peer_review_data.get(
                         "review-group-id") else None
@@ -1567,12 +1990,18 @@ class PeerReviewRecord(RecordModel):
                                 relationship=relationship)
                     else:
                         raise SchemaError(u"Schema validation failed:\n - An external identifier is required")
+                    if batch_size and n % batch_size == 0:
+                        task.record_count = n
+                        task.save()
+                        transaction.commit()
+                task.record_count = n
+                task.save()
 
-                return task
-            except Exception:
-                db.rollback()
-                app.logger.exception("Failed to load peer review file.")
-                raise
+            return task
+
+        except Exception:
+            app.logger.exception("Failed to load peer review file.")
+            raise
 
     class Meta:  # noqa: D101,D106
         db_table = "peer_review_record"
@@ -1604,28 +2033,26 @@ class WorkRecord(RecordModel):
     status = TextField(null=True, help_text="Record processing status.")
 
     @classmethod
-    def load_from_json(cls, source, filename=None, org=None):
-        """Load data from JSON file or a string."""
-        if isinstance(source, str):
-            # import data from file based on its extension; either it is yaml or json
-            work_data_list = load_yaml_json(filename=filename, source=source)
-
-            # TODO: validation of uploaded work file
-            for work_data in work_data_list:
-                validation_source_data = copy.deepcopy(work_data)
-                validation_source_data = del_none(validation_source_data)
+    def load_from_json(cls, source, filename=None, org=None, task=None, batch_size=None):
+        """Load data from a JSON or YAML file, a string or a text stream.
 
-                # Adding schema valdation for Work
-                validator = Core(
-                    source_data=validation_source_data, schema_files=["work_schema.yaml"])
-                validator.validate(raise_exception=True)
-
-            try:
-                if org is None:
-                    org = current_user.organisation if current_user else None
-                task = Task.create(org=org, filename=filename, task_type=TaskType.WORK)
-
-                for work_data in work_data_list:
+        The records are parsed, validated and stored one by one as they are read up,
+        so the whole file never has to be loaded into the memory. If the batch size is given,
+        the loaded records are committed in batches.
+        """
+        try:
+            if org is None:
+                org = current_user.organisation if current_user else None
+            with db.atomic() as transaction:
+                if task is None:
+                    task = Task.create(org=org, filename=filename, task_type=TaskType.WORK)
+
+                n = 0
+                for n, work_data in enumerate(iter_yaml_json(filename=filename, source=source), 1):
+                    validator = Core(
+                        source_data=del_none(copy.deepcopy(work_data)),
+                        schema_files=["work_schema.yaml"])
+                    validator.validate(raise_exception=True)
 
                     title = get_val(work_data, "title", "title", "value")
                     sub_title = get_val(work_data, "title", "subtitle", "value")
@@ -1724,12 +2151,18 @@ class WorkRecord(RecordModel):
                                 relationship=relationship)
                     else:
                         raise SchemaError(u"Schema validation failed:\n - An external identifier is required")
+                    if batch_size and n % batch_size == 0:
+                        task.record_count = n
+                        task.save()
+                        transaction.commit()
+                task.record_count = n
+                task.save()
 
-                return task
-            except Exception:
-                db.rollback()
-                app.logger.exception("Failed to load work record file.")
-                raise
+            return task
+
+        except Exception:
+            app.logger.exception("Failed to load work record file.")
+            raise
 
     class Meta:  # noqa: D101,D106
         db_table = "work_record"
@@ -1768,7 +2201,7 @@ class FundingContributor(ContributorModel):
         table_alias = "fc"
 
 
-class InviteesModel(BaseModel):
+class InviteesModel(BaseModel, StatusLogMixin):
     """Common model bits of the invitees records."""
 
     identifier = CharField(max_length=120, null=True)
@@ -1780,11 +2213,8 @@ class InviteesModel(BaseModel):
     visibility = CharField(null=True, max_length=100)
     status = TextField(null=True, help_text="Record processing status.")
     processed_at = DateTimeField(null=True)
-
-    def add_status_line(self, line):
-        """Add a text line to the status for logging processing progress."""
-        ts = datetime.utcnow().isoformat(timespec="seconds")
-        self.status = (self.status + "\n" if self.status else '') + ts + ": " + line
+    outcome = SmallIntegerField(default=0, help_text="Record processing outcome (see RecordOutcome).")
+    error_code = CharField(null=True, max_length=40, help_text="The code of the last processing error.")
 
 
 class PeerReviewInvitee(InviteesModel):
@@ -1865,24 +2295,110 @@ class ExternalId(ExternalIdModel):
 class Url(BaseModel, AuditMixin):
     """Shortened URLs."""
 
+    SHORT_ID_CHARS = string.ascii_letters + string.digits
+
     short_id = CharField(unique=True, max_length=5)
     url = TextField()
+    url_hash = CharField(max_length=32, index=True, null=True, help_text="MD5 digest of the URL used for lookups.")
+
+    @staticmethod
+    def get_url_hash(url):
+        """Get the digest of the URL used for the indexed lookups."""
+        return md5(url.encode()).hexdigest()
 
     @classmethod
-    def shorten(cls, url):
-        """Create a shorten url or retrievs an exiting one."""
-        try:
-            u = cls.get(url=url)
-        except cls.DoesNotExist:
-            while True:
-                short_id = ''.join(
-                    random.choice(string.ascii_letters + string.digits) for _ in range(5))
-                try:
-                    cls.get(short_id=short_id)
-                except cls.DoesNotExist:
-                    u = cls.create(short_id=short_id, url=url)
-                    return u
-        return u
+    def generate_short_ids(cls, count):
+        """Generate the given number of distinct short IDs that are not taken yet.
+
+        All the candidates get checked with a single query (per chunk) and only
+        the (rare) colliding ones get regenerated.
+        """
+        short_ids = set()
+        while len(short_ids) < count:
+            candidates = set(''.join(random.choice(cls.SHORT_ID_CHARS) for _ in range(5))
+                             for _ in range(count - len(short_ids))) - short_ids
+            for chunk in chunks(list(candidates), BULK_CHUNK_SIZE):
+                candidates.difference_update(
+                    r[0] for r in cls.select(cls.short_id).where(cls.short_id << chunk).tuples())
+            short_ids.update(candidates)
+        return list(short_ids)
+
+    @classmethod
+    def refresh_url_hashes(cls):
+        """Backfill the digests of the URLs shortened before the digests were introduced."""
+        while True:
+            rows = list(cls.select(cls.id, cls.url).where(cls.url_hash.is_null()).limit(BULK_CHUNK_SIZE).tuples())
+            if not rows:
+                break
+            with db.atomic():
+                for url_id, url in rows:
+                    cls.update(url_hash=cls.get_url_hash(url)).where(cls.id == url_id).execute()
+
+    @classmethod
+    def shorten_many(cls, urls):
+        """Create the short urls or retrieve the existing ones of the given URLs at once.
+
+        Returns a dictionary mapping each URL to its short url entry.
+        """
+        urls = set(urls)
+        result = {}
+        for chunk in chunks(urls, BULK_CHUNK_SIZE):
+            hashes = [cls.get_url_hash(url) for url in chunk]
+            for u in cls.select().where(cls.url_hash << hashes):
+                if u.url in urls:
+                    result[u.url] = u
+
+        missing = [url for url in urls if url not in result]
+        if missing:
+            now = datetime.utcnow()
+            short_ids = cls.generate_short_ids(len(missing))
+            with db.atomic():
+                for chunk in chunks(zip(short_ids, missing), BULK_CHUNK_SIZE):
+                    cls.insert_many([
+                        dict(short_id=short_id, url=url, url_hash=cls.get_url_hash(url), created_at=now)
+                        for short_id, url in chunk
+                    ]).execute()
+            for chunk in chunks(short_ids, BULK_CHUNK_SIZE):
+                result.update((u.url, u) for u in cls.select().where(cls.short_id << chunk))
+        return result
+
+    @classmethod
+    def shorten(cls, url, short_id=None):
+        """Create a shorten url or retrievs an exiting one.
+
+        The short ID can be reserved upfront with `generate_short_ids` for a batch of new URLs.
+        """
+        if short_id:
+            return cls.create(short_id=short_id, url=url, url_hash=cls.get_url_hash(url))
+        return cls.shorten_many([url])[url]
+
+
+class MailMessage(BaseModel):
+    """Transactional outbox of the email messages.
+
+    The messages get written in the same transaction as the records they are
+    about and the mail dispatcher (utils.dispatch_mail) delivers them.
+    """
+
+    recipient_name = CharField(max_length=120, null=True)
+    recipient_email = CharField(max_length=120)
+    recipient_domain = CharField(max_length=120, help_text="Used for rate limiting of the delivery.")
+    cc_name = CharField(max_length=120, null=True)
+    cc_email = CharField(max_length=120, null=True)
+    reply_to_name = CharField(max_length=120, null=True)
+    reply_to_email = CharField(max_length=120, null=True)
+    subject = TextField()
+    html = TextField()
+    text = TextField(null=True, help_text="The plain text alternative of the message.")
+    created_at = DateTimeField(default=datetime.utcnow)
+    scheduled_at = DateTimeField(default=datetime.utcnow, help_text="The time of the next delivery attempt.")
+    sent_at = DateTimeField(null=True)
+    attempts = SmallIntegerField(default=0)
+    error = TextField(null=True, help_text="The error of the last failed delivery attempt.")
+
+    class Meta:  # noqa: D101,D106
+        db_table = "mail_outbox"
+        table_alias = "mo"
 
 
 class Funding(BaseModel):
@@ -2047,6 +2563,27 @@ def readup_file(input_file):
     return raw.decode("latin-1")
 
 
+def decoded_stream(raw):
+    """Wrap up a binary stream with a reader decoding it on the fly.
+
+    The encoding gets detected from the head of the stream, so the content is never read up
+    and decoded as a whole.
+    """
+    head = raw.read(4096)
+    raw.seek(0)
+    if head.startswith(codecs.BOM_UTF8):
+        encoding = "utf-8-sig"
+    elif head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        encoding = "utf-16"
+    else:
+        try:
+            codecs.getincrementaldecoder("utf-8")().decode(head)
+            encoding = "utf-8"
+        except UnicodeDecodeError:
+            encoding = "latin-1"
+    return codecs.getreader(encoding)(raw)
+
+
 def create_tables():
     """Create all DB tables."""
     try:
@@ -2066,6 +2603,8 @@ def create_tables():
             OrcidAuthorizeCall,
             Task,
             AffiliationRecord,
+            RecordEvent,
+            MailMessage,
             GroupIdRecord,
             OrgInvitation,
             Url,
@@ -2094,6 +2633,25 @@ def create_tables():
             else:
                 raise ex
 
+    # Partial indexes covering only the rows still pending the batch processing (or delivery):
+    for model, column, condition in [
+        (AffiliationRecord, "task_id", "processed_at IS NULL AND is_active"),
+        (FundingRecord, "task_id", "processed_at IS NULL AND is_active"),
+        (WorkRecord, "task_id", "processed_at IS NULL AND is_active"),
+        (PeerReviewRecord, "task_id", "processed_at IS NULL AND is_active"),
+        (FundingInvitees, "funding_record_id", "processed_at IS NULL"),
+        (WorkInvitees, "work_record_id", "processed_at IS NULL"),
+        (PeerReviewInvitee, "peer_review_record_id", "processed_at IS NULL"),
+        (MailMessage, "scheduled_at", "sent_at IS NULL"),
+    ]:
+        table = model._meta.db_table
+        model._meta.database.execute_sql(f"CREATE INDEX IF NOT EXISTS {table}_unprocessed_idx "
+                                         f"ON {table} ({column}) WHERE {condition}")
+    # The tokens the batch processing can use for updating ORCID profiles:
+    OrcidToken._meta.database.execute_sql(
+        f"CREATE INDEX IF NOT EXISTS {OrcidToken._meta.db_table}_update_idx "
+        f"ON {OrcidToken._meta.db_table} (user_id, org_id) WHERE can_update_activities")
+
 
 def create_audit_tables():
     """Create all DB audit tables for PostgreSQL DB."""
@@ -2114,7 +2672,8 @@ def create_audit_tables():
 def drop_tables():
     """Drop all model tables."""
     for m in (Organisation, User, UserOrg, OrcidToken, UserOrgAffiliation, OrgInfo, OrgInvitation,
-              OrcidApiCall, OrcidAuthorizeCall, Task, AffiliationRecord, Url, UserInvitation):
+              OrcidApiCall, OrcidAuthorizeCall, Task, AffiliationRecord, RecordEvent, MailMessage, Url,
+              UserInvitation):
         if m.table_exists():
             try:
                 m.drop_table(fail_silently=True, cascade=m._meta.database.drop_cascade)
@@ -2124,17 +2683,92 @@ def drop_tables():
 
 def load_yaml_json(filename, source):
     """Create a common way of loading json or yaml file."""
-    if os.path.splitext(filename)[1][1:] == "yaml" or os.path.splitext(
-            filename)[1][1:] == "yml":
-        data_list = yaml.load(source)
-    else:
-        data_list = json.loads(source)
+    return list(iter_yaml_json(filename, source))
 
-    # Removing None for correct schema validation
-    if not isinstance(data_list, list):
-        raise SchemaError(
-            u"Schema validation failed:\n - Expecting a list of Records")
-    return data_list
+
+def iter_yaml_json(filename, source, chunk_size=65536):
+    """Iterate over the records of a JSON or YAML file without loading up the whole file.
+
+    The source can be either a string or a text stream. JSON files are expected to contain
+    a top level array of records. YAML files can contain either a sequence of records or
+    a stream of documents with a record per document.
+    """
+    if isinstance(source, str):
+        source = StringIO(source)
+    ext = os.path.splitext(filename)[1][1:].lower() if filename else None
+    items = _iter_yaml(source) if ext in ("yaml", "yml") else _iter_json(source, chunk_size)
+    for item in items:
+        if not isinstance(item, dict):
+            raise SchemaError(u"Schema validation failed:\n - Expecting a list of Records")
+        yield item
+
+
+def _iter_json(source, chunk_size):
+    """Parse incrementally a top level JSON array and yield its elements."""
+    decoder = json.JSONDecoder()
+    buf, pos, eof = "", 0, False
+
+    def peek():
+        """Skip the white spaces and return the next character (or '' at the end)."""
+        nonlocal buf, pos, eof
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n\ufeff":
+                pos += 1
+            if pos < len(buf) or eof:
+                return buf[pos:pos + 1]
+            buf, pos = source.read(chunk_size), 0
+            eof = not buf
+
+    if peek() != "[":
+        raise SchemaError(u"Schema validation failed:\n - Expecting a list of Records")
+    pos += 1
+    if peek() == "]":
+        return
+    while True:
+        peek()
+        size = chunk_size
+        while True:
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+                # a value at the very end of the buffer might be incomplete:
+                if end < len(buf) or eof:
+                    break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            chunk = source.read(size)
+            eof = not chunk
+            buf, pos, size = buf[pos:] + chunk, 0, size * 2
+        pos = end
+        yield item
+        c = peek()
+        if c == "]":
+            return
+        if c != ",":
+            raise json.JSONDecodeError("Expecting ',' delimiter", buf, pos)
+        pos += 1
+
+
+def _iter_yaml(source):
+    """Compose and construct YAML records one by one."""
+    loader = yaml.SafeLoader(source)
+    try:
+        loader.get_event()  # StreamStartEvent
+        while not loader.check_event(yaml.StreamEndEvent):
+            loader.get_event()  # DocumentStartEvent
+            if loader.check_event(yaml.SequenceStartEvent):
+                loader.get_event()
+                while not loader.check_event(yaml.SequenceEndEvent):
+                    yield loader.construct_document(loader.compose_node(None, None))
+                loader.get_event()
+            else:
+                data = loader.construct_document(loader.compose_node(None, None))
+                if data is not None:
+                    yield data
+            loader.get_event()  # DocumentEndEvent
+            loader.anchors = {}
+    finally:
+        loader.dispose()
 
 
 def del_none(d):
@@ -2155,6 +2789,27 @@ def del_none(d):
     return d
 
 
+def chunks(iterable, size):
+    """Split up the iterable into lists of the given size (the last one might be shorter)."""
+    it = iter(iterable)
+    chunk = list(islice(it, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(it, size))
+
+
+def iterate(query, itersize=None):
+    """Iterate over the query result without loading the whole of it into the memory.
+
+    With PostgreSQL the rows get read in batches through a named (server-side) cursor
+    (see failover.ServerSideCursorMixin). Otherwise (e.g., SQLite in the tests) the result rows
+    just don't get cached. The query gets cloned, so it can be iterated even if it has been executed.
+    """
+    if hasattr(query.database, "iterate"):
+        return query.database.iterate(query, itersize=itersize)
+    return query.clone().iterator()
+
+
 def get_val(d, *keys, default=None):
     """To get the value from uploaded fields."""
     for k in keys:
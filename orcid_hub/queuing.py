@@ -48,6 +48,17 @@ if __redis_available:
 else:
     from functools import wraps
 
+    # the keyword arguments of the job queueing that are not passed to the job function:
+    QUEUE_KWARGS = ("queue", "timeout", "description", "result_ttl", "ttl", "depends_on", "job_id", "at_front",
+                    "meta")
+
+    class Queue:
+        """Fake queue."""
+
+        def fetch_job(self, job_id):
+            """Fetch a job (the jobs get executed in place, so none of them is ever queued)."""
+            return None
+
     class RQ:
         """Fake RQ."""
 
@@ -55,6 +66,10 @@ else:
             """Create a fake wrapper."""
             pass
 
+        def get_queue(self, name=None):
+            """Get the (always empty) fake queue."""
+            return Queue()
+
         def job(*args, **kwargs):  # noqa: D202
             """Docorate a function to emulate queueing into a queue."""
 
@@ -63,6 +78,12 @@ else:
                 def decorated_view(*args, **kwargs):
                     return fn(*args, **kwargs)
 
+                @wraps(fn)
+                def queue(*args, **kwargs):
+                    return fn(*args, **{k: v for k, v in kwargs.items() if k not in QUEUE_KWARGS})
+
+                # without a queue the job gets executed in place:
+                decorated_view.queue = queue
                 return decorated_view
 
             return wrapper
@@ -7,7 +7,7 @@ from peewee import JOIN, SQL, fn
 from . import app
 from .forms import DateRangeForm
 from .login_provider import roles_required
-from .models import OrcidToken, Organisation, OrgInvitation, Role, User, UserInvitation, UserOrg
+from .models import OrcidToken, Organisation, OrgInvitation, Role, User, UserInvitation, UserOrg, iterate
 
 
 @app.route("/user_summary")
@@ -68,8 +68,9 @@ def user_summary():  # noqa: D103
         order_fields = [f.desc() for f in order_fields]
     query = query.order_by(*order_fields)
 
-    total_user_count = sum(r.user_count for r in query if r.user_count)
-    total_linked_user_count = sum(r.linked_user_count for r in query if r.linked_user_count)
+    total_user_count, total_linked_user_count = query.select(
+        fn.SUM(user_counts.c.user_count), fn.SUM(linked_counts.c.linked_user_count)).order_by().scalar(as_tuple=True)
+    total_user_count, total_linked_user_count = int(total_user_count or 0), int(total_linked_user_count or 0)
 
     headers = [(h,
                 url_for(
@@ -83,7 +84,7 @@ def user_summary():  # noqa: D103
     return render_template(
         "user_summary.html",
         form=form,
-        query=query,
+        query=iterate(query),
         total_user_count=total_user_count,
         total_linked_user_count=total_linked_user_count,
         sort=sort, desc=desc,
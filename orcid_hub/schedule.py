@@ -12,3 +12,4 @@ def setup():
         job.delete()
 
     tasks.process_tasks.schedule(datetime.utcnow(), interval=3600)
+    tasks.dispatch_mail.schedule(datetime.utcnow(), interval=60)
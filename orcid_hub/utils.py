@@ -1,28 +1,40 @@
 # -*- coding: utf-8 -*-
 """Various utilities."""
 
+import glob
+import gzip
 import json
 import logging
 import os
+import random
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from functools import lru_cache
 from itertools import filterfalse, groupby
 from urllib.parse import quote, urlencode, urlparse
 
 import emails
 import flask
 import requests
+from emails.backend import SMTPBackend
 from flask import request, url_for
 from flask_login import current_user
 from html2text import html2text
 from itsdangerous import BadSignature, TimedJSONWebSignatureSerializer
 from jinja2 import Template
-from peewee import JOIN
+from peewee import JOIN, ForeignKeyField, fn
 
 from . import app, orcid_client, rq
-from .models import (AFFILIATION_TYPES, Affiliation, AffiliationRecord, FundingInvitees,
-                     FundingRecord, OrcidToken, Organisation, PartialDate, PeerReviewExternalId,
-                     PeerReviewInvitee, PeerReviewRecord, Role, Task, Url, User, UserInvitation,
-                     UserOrg, WorkInvitees, WorkRecord, get_val)
+from .models import (AFFILIATION_TYPES, BULK_CHUNK_SIZE, Affiliation, AffiliationRecord, FundingInvitees,
+                     FundingRecord, IdentityMap, MailMessage, OrcidToken, Organisation, PartialDate,
+                     PeerReviewExternalId, PeerReviewInvitee, PeerReviewRecord, RecordOutcome, Role, Task, TaskStatus,
+                     TaskType, Url, User, UserInvitation, UserOrg, WorkInvitees, WorkRecord, db, decoded_stream,
+                     chunks, defer_task_touches, get_val, iterate)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -34,6 +46,8 @@ EMP_CODES = {"faculty", "staff", "emp"}
 ENV = app.config.get("ENV")
 EXTERNAL_SP = app.config.get("EXTERNAL_SP")
 
+_smtp = threading.local()
+
 
 def get_next_url():
     """Retrieve and sanitize next/return URL."""
@@ -54,6 +68,108 @@ def is_valid_url(url):
         return False
 
 
+class TTLCache:
+    """Bounded thread-safe LRU cache with the entries expiring after the given time-to-live (in seconds)."""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        """Create an empty cache."""
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Get the cached value or the default value if it is missing or has expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Cache the value evicting the least recently used entries over the limit."""
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Remove all the entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def get_smtp_backend():
+    """Get the pooled SMTP transport of the current thread.
+
+    The transport keeps the connection open and reuses it for the following messages.
+    It reconnects if the connection was left idle for longer than MAIL_IDLE_TIMEOUT
+    (most likely closed by the server) or if the server has dropped it.
+    """
+    backend = getattr(_smtp, "backend", None)
+    now = time.monotonic()
+    if backend is None:
+        backend = _smtp.backend = SMTPBackend(
+            host=app.config["MAIL_SERVER"], port=app.config["MAIL_PORT"])
+    elif now - _smtp.last_used > app.config["MAIL_IDLE_TIMEOUT"]:
+        backend.close()
+    _smtp.last_used = now
+    return backend
+
+
+@lru_cache()
+def read_dkim_key(path):
+    """Read the DKIM private key once. Returns None if the key is missing."""
+    if os.path.exists(path):
+        with open(path) as key_file:
+            return key_file.read()
+
+
+EMAIL_TEMPLATE_FIELDS = ("EMAIL", "SUBJECT", "MESSAGE", "LOGO", "BASE_URL", "INCLUDED_URL")
+EMAIL_SKELETON_FIELD_REGEX = re.compile(r"@@(\d)@@")
+
+
+@lru_cache(maxsize=4)
+def get_email_jinja_env(jinja_env):
+    """Get the Jinja2 environment for rendering email messages.
+
+    The environment is created once so that the compiled templates get reused.
+    """
+    return jinja_env.overlay(autoescape=False)
+
+
+@lru_cache(maxsize=128)
+def get_inline_email_template(source):
+    """Compile an inline email message template (cached by its source)."""
+    return Template(source)
+
+
+@lru_cache(maxsize=128)
+def get_email_skeletons(base):
+    """Compile the base email template (default or organisation one) into HTML and plain text skeletons.
+
+    The skeletons are cached by the base template text, so a change of the organisation
+    email template gets picked up right away.
+    """
+    html = base.format(**{f: f"@@{n}@@" for n, f in enumerate(EMAIL_TEMPLATE_FIELDS)})
+    return html, html2text(html)
+
+
+def fill_email_skeleton(skeleton, values):
+    """Fill in the fields of the email skeleton."""
+    return EMAIL_SKELETON_FIELD_REGEX.sub(
+        lambda m: str(values[EMAIL_TEMPLATE_FIELDS[int(m.group(1))]]), skeleton)
+
+
 def send_email(template,
                recipient,
                cc_email=None,
@@ -63,6 +179,7 @@ def send_email(template,
                base=None,
                logo=None,
                org=None,
+               outbox=False,
                **kwargs):
     """Send an email, acquiring its payload by rendering a jinja2 template.
 
@@ -75,6 +192,8 @@ def send_email(template,
     :type sender: :class:`tuple` (:class:`str`, :class:`str`)
     :param sender: 'From' (name, email)
     :param org: organisation on which behalf the email is sent
+    :param outbox: queue the message into the outbox within the current transaction
+        instead of sending it right away (see :func:`dispatch_mail`)
     * `recipient` and `sender` are made available to the template as variables
     * In any email tuple, name may be ``None``
     * The subject is retrieved from a sufficiently-global template variable;
@@ -94,8 +213,6 @@ def send_email(template,
     """
     if not org and current_user and not current_user.is_anonymous:
         org = current_user.organisation
-    jinja_env = flask.current_app.jinja_env
-
     if logo is None:
         if org and org.logo:
             logo = url_for("logo_image", token=org.logo.token, _external=True)
@@ -109,7 +226,7 @@ def send_email(template,
     if not base:
         base = app.config.get("DEFAULT_EMAIL_TEMPLATE")
 
-    jinja_env = jinja_env.overlay(autoescape=False)
+    jinja_env = get_email_jinja_env(flask.current_app.jinja_env)
 
     def _jinja2_email(name, email):
         if name is None:
@@ -120,7 +237,7 @@ def send_email(template,
     if '\n' not in template and template.endswith(".html"):
         template = jinja_env.get_template(template)
     else:
-        template = Template(template)
+        template = get_inline_email_template(template)
 
     kwargs["sender"] = _jinja2_email(*sender)
     kwargs["recipient"] = _jinja2_email(*recipient)
@@ -133,29 +250,150 @@ def send_email(template,
     if subject is None:
         subject = getattr(rendered, "subject", "Welcome to the NZ ORCID Hub")
 
-    html_msg = base.format(
+    message = str(rendered)
+    values = dict(
         EMAIL=kwargs["recipient"]["email"],
         SUBJECT=subject,
-        MESSAGE=str(rendered),
+        MESSAGE=message,
         LOGO=logo,
         BASE_URL=url_for("index", _external=True)[:-1],
         INCLUDED_URL=kwargs.get("invitation_url", '') or kwargs.get("include_url", ''))
+    html_skeleton, text_skeleton = get_email_skeletons(base)
+    html_msg = fill_email_skeleton(html_skeleton, values)
+    # The plain text alternative: only the message itself gets converted
+    values["MESSAGE"] = html2text(message).strip()
+    plain_msg = fill_email_skeleton(text_skeleton, values)
+
+    if outbox:
+        MailMessage.create(
+            recipient_name=recipient[0],
+            recipient_email=recipient[1],
+            recipient_domain=recipient[1].split('@')[-1].lower(),
+            cc_name=cc_email[0] if cc_email else None,
+            cc_email=cc_email[1] if cc_email else None,
+            reply_to_name=reply_to[0],
+            reply_to_email=reply_to[1],
+            subject=subject,
+            html=html_msg,
+            text=plain_msg)
+        return
 
-    plain_msg = html2text(html_msg)
+    msg = compose_email(subject, html_msg, recipient, cc_email, reply_to, text=plain_msg)
+    msg.send(smtp=get_smtp_backend())
 
+
+def compose_email(subject, html, recipient, cc_email=None, reply_to=None, text=None):
+    """Create a (DKIM signed) email message."""
     msg = emails.html(
         subject=subject,
         mail_from=(app.config.get("APP_NAME", "ORCID Hub"), app.config.get("MAIL_DEFAULT_SENDER")),
-        html=html_msg,
-        text=plain_msg)
-    dkip_key_path = app.config["DKIP_KEY_PATH"]
-    if os.path.exists(dkip_key_path):
-        msg.dkim(key=open(dkip_key_path), domain="orcidhub.org.nz", selector="default")
+        html=html,
+        text=html2text(html) if text is None else text)
+    dkim_key = read_dkim_key(app.config["DKIP_KEY_PATH"])
+    if dkim_key:
+        msg.dkim(key=dkim_key, domain="orcidhub.org.nz", selector="default")
     if cc_email:
         msg.cc.append(cc_email)
     msg.set_headers({"reply-to": reply_to})
     msg.mail_to.append(recipient)
-    msg.send(smtp=dict(host=app.config["MAIL_SERVER"], port=app.config["MAIL_PORT"]))
+    return msg
+
+
+def deliver_mail_message(message):
+    """Send a message from the outbox. Returns the error if the delivery failed."""
+    try:
+        msg = compose_email(
+            message.subject,
+            message.html,
+            (message.recipient_name, message.recipient_email),
+            cc_email=(message.cc_name, message.cc_email) if message.cc_email else None,
+            reply_to=(message.reply_to_name, message.reply_to_email),
+            text=message.text)
+        response = msg.send(smtp=get_smtp_backend())
+        if response is not None:
+            response.raise_if_needed()
+    except Exception as ex:
+        return ex
+
+
+@rq.job(timeout=600)
+def dispatch_mail(max_messages=1000):
+    """Deliver the email messages queued in the outbox.
+
+    The messages get sent concurrently (MAIL_DISPATCH_WORKERS connections) sending no more
+    than MAIL_DOMAIN_RATE_LIMIT messages per minute to a recipient domain. The messages over
+    the limit are left for the next run. A failed delivery is retried with an exponential
+    back-off up to MAIL_MAX_ATTEMPTS times. Returns the number of the delivered messages.
+
+    The messages get claimed with a conditional update that sets a (randomized) lease time,
+    so that the overlapping runs never pick up the same messages.
+    """
+    now = datetime.utcnow()
+    budget = defaultdict(lambda: app.config["MAIL_DOMAIN_RATE_LIMIT"])
+    for domain, count in MailMessage.select(
+            MailMessage.recipient_domain, fn.COUNT(MailMessage.id)).where(
+                MailMessage.sent_at >= now - timedelta(minutes=1)).group_by(
+                    MailMessage.recipient_domain).tuples():
+        budget[domain] -= count
+
+    # The budget is applied per domain (the domains with the oldest messages first),
+    # so that a domain with a large backlog doesn't hold up the rest:
+    pending = (MailMessage.sent_at.is_null(), MailMessage.scheduled_at <= now,
+               MailMessage.attempts < app.config["MAIL_MAX_ATTEMPTS"])
+    ids = []
+    for domain, in MailMessage.select(MailMessage.recipient_domain).where(*pending).group_by(
+            MailMessage.recipient_domain).order_by(fn.MIN(MailMessage.id)).tuples():
+        if len(ids) >= max_messages:
+            break
+        limit = min(budget[domain], max_messages - len(ids))
+        if limit > 0:
+            ids.extend(i for (i, ) in MailMessage.select(MailMessage.id).where(
+                MailMessage.recipient_domain == domain, *pending).order_by(MailMessage.id).limit(limit).tuples())
+    if not ids:
+        return 0
+
+    # Lease the messages so that they don't get picked up by another dispatcher run:
+    leased_until = now + timedelta(minutes=10, microseconds=random.randrange(1000000))
+    messages = []
+    for chunk in chunks(sorted(ids), BULK_CHUNK_SIZE):
+        MailMessage.update(scheduled_at=leased_until).where(
+            MailMessage.id << chunk, MailMessage.sent_at.is_null(), MailMessage.scheduled_at <= now).execute()
+        messages.extend(MailMessage.select().where(
+            MailMessage.id << chunk, MailMessage.scheduled_at == leased_until).order_by(MailMessage.id))
+    if not messages:
+        return 0
+
+    backends = set()
+
+    def deliver(message):
+        error = deliver_mail_message(message)
+        backends.add(getattr(_smtp, "backend", None))
+        return error
+
+    try:
+        with ThreadPoolExecutor(max_workers=app.config["MAIL_DISPATCH_WORKERS"]) as executor:
+            errors = list(executor.map(deliver, messages))
+    finally:
+        # The worker threads are gone, so are their SMTP transports:
+        for backend in backends - {None}:
+            try:
+                backend.close()
+            except Exception:
+                logger.exception("Failed to close the SMTP connection.")
+
+    now = datetime.utcnow()
+    sent_ids = [m.id for m, ex in zip(messages, errors) if ex is None]
+    for chunk in chunks(sent_ids, BULK_CHUNK_SIZE):
+        MailMessage.update(
+            sent_at=now, attempts=MailMessage.attempts + 1, error=None).where(MailMessage.id << chunk).execute()
+    for m, ex in zip(messages, errors):
+        if ex is not None:
+            logger.error(f"Failed to send the message (ID: {m.id}) to {m.recipient_email}: {ex}")
+            MailMessage.update(
+                attempts=m.attempts + 1,
+                error=str(ex),
+                scheduled_at=now + timedelta(minutes=2**m.attempts)).where(MailMessage.id == m.id).execute()
+    return len(sent_ids)
 
 
 def generate_confirmation_token(*args, expiration=1300000, **kwargs):
@@ -217,6 +455,53 @@ def track_event(category, action, label=None, value=0):
     return response
 
 
+def get_error_code(ex):
+    """Get a short code of the error (exception) encountered while processing a record."""
+    status = getattr(ex, "status", None)
+    return f"HTTP-{status}" if status else type(ex).__name__
+
+
+def short_id_pool(size):
+    """Supply short URL IDs reserved in batches of the given size (generated lazily on the first use)."""
+    while True:
+        yield from Url.generate_short_ids(size)
+
+
+def get_token_holders(user_org_ids):
+    """Get the (user ID, organisation ID) pairs, out of the given ones, with an '/activities/update' access token.
+
+    A single query replaces the token lookups of the individual users of a batch.
+    """
+    user_org_ids = {(user_id, org_id) for user_id, org_id in user_org_ids if user_id}
+    if not user_org_ids:
+        return set()
+    return user_org_ids & set(
+        OrcidToken.select(OrcidToken.user_id, OrcidToken.org_id).where(
+            OrcidToken.user_id << list({user_id for user_id, _ in user_org_ids}),
+            OrcidToken.org_id << list({org_id for _, org_id in user_org_ids}),
+            OrcidToken.can_update_activities).distinct().tuples())
+
+
+def get_reset_emails(model, emails, *where):
+    """Get the emails, out of the given ones, of the invitees (or the records) that have been reset.
+
+    A single query of the record event log replaces the reset status lookups of the individual invitees.
+    The invitees reset before the resets were logged as the events are recognized by the status.
+    """
+    emails = list(set(emails))
+    if not emails:
+        return set()
+    reset_emails = {
+        email for email, in model.select_logged("reset", model.email).where(
+            model.email << emails, *where).distinct().tuples()
+    }
+    emails = [e for e in emails if e not in reset_emails]
+    if emails:
+        reset_emails.update(email for email, in model.select(model.email).where(
+            model.email << emails, model.status ** "%reset%", *where).distinct().tuples())
+    return reset_emails
+
+
 def set_server_name():
     """Set the server name for batch processes."""
     if not app.config.get("SERVER_NAME"):
@@ -228,7 +513,8 @@ def set_server_name():
 
 
 def send_work_funding_peer_review_invitation(inviter, org, email, first_name=None, last_name=None, task_id=None,
-                                             invitation_template=None, token_expiry_in_sec=1300000, **kwargs):
+                                             invitation_template=None, token_expiry_in_sec=1300000, outbox=False,
+                                             short_id=None, **kwargs):
     """Send a work, funding or peer review invitation to join ORCID Hub logging in via ORCID."""
     try:
         logger.info(f"*** Sending an invitation to '{first_name} <{email}>' "
@@ -253,9 +539,10 @@ def send_work_funding_peer_review_invitation(inviter, org, email, first_name=Non
         with app.app_context():
             url = flask.url_for('orcid_login', invitation_token=token, _external=True)
             invitation_url = flask.url_for(
-                "short_url", short_id=Url.shorten(url).short_id, _external=True)
+                "short_url", short_id=Url.shorten(url, short_id=short_id).short_id, _external=True)
             send_email(
                 invitation_template,
+                outbox=outbox,
                 recipient=(user.organisation.name, user.email),
                 reply_to=(inviter.name, inviter.email),
                 invitation_url=invitation_url,
@@ -297,7 +584,7 @@ def send_work_funding_peer_review_invitation(inviter, org, email, first_name=Non
 def create_or_update_work(user, org_id, records, *args, **kwargs):
     """Create or update work record of a user."""
     records = list(unique_everseen(records, key=lambda t: t.work_record.id))
-    org = Organisation.get(id=org_id)
+    org = records[0].org if records else Organisation.get(id=org_id)
     client_id = org.orcid_client_id
     api = orcid_client.MemberAPI(org, user)
 
@@ -355,8 +642,11 @@ def create_or_update_work(user, org_id, records, *args, **kwargs):
                 put_code, orcid, created = api.create_or_update_work(task_by_user)
                 if created:
                     wi.add_status_line(f"Work record was created.")
+                    wi.outcome = RecordOutcome.CREATED
                 else:
                     wi.add_status_line(f"Work record was updated.")
+                    wi.outcome = RecordOutcome.UPDATED
+                wi.error_code = None
                 wi.orcid = orcid
                 wi.put_code = put_code
 
@@ -366,6 +656,7 @@ def create_or_update_work(user, org_id, records, *args, **kwargs):
                 if ex and ex.body:
                     exception_msg = json.loads(ex.body)
                 wi.add_status_line(f"Exception occured processing the record: {exception_msg}.")
+                wi.outcome, wi.error_code = RecordOutcome.ERROR, get_error_code(ex)
                 wr.add_status_line(
                     f"Error processing record. Fix and reset to enable this record to be processed: {exception_msg}."
                 )
@@ -383,7 +674,7 @@ def create_or_update_work(user, org_id, records, *args, **kwargs):
 def create_or_update_peer_review(user, org_id, records, *args, **kwargs):
     """Create or update peer review record of a user."""
     records = list(unique_everseen(records, key=lambda t: t.peer_review_record.id))
-    org = Organisation.get(id=org_id)
+    org = records[0].org if records else Organisation.get(id=org_id)
     client_id = org.orcid_client_id
     api = orcid_client.MemberAPI(org, user)
 
@@ -449,8 +740,11 @@ def create_or_update_peer_review(user, org_id, records, *args, **kwargs):
                 put_code, orcid, created = api.create_or_update_peer_review(task_by_user)
                 if created:
                     pi.add_status_line(f"Peer review record was created.")
+                    pi.outcome = RecordOutcome.CREATED
                 else:
                     pi.add_status_line(f"Peer review record was updated.")
+                    pi.outcome = RecordOutcome.UPDATED
+                pi.error_code = None
                 pi.orcid = orcid
                 pi.put_code = put_code
 
@@ -460,6 +754,7 @@ def create_or_update_peer_review(user, org_id, records, *args, **kwargs):
                 if ex and ex.body:
                     exception_msg = json.loads(ex.body)
                 pi.add_status_line(f"Exception occured processing the record: {exception_msg}.")
+                pi.outcome, pi.error_code = RecordOutcome.ERROR, get_error_code(ex)
                 pr.add_status_line(
                     f"Error processing record. Fix and reset to enable this record to be processed: {exception_msg}."
                 )
@@ -477,7 +772,7 @@ def create_or_update_peer_review(user, org_id, records, *args, **kwargs):
 def create_or_update_funding(user, org_id, records, *args, **kwargs):
     """Create or update funding record of a user."""
     records = list(unique_everseen(records, key=lambda t: t.funding_record.id))
-    org = Organisation.get(id=org_id)
+    org = records[0].org if records else Organisation.get(id=org_id)
     client_id = org.orcid_client_id
     api = orcid_client.MemberAPI(org, user)
 
@@ -538,8 +833,11 @@ def create_or_update_funding(user, org_id, records, *args, **kwargs):
                 put_code, orcid, created = api.create_or_update_funding(task_by_user)
                 if created:
                     fi.add_status_line(f"Funding record was created.")
+                    fi.outcome = RecordOutcome.CREATED
                 else:
                     fi.add_status_line(f"Funding record was updated.")
+                    fi.outcome = RecordOutcome.UPDATED
+                fi.error_code = None
                 fi.orcid = orcid
                 fi.put_code = put_code
 
@@ -549,6 +847,7 @@ def create_or_update_funding(user, org_id, records, *args, **kwargs):
                 if ex and ex.body:
                     exception_msg = json.loads(ex.body)
                 fi.add_status_line(f"Exception occured processing the record: {exception_msg}.")
+                fi.outcome, fi.error_code = RecordOutcome.ERROR, get_error_code(ex)
                 fr.add_status_line(
                     f"Error processing record. Fix and reset to enable this record to be processed: {exception_msg}."
                 )
@@ -585,6 +884,8 @@ def send_user_invitation(inviter,
                          task_id=None,
                          cc_email=None,
                          token_expiry_in_sec=1300000,
+                         outbox=False,
+                         short_id=None,
                          **kwargs):
     """Send an invitation to join ORCID Hub logging in via ORCID."""
     try:
@@ -611,9 +912,10 @@ def send_user_invitation(inviter,
         with app.app_context():
             url = flask.url_for('orcid_login', invitation_token=token, _external=True)
             invitation_url = flask.url_for(
-                "short_url", short_id=Url.shorten(url).short_id, _external=True)
+                "short_url", short_id=Url.shorten(url, short_id=short_id).short_id, _external=True)
             send_email(
                 "email/researcher_invitation.html",
+                outbox=outbox,
                 recipient=(user.organisation.name, user.email),
                 reply_to=(inviter.name, inviter.email),
                 cc_email=cc_email,
@@ -662,10 +964,9 @@ def send_user_invitation(inviter,
             token=token)
 
         status = "The invitation sent at " + datetime.utcnow().isoformat(timespec="seconds")
-        (AffiliationRecord.update(status=AffiliationRecord.status + "\n" + status).where(
-            AffiliationRecord.status.is_null(False), AffiliationRecord.email == email).execute())
-        (AffiliationRecord.update(status=status).where(AffiliationRecord.status.is_null(),
-                                                       AffiliationRecord.email == email).execute())
+        AffiliationRecord.update_status(
+            status, AffiliationRecord.task_id == task_id, AffiliationRecord.email == email,
+            AffiliationRecord.processed_at.is_null(), code="invited", outcome=RecordOutcome.INVITED)
         return ui.id
 
     except Exception as ex:
@@ -705,7 +1006,7 @@ def create_or_update_affiliations(user, org_id, records, *args, **kwargs):
     4. If no match create a new one.
     """
     records = list(unique_everseen(records, key=lambda t: t.affiliation_record.id))
-    org = Organisation.get(id=org_id)
+    org = records[0].org if records else Organisation.get(id=org_id)
     client_id = org.orcid_client_id
     api = orcid_client.MemberAPI(org, user)
     profile_record = api.get_record()
@@ -785,24 +1086,30 @@ def create_or_update_affiliations(user, org_id, records, *args, **kwargs):
                     ar.add_status_line(
                         f"Unsupported affiliation type '{at}' allowed values are: " + ', '.join(
                             at for at in AFFILIATION_TYPES))
+                    ar.outcome, ar.error_code = RecordOutcome.ERROR, "unsupported-affiliation-type"
                     ar.save()
                     continue
 
                 if no_orcid_call:
                     ar.add_status_line(f"{str(affiliation)} record unchanged.")
+                    ar.outcome = RecordOutcome.UNCHANGED
                 else:
                     put_code, orcid, created = api.create_or_update_affiliation(
                         affiliation=affiliation, **ar._data)
                     if created:
                         ar.add_status_line(f"{str(affiliation)} record was created.")
+                        ar.outcome = RecordOutcome.CREATED
                     else:
                         ar.add_status_line(f"{str(affiliation)} record was updated.")
+                        ar.outcome = RecordOutcome.UPDATED
                     ar.orcid = orcid
                     ar.put_code = put_code
+                ar.error_code = None
 
             except Exception as ex:
                 logger.exception(f"For {user} encountered exception")
                 ar.add_status_line(f"Exception occured processing the record: {ex}.")
+                ar.outcome, ar.error_code = RecordOutcome.ERROR, get_error_code(ex)
 
             finally:
                 ar.processed_at = datetime.utcnow()
@@ -819,6 +1126,7 @@ def create_or_update_affiliations(user, org_id, records, *args, **kwargs):
                     "short_url", short_id=Url.shorten(url).short_id, _external=True)
                 send_email(
                     "email/researcher_reinvitation.html",
+                    outbox=True,
                     recipient=(user.organisation.name, user.email),
                     reply_to=(task_by_user.created_by.name, task_by_user.created_by.email),
                     invitation_url=invitation_url,
@@ -846,46 +1154,98 @@ def create_or_update_affiliations(user, org_id, records, *args, **kwargs):
 
             status = "Exception occured while accessing user's profile. " \
                      "Hence, The invitation resent at " + datetime.utcnow().isoformat(timespec="seconds")
-            (AffiliationRecord.update(status=AffiliationRecord.status + "\n" + status).where(
-                AffiliationRecord.status.is_null(False),
-                AffiliationRecord.email == user.email).execute())
-            (AffiliationRecord.update(status=status).where(
-                AffiliationRecord.status.is_null(),
-                AffiliationRecord.email == user.email).execute())
+            AffiliationRecord.update_status(
+                status, AffiliationRecord.task_id == task_by_user.id, AffiliationRecord.email == user.email,
+                AffiliationRecord.processed_at.is_null(), code="invited", outcome=RecordOutcome.INVITED)
             return
 
 
+def get_foreign_key(model, rel_model):
+    """Get the foreign key field of the model referencing the related model."""
+    return next(f for f in model._meta.fields.values() if isinstance(f, ForeignKeyField) and f.rel_model is rel_model)
+
+
+def select_invitee_candidates(record_model, invitee_model):
+    """Select the IDs of the invitees of the active task records pending the processing.
+
+    The candidates are the invitees who haven't been invited yet and the invited ones who
+    have since granted the organisation the '/activities/update' access. They get selected
+    with a UNION of queries with indexed equality joins only (instead of an OR-join on the
+    user email or ORCID iD and a LIKE match of the token scope, that can't use the indexes).
+    """
+    fk = get_foreign_key(invitee_model, record_model)
+    pending = invitee_model.select(invitee_model.id).join(
+        record_model, on=(record_model.id == fk)).join(
+            Task, on=(Task.id == record_model.task_id)).where(
+                record_model.processed_at.is_null(), record_model.is_active,
+                invitee_model.processed_at.is_null())
+
+    def authorized(user_match):
+        return pending.join(User, on=user_match).join(
+            OrcidToken,
+            on=((OrcidToken.user_id == User.id) & (OrcidToken.org_id == Task.org_id)
+                & OrcidToken.can_update_activities))
+
+    return (pending.where(invitee_model.outcome != RecordOutcome.INVITED)
+            | authorized(User.email == invitee_model.email)
+            | authorized(User.orcid == invitee_model.orcid))
+
+
+def select_invitee_batch(record_model, invitee_model, max_rows=20):
+    """Select a batch of the invitees pending the processing (see select_invitee_candidates).
+
+    The users get matched by the email, or by the ORCID iD if there is no match, with two
+    lookups and are attached to the invitees as 'user' (an empty User if there is no match).
+
+    Returns the list of the tasks with the joined records and invitees (an entry per invitee)
+    ordered by the task, the record and the invitee.
+    """
+    ids = [r[0] for r in select_invitee_candidates(record_model, invitee_model).limit(max_rows).tuples()]
+    if not ids:
+        return []
+
+    tasks = list(
+        Task.select(Task, record_model, invitee_model).join(
+            record_model, on=(Task.id == record_model.task_id)).join(
+                invitee_model, on=(record_model.id == get_foreign_key(invitee_model, record_model))).where(
+                    invitee_model.id << ids))
+    # The joined records and invitees are attached to the tasks under their table names:
+    record_attr, invitee_attr = record_model._meta.db_table, invitee_model._meta.db_table
+    invitees = [getattr(getattr(t, record_attr), invitee_attr) for t in tasks]
+    emails = list({i.email for i in invitees if i.email})
+    orcids = list({i.orcid for i in invitees if i.orcid})
+    users_by_email = {u.email: u for u in User.select().where(User.email << emails)} if emails else {}
+    users_by_orcid = {u.orcid: u for u in User.select().where(User.orcid << orcids)} if orcids else {}
+    for i in invitees:
+        i.user = users_by_email.get(i.email) or users_by_orcid.get(i.orcid) or User()
+
+    def sort_key(t):
+        r = getattr(t, record_attr)
+        i = getattr(r, invitee_attr)
+        return (t.id, r.id, i.user.id or 0, i.email or '', i.first_name or '', i.last_name or '')
+
+    return sorted(tasks, key=sort_key)
+
+
 @rq.job(timeout=300)
+@defer_task_touches()
 def process_work_records(max_rows=20):
     """Process uploaded work records."""
     set_server_name()
+    short_ids = short_id_pool(max_rows)
     task_ids = set()
     work_ids = set()
     """This query is to retrieve Tasks associated with work records, which are not processed but are active"""
 
-    tasks = (Task.select(
-        Task, WorkRecord, WorkInvitees,
-        User, UserInvitation.id.alias("invitation_id"), OrcidToken).where(
-            WorkRecord.processed_at.is_null(), WorkInvitees.processed_at.is_null(),
-            WorkRecord.is_active,
-            (OrcidToken.id.is_null(False) |
-             ((WorkInvitees.status.is_null()) |
-              (WorkInvitees.status.contains("sent").__invert__())))).join(
-                  WorkRecord, on=(Task.id == WorkRecord.task_id)).join(
-                      WorkInvitees,
-                      on=(WorkRecord.id == WorkInvitees.work_record_id)).join(
-                          User, JOIN.LEFT_OUTER,
-                          on=((User.email == WorkInvitees.email) | (User.orcid == WorkInvitees.orcid)))
-             .join(Organisation, JOIN.LEFT_OUTER, on=(Organisation.id == Task.org_id)).join(
-                 UserInvitation,
-                 JOIN.LEFT_OUTER,
-                 on=((UserInvitation.email == WorkInvitees.email)
-                     & (UserInvitation.task_id == Task.id))).join(
-                         OrcidToken,
-                         JOIN.LEFT_OUTER,
-                         on=((OrcidToken.user_id == User.id)
-                             & (OrcidToken.org_id == Organisation.id)
-                             & (OrcidToken.scope.contains("/activities/update")))).limit(max_rows))
+    tasks = select_invitee_batch(WorkRecord, WorkInvitees, max_rows)
+
+    # Preload the organisations and the users referenced by the batch:
+    identity_map = IdentityMap()
+    identity_map.attach(tasks, "org", "created_by")
+    identity_map.attach((t.work_record.work_invitees.user for t in tasks), "organisation")
+    # The per-batch lookups of the token holders and the invitees who have been reset:
+    token_holders = get_token_holders((t.work_record.work_invitees.user.id, t.org_id) for t in tasks)
+    reset_emails = get_reset_emails(WorkInvitees, (t.work_record.work_invitees.email for t in tasks))
 
     for (task_id, org_id, work_record_id, user), tasks_by_user in groupby(tasks, lambda t: (
             t.id,
@@ -893,9 +1253,7 @@ def process_work_records(max_rows=20):
             t.work_record.id,
             t.work_record.work_invitees.user,)):
         """If we have the token associated to the user then update the work record, otherwise send him an invite"""
-        if (user.id is None or user.orcid is None or not OrcidToken.select().where(
-            (OrcidToken.user_id == user.id) & (OrcidToken.org_id == org_id) &
-            (OrcidToken.scope.contains("/activities/update"))).exists()):  # noqa: E127, E129
+        if user.id is None or user.orcid is None or (user.id, org_id) not in token_holders:
 
             for k, tasks in groupby(
                     tasks_by_user,
@@ -907,24 +1265,26 @@ def process_work_records(max_rows=20):
                         t.work_record.work_invitees.last_name, )
             ):  # noqa: E501
                 email = k[2]
+                invitee_ids = [t.work_record.work_invitees.id for t in tasks]
                 token_expiry_in_sec = 2600000
                 status = "The invitation sent at " + datetime.utcnow().isoformat(timespec="seconds")
                 try:
                     # For researcher invitation the expiry is 30 days, if it is reset then it is 2 weeks.
-                    if WorkInvitees.select().where(WorkInvitees.email == email,
-                                                   WorkInvitees.status ** "%reset%").count() != 0:
+                    if email in reset_emails:
                         token_expiry_in_sec = 1300000
-                    send_work_funding_peer_review_invitation(*k, task_id=task_id,
-                                                             token_expiry_in_sec=token_expiry_in_sec,
-                                                             invitation_template="email/work_invitation.html")
-
-                    (WorkInvitees.update(status=WorkInvitees.status + "\n" + status).where(
-                        WorkInvitees.status.is_null(False), WorkInvitees.email == email).execute())
-                    (WorkInvitees.update(status=status).where(
-                        WorkInvitees.status.is_null(), WorkInvitees.email == email).execute())
+                    # The invitation gets queued in the same transaction as the status change:
+                    with db.atomic():
+                        send_work_funding_peer_review_invitation(
+                            *k, task_id=task_id, token_expiry_in_sec=token_expiry_in_sec, short_id=next(short_ids),
+                            invitation_template="email/work_invitation.html", outbox=True)
+                        WorkInvitees.update_status(
+                            status, WorkInvitees.id << invitee_ids, code="invited", outcome=RecordOutcome.INVITED)
                 except Exception as ex:
-                    (WorkInvitees.update(processed_at=datetime.utcnow(), status=f"Failed to send an invitation: {ex}.")
-                     .where(WorkInvitees.email == email, WorkInvitees.processed_at.is_null())).execute()
+                    WorkInvitees.update_status(
+                        f"Failed to send an invitation: {ex}.",
+                        WorkInvitees.id << invitee_ids, WorkInvitees.processed_at.is_null(),
+                        code="invitation-failed", processed_at=datetime.utcnow(),
+                        outcome=RecordOutcome.ERROR, error_code=get_error_code(ex))
         else:
             create_or_update_work(user, org_id, tasks_by_user)
         task_ids.add(task_id)
@@ -939,28 +1299,21 @@ def process_work_records(max_rows=20):
             if not work_record.status or "error" not in work_record.status:
                 work_record.add_status_line("Work record is processed.")
             work_record.save()
+    Task.count_processed(WorkRecord, work_ids)
 
-    for task in Task.select().where(Task.id << task_ids):
+    completed_tasks = list(Task.select().where(Task.id << task_ids))
+    identity_map.attach(completed_tasks, "created_by")
+    for task in completed_tasks:
         # The task is completed (Once all records are processed):
-        if not (WorkRecord.select().where(WorkRecord.task_id == task.id, WorkRecord.processed_at.is_null()).exists()):
-            task.completed_at = datetime.utcnow()
-            task.save()
-            error_count = WorkRecord.select().where(
-                WorkRecord.task_id == task.id, WorkRecord.status**"%error%").count()
+        if task.check_completed():
+            error_count = task.error_count
             row_count = task.record_count
 
             with app.app_context():
-                protocol_scheme = 'http'
-                if not EXTERNAL_SP:
-                    protocol_scheme = 'https'
-                export_url = flask.url_for(
-                    "workrecord.export",
-                    export_type="json",
-                    _scheme=protocol_scheme,
-                    task_id=task.id,
-                    _external=True)
+                export_url = get_task_export_url(task, "json")
                 send_email(
                     "email/work_task_completed.html",
+                    outbox=True,
                     subject="Work Process Update",
                     recipient=(task.created_by.name, task.created_by.email),
                     error_count=error_count,
@@ -968,37 +1321,26 @@ def process_work_records(max_rows=20):
                     export_url=export_url,
                     task_name="Work",
                     filename=task.filename)
+    publish_task_progress(task_ids)
 
 
+@defer_task_touches()
 def process_peer_review_records(max_rows=20):
     """Process uploaded peer_review records."""
     set_server_name()
+    short_ids = short_id_pool(max_rows)
     task_ids = set()
     peer_review_ids = set()
     """This query is to retrieve Tasks associated with peer review records, which are not processed but are active"""
-    tasks = (Task.select(
-        Task, PeerReviewRecord, PeerReviewInvitee,
-        User, UserInvitation.id.alias("invitation_id"), OrcidToken).where(
-            PeerReviewRecord.processed_at.is_null(), PeerReviewInvitee.processed_at.is_null(),
-            PeerReviewRecord.is_active,
-            (OrcidToken.id.is_null(False) |
-             ((PeerReviewInvitee.status.is_null()) |
-              (PeerReviewInvitee.status.contains("sent").__invert__())))).join(
-                  PeerReviewRecord, on=(Task.id == PeerReviewRecord.task_id)).join(
-                      PeerReviewInvitee,
-                      on=(PeerReviewRecord.id == PeerReviewInvitee.peer_review_record_id)).join(
-                          User, JOIN.LEFT_OUTER,
-                          on=((User.email == PeerReviewInvitee.email) | (User.orcid == PeerReviewInvitee.orcid)))
-             .join(Organisation, JOIN.LEFT_OUTER, on=(Organisation.id == Task.org_id)).join(
-                 UserInvitation,
-                 JOIN.LEFT_OUTER,
-                 on=((UserInvitation.email == PeerReviewInvitee.email)
-                     & (UserInvitation.task_id == Task.id))).join(
-                         OrcidToken,
-                         JOIN.LEFT_OUTER,
-                         on=((OrcidToken.user_id == User.id)
-                             & (OrcidToken.org_id == Organisation.id)
-                             & (OrcidToken.scope.contains("/activities/update")))).limit(max_rows))
+    tasks = select_invitee_batch(PeerReviewRecord, PeerReviewInvitee, max_rows)
+
+    # Preload the organisations and the users referenced by the batch:
+    identity_map = IdentityMap()
+    identity_map.attach(tasks, "org", "created_by")
+    identity_map.attach((t.peer_review_record.peer_review_invitee.user for t in tasks), "organisation")
+    # The per-batch lookups of the token holders and the invitees who have been reset:
+    token_holders = get_token_holders((t.peer_review_record.peer_review_invitee.user.id, t.org_id) for t in tasks)
+    reset_emails = get_reset_emails(PeerReviewInvitee, (t.peer_review_record.peer_review_invitee.email for t in tasks))
 
     for (task_id, org_id, peer_review_record_id, user), tasks_by_user in groupby(tasks, lambda t: (
             t.id,
@@ -1006,9 +1348,7 @@ def process_peer_review_records(max_rows=20):
             t.peer_review_record.id,
             t.peer_review_record.peer_review_invitee.user,)):
         """If we have the token associated to the user then update the peer record, otherwise send him an invite"""
-        if (user.id is None or user.orcid is None or not OrcidToken.select().where(
-            (OrcidToken.user_id == user.id) & (OrcidToken.org_id == org_id) &
-            (OrcidToken.scope.contains("/activities/update"))).exists()):  # noqa: E127, E129
+        if user.id is None or user.orcid is None or (user.id, org_id) not in token_holders:
 
             for k, tasks in groupby(
                     tasks_by_user,
@@ -1020,24 +1360,25 @@ def process_peer_review_records(max_rows=20):
                         t.peer_review_record.peer_review_invitee.last_name, )
             ):  # noqa: E501
                 email = k[2]
+                invitee_ids = [t.peer_review_record.peer_review_invitee.id for t in tasks]
                 token_expiry_in_sec = 2600000
                 status = "The invitation sent at " + datetime.utcnow().isoformat(timespec="seconds")
                 try:
-                    if PeerReviewInvitee.select().where(PeerReviewInvitee.email == email,
-                                                        PeerReviewInvitee.status ** "%reset%").count() != 0:
+                    if email in reset_emails:
                         token_expiry_in_sec = 1300000
-                    send_work_funding_peer_review_invitation(*k, task_id=task_id,
-                                                             token_expiry_in_sec=token_expiry_in_sec,
-                                                             invitation_template="email/peer_review_invitation.html")
-
-                    (PeerReviewInvitee.update(status=PeerReviewInvitee.status + "\n" + status).where(
-                        PeerReviewInvitee.status.is_null(False), PeerReviewInvitee.email == email).execute())
-                    (PeerReviewInvitee.update(status=status).where(
-                        PeerReviewInvitee.status.is_null(), PeerReviewInvitee.email == email).execute())
+                    # The invitation gets queued in the same transaction as the status change:
+                    with db.atomic():
+                        send_work_funding_peer_review_invitation(
+                            *k, task_id=task_id, token_expiry_in_sec=token_expiry_in_sec, short_id=next(short_ids),
+                            invitation_template="email/peer_review_invitation.html", outbox=True)
+                        PeerReviewInvitee.update_status(
+                            status, PeerReviewInvitee.id << invitee_ids, code="invited", outcome=RecordOutcome.INVITED)
                 except Exception as ex:
-                    (PeerReviewInvitee.update(processed_at=datetime.utcnow(),
-                                              status=f"Failed to send an invitation: {ex}.")
-                     .where(PeerReviewInvitee.email == email, PeerReviewInvitee.processed_at.is_null())).execute()
+                    PeerReviewInvitee.update_status(
+                        f"Failed to send an invitation: {ex}.",
+                        PeerReviewInvitee.id << invitee_ids, PeerReviewInvitee.processed_at.is_null(),
+                        code="invitation-failed", processed_at=datetime.utcnow(),
+                        outcome=RecordOutcome.ERROR, error_code=get_error_code(ex))
         else:
             create_or_update_peer_review(user, org_id, tasks_by_user)
         task_ids.add(task_id)
@@ -1052,29 +1393,21 @@ def process_peer_review_records(max_rows=20):
             if not peer_review_record.status or "error" not in peer_review_record.status:
                 peer_review_record.add_status_line("Peer Review record is processed.")
             peer_review_record.save()
+    Task.count_processed(PeerReviewRecord, peer_review_ids)
 
-    for task in Task.select().where(Task.id << task_ids):
+    completed_tasks = list(Task.select().where(Task.id << task_ids))
+    identity_map.attach(completed_tasks, "created_by")
+    for task in completed_tasks:
         # The task is completed (Once all records are processed):
-        if not (PeerReviewRecord.select().where(PeerReviewRecord.task_id == task.id,
-                                                PeerReviewRecord.processed_at.is_null()).exists()):
-            task.completed_at = datetime.utcnow()
-            task.save()
-            error_count = PeerReviewRecord.select().where(
-                PeerReviewRecord.task_id == task.id, PeerReviewRecord.status ** "%error%").count()
+        if task.check_completed():
+            error_count = task.error_count
             row_count = task.record_count
 
             with app.app_context():
-                protocol_scheme = 'http'
-                if not EXTERNAL_SP:
-                    protocol_scheme = 'https'
-                export_url = flask.url_for(
-                    "peerreviewrecord.export",
-                    export_type="json",
-                    _scheme=protocol_scheme,
-                    task_id=task.id,
-                    _external=True)
+                export_url = get_task_export_url(task, "json")
                 send_email(
                     "email/work_task_completed.html",
+                    outbox=True,
                     subject="Peer Review Process Update",
                     recipient=(task.created_by.name, task.created_by.email),
                     error_count=error_count,
@@ -1082,39 +1415,26 @@ def process_peer_review_records(max_rows=20):
                     export_url=export_url,
                     task_name="Peer Review",
                     filename=task.filename)
+    publish_task_progress(task_ids)
 
 
+@defer_task_touches()
 def process_funding_records(max_rows=20):
     """Process uploaded affiliation records."""
     set_server_name()
+    short_ids = short_id_pool(max_rows)
     task_ids = set()
     funding_ids = set()
     """This query is to retrieve Tasks associated with funding records, which are not processed but are active"""
-    tasks = (Task.select(
-        Task, FundingRecord, FundingInvitees,
-        User, UserInvitation.id.alias("invitation_id"), OrcidToken).where(
-            FundingRecord.processed_at.is_null(), FundingInvitees.processed_at.is_null(),
-            FundingRecord.is_active,
-            (OrcidToken.id.is_null(False) |
-             ((FundingInvitees.status.is_null()) |
-              (FundingInvitees.status.contains("sent").__invert__())))).join(
-                  FundingRecord, on=(Task.id == FundingRecord.task_id)).join(
-                      FundingInvitees,
-                      on=(FundingRecord.id == FundingInvitees.funding_record_id)).join(
-                          User,
-                          JOIN.LEFT_OUTER,
-                          on=((User.email == FundingInvitees.email) |
-                              (User.orcid == FundingInvitees.orcid)))
-             .join(Organisation, JOIN.LEFT_OUTER, on=(Organisation.id == Task.org_id)).join(
-                 UserInvitation,
-                 JOIN.LEFT_OUTER,
-                 on=((UserInvitation.email == FundingInvitees.email)
-                     & (UserInvitation.task_id == Task.id))).join(
-                         OrcidToken,
-                         JOIN.LEFT_OUTER,
-                         on=((OrcidToken.user_id == User.id)
-                             & (OrcidToken.org_id == Organisation.id)
-                             & (OrcidToken.scope.contains("/activities/update")))).limit(max_rows))
+    tasks = select_invitee_batch(FundingRecord, FundingInvitees, max_rows)
+
+    # Preload the organisations and the users referenced by the batch:
+    identity_map = IdentityMap()
+    identity_map.attach(tasks, "org", "created_by")
+    identity_map.attach((t.funding_record.funding_invitees.user for t in tasks), "organisation")
+    # The per-batch lookups of the token holders and the invitees who have been reset:
+    token_holders = get_token_holders((t.funding_record.funding_invitees.user.id, t.org_id) for t in tasks)
+    reset_emails = get_reset_emails(FundingInvitees, (t.funding_record.funding_invitees.email for t in tasks))
 
     for (task_id, org_id, funding_record_id, user), tasks_by_user in groupby(tasks, lambda t: (
             t.id,
@@ -1122,9 +1442,7 @@ def process_funding_records(max_rows=20):
             t.funding_record.id,
             t.funding_record.funding_invitees.user,)):
         """If we have the token associated to the user then update the funding record, otherwise send him an invite"""
-        if (user.id is None or user.orcid is None or not OrcidToken.select().where(
-            (OrcidToken.user_id == user.id) & (OrcidToken.org_id == org_id) &
-            (OrcidToken.scope.contains("/activities/update"))).exists()):  # noqa: E127, E129
+        if user.id is None or user.orcid is None or (user.id, org_id) not in token_holders:
 
             for k, tasks in groupby(
                     tasks_by_user,
@@ -1136,24 +1454,25 @@ def process_funding_records(max_rows=20):
                         t.funding_record.funding_invitees.last_name, )
             ):  # noqa: E501
                 email = k[2]
+                invitee_ids = [t.funding_record.funding_invitees.id for t in tasks]
                 token_expiry_in_sec = 2600000
                 status = "The invitation sent at " + datetime.utcnow().isoformat(timespec="seconds")
                 try:
-                    if FundingInvitees.select().where(FundingInvitees.email == email,
-                                                      FundingInvitees.status ** "%reset%").count() != 0:
+                    if email in reset_emails:
                         token_expiry_in_sec = 1300000
-                    send_work_funding_peer_review_invitation(*k, task_id=task_id,
-                                                             token_expiry_in_sec=token_expiry_in_sec,
-                                                             invitation_template="email/funding_invitation.html")
-
-                    (FundingInvitees.update(status=FundingInvitees.status + "\n" + status).where(
-                        FundingInvitees.status.is_null(False), FundingInvitees.email == email).execute())
-                    (FundingInvitees.update(status=status).where(
-                        FundingInvitees.status.is_null(), FundingInvitees.email == email).execute())
+                    # The invitation gets queued in the same transaction as the status change:
+                    with db.atomic():
+                        send_work_funding_peer_review_invitation(
+                            *k, task_id=task_id, token_expiry_in_sec=token_expiry_in_sec, short_id=next(short_ids),
+                            invitation_template="email/funding_invitation.html", outbox=True)
+                        FundingInvitees.update_status(
+                            status, FundingInvitees.id << invitee_ids, code="invited", outcome=RecordOutcome.INVITED)
                 except Exception as ex:
-                    (FundingInvitees.update(processed_at=datetime.utcnow(),
-                                            status=f"Failed to send an invitation: {ex}.")
-                     .where(FundingInvitees.email == email, FundingInvitees.processed_at.is_null())).execute()
+                    FundingInvitees.update_status(
+                        f"Failed to send an invitation: {ex}.",
+                        FundingInvitees.id << invitee_ids, FundingInvitees.processed_at.is_null(),
+                        code="invitation-failed", processed_at=datetime.utcnow(),
+                        outcome=RecordOutcome.ERROR, error_code=get_error_code(ex))
         else:
             create_or_update_funding(user, org_id, tasks_by_user)
         task_ids.add(task_id)
@@ -1168,40 +1487,35 @@ def process_funding_records(max_rows=20):
             if not funding_record.status or "error" not in funding_record.status:
                 funding_record.add_status_line("Funding record is processed.")
             funding_record.save()
+    Task.count_processed(FundingRecord, funding_ids)
 
-    for task in Task.select().where(Task.id << task_ids):
+    completed_tasks = list(Task.select().where(Task.id << task_ids))
+    identity_map.attach(completed_tasks, "created_by")
+    for task in completed_tasks:
         # The task is completed (Once all records are processed):
-        if not (FundingRecord.select().where(FundingRecord.task_id == task.id,
-                                             FundingRecord.processed_at.is_null()).exists()):
-            task.completed_at = datetime.utcnow()
-            task.save()
-            error_count = FundingRecord.select().where(
-                FundingRecord.task_id == task.id, FundingRecord.status**"%error%").count()
+        if task.check_completed():
+            error_count = task.error_count
             row_count = task.record_count
 
             with app.app_context():
-                protocol_scheme = 'http'
-                if not EXTERNAL_SP:
-                    protocol_scheme = 'https'
-                export_url = flask.url_for(
-                    "fundingrecord.export",
-                    export_type="json",
-                    _scheme=protocol_scheme,
-                    task_id=task.id,
-                    _external=True)
+                export_url = get_task_export_url(task, "json")
                 send_email(
                     "email/funding_task_completed.html",
+                    outbox=True,
                     subject="Funding Process Update",
                     recipient=(task.created_by.name, task.created_by.email),
                     error_count=error_count,
                     row_count=row_count,
                     export_url=export_url,
                     filename=task.filename)
+    publish_task_progress(task_ids)
 
 
+@defer_task_touches()
 def process_affiliation_records(max_rows=20):
     """Process uploaded affiliation records."""
     set_server_name()
+    short_ids = short_id_pool(max_rows)
     # TODO: optimize removing redundant fields
     # TODO: perhaps it should be broken into 2 queries
     task_ids = set()
@@ -1210,9 +1524,7 @@ def process_affiliation_records(max_rows=20):
             AffiliationRecord.processed_at.is_null(), AffiliationRecord.is_active,
             ((User.id.is_null(False) & User.orcid.is_null(False) & OrcidToken.id.is_null(False)) |
              ((User.id.is_null() | User.orcid.is_null() | OrcidToken.id.is_null()) &
-              UserInvitation.id.is_null() &
-              (AffiliationRecord.status.is_null()
-               | AffiliationRecord.status.contains("sent").__invert__())))).join(
+              UserInvitation.id.is_null() & (AffiliationRecord.outcome != RecordOutcome.INVITED)))).join(
                    AffiliationRecord, on=(Task.id == AffiliationRecord.task_id)).join(
                        User,
                        JOIN.LEFT_OUTER,
@@ -1228,14 +1540,23 @@ def process_affiliation_records(max_rows=20):
                          JOIN.LEFT_OUTER,
                          on=((OrcidToken.user_id == User.id) &
                              (OrcidToken.org_id == Organisation.id) &
-                             (OrcidToken.scope.contains("/activities/update")))).limit(max_rows))
+                             OrcidToken.can_update_activities)).limit(max_rows))
+    # Preload the organisations and the users referenced by the batch:
+    identity_map = IdentityMap()
+    identity_map.attach(tasks, "org", "created_by")
+    identity_map.attach((t.affiliation_record.user for t in tasks), "organisation")
+    # The per-batch lookups of the token holders and the records that have been reset:
+    token_holders = get_token_holders((t.affiliation_record.user.id, t.org_id) for t in tasks)
+    reset_emails = get_reset_emails(
+        AffiliationRecord, (t.affiliation_record.email for t in tasks),
+        AffiliationRecord.task_id << list({t.id for t in tasks}))
+    record_ids = list({t.affiliation_record.id for t in tasks})
+
     for (task_id, org_id, user), tasks_by_user in groupby(tasks, lambda t: (
             t.id,
             t.org_id,
             t.affiliation_record.user, )):
-        if (user.id is None or user.orcid is None or not OrcidToken.select().where(
-            (OrcidToken.user_id == user.id) & (OrcidToken.org_id == org_id) &
-            (OrcidToken.scope.contains("/activities/update"))).exists()):  # noqa: E127, E129
+        if user.id is None or user.orcid is None or (user.id, org_id) not in token_holders:
 
             # maps invitation attributes to affiliation type set:
             # - the user who uploaded the task;
@@ -1255,46 +1576,40 @@ def process_affiliation_records(max_rows=20):
                 token_expiry_in_sec = 2600000
                 try:
                     # For researcher invitation the expiry is 30 days, if it is reset then it 2 weeks.
-                    if AffiliationRecord.select().where(AffiliationRecord.task_id == task_id,
-                                                        AffiliationRecord.email == email,
-                                                        AffiliationRecord.status ** "%reset%").count() != 0:
+                    if email in reset_emails:
                         token_expiry_in_sec = 1300000
-                    send_user_invitation(*invitation, affiliations, task_id=task_id,
-                                         token_expiry_in_sec=token_expiry_in_sec)
+                    # The invitation gets queued in the same transaction as the status change:
+                    with db.atomic():
+                        send_user_invitation(*invitation, affiliations, task_id=task_id,
+                                             token_expiry_in_sec=token_expiry_in_sec, outbox=True,
+                                             short_id=next(short_ids))
                 except Exception as ex:
-                    (AffiliationRecord.update(
-                        processed_at=datetime.utcnow(), status=f"Failed to send an invitation: {ex}.")
-                     .where(AffiliationRecord.task_id == task_id, AffiliationRecord.email == email,
-                            AffiliationRecord.processed_at.is_null())).execute()
+                    AffiliationRecord.update_status(
+                        f"Failed to send an invitation: {ex}.",
+                        AffiliationRecord.id << record_ids, AffiliationRecord.task_id == task_id,
+                        AffiliationRecord.email == email, AffiliationRecord.processed_at.is_null(),
+                        code="invitation-failed", processed_at=datetime.utcnow(),
+                        outcome=RecordOutcome.ERROR, error_code=get_error_code(ex))
         else:  # user exits and we have tokens
             create_or_update_affiliations(user, org_id, tasks_by_user)
         task_ids.add(task_id)
-    for task in Task.select().where(Task.id << task_ids):
+    Task.count_processed(AffiliationRecord, record_ids)
+
+    completed_tasks = list(Task.select().where(Task.id << task_ids))
+    identity_map.attach(completed_tasks, "created_by")
+    for task in completed_tasks:
         # The task is completed (all recores are processed):
-        if not (AffiliationRecord.select().where(
-                AffiliationRecord.task_id == task.id,
-                AffiliationRecord.processed_at.is_null()).exists()):
-            task.completed_at = datetime.utcnow()
-            task.save()
-            error_count = AffiliationRecord.select().where(
-                AffiliationRecord.task_id == task.id, AffiliationRecord.status**"%error%").count()
+        if task.check_completed():
+            error_count = task.error_count
             row_count = task.record_count
-            orcid_rec_count = task.affiliation_records.select(
-                AffiliationRecord.orcid).distinct().count()
+            orcid_rec_count = task.orcid_rec_count
 
             with app.app_context():
-                protocol_scheme = 'http'
-                if not EXTERNAL_SP:
-                    protocol_scheme = 'https'
-                export_url = flask.url_for(
-                    "affiliationrecord.export",
-                    export_type="csv",
-                    _scheme=protocol_scheme,
-                    task_id=task.id,
-                    _external=True)
+                export_url = get_task_export_url(task, "csv")
                 try:
                     send_email(
                         "email/task_completed.html",
+                        outbox=True,
                         subject="Affiliation Process Update",
                         recipient=(task.created_by.name, task.created_by.email),
                         error_count=error_count,
@@ -1305,6 +1620,7 @@ def process_affiliation_records(max_rows=20):
                 except Exception:
                     logger.exception(
                         "Failed to send batch process comletion notification message.")
+    publish_task_progress(task_ids)
 
 
 @rq.job(timeout=300)
@@ -1327,7 +1643,7 @@ def process_tasks(max_rows=20):
     tasks = Task.select().where(Task.expires_at.is_null())
     if max_rows and max_rows > 0:
         tasks = tasks.limit(max_rows)
-    for task in tasks:
+    for task in iterate(tasks):
 
         max_created_at_expiry = (task.created_at + timedelta(weeks=4))
         max_updated_at_expiry = (task.updated_at + timedelta(weeks=2))
@@ -1346,24 +1662,16 @@ def process_tasks(max_rows=20):
             Task.expires_at < (datetime.now() + timedelta(weeks=1)))
     if max_rows and max_rows > 0:
         tasks = tasks.limit(max_rows)
-    for task in tasks:
+    for task in iterate(tasks):
 
-        export_model = task.record_model._meta.name + ".export"
         error_count = task.error_count
 
         set_server_name()
         with app.app_context():
-            protocol_scheme = 'http'
-            if not EXTERNAL_SP:
-                protocol_scheme = 'https'
-            export_url = flask.url_for(
-                export_model,
-                export_type="csv",
-                _scheme=protocol_scheme,
-                task_id=task.id,
-                _external=True)
+            export_url = get_task_export_url(task, "csv")
             send_email(
                 "email/task_expiration.html",
+                outbox=True,
                 task=task,
                 subject="Batch process task is about to expire",
                 recipient=(task.created_by.name, task.created_by.email),
@@ -1475,10 +1783,205 @@ def disable_org_webhook(org):
         register_orcid_webhook.queue(u, delete=True)
 
 
+def queue_task_file(source, filename, task_type=TaskType.AFFILIATION, org=None):
+    """Spool the uploaded batch task file to the disk and queue loading of it in the background.
+
+    The source can be either a binary stream or bytes. Returns the task created in the "loading" state.
+    """
+    if org is None:
+        org = current_user.organisation
+    task = Task.create(org=org, filename=filename, task_type=task_type, status=TaskStatus.LOADING)
+    upload_folder = app.config["UPLOAD_FOLDER"]
+    os.makedirs(upload_folder, exist_ok=True)
+    path = os.path.join(upload_folder, f"task-{task.id}.upload")
+    with open(path, "wb") as output:
+        if isinstance(source, bytes):
+            output.write(source)
+        else:
+            shutil.copyfileobj(source, output)
+    load_task_file.queue(task.id, path)
+    return task
+
+
+@rq.job(timeout=3600)
+@defer_task_touches()
+def load_task_file(task_id, path):
+    """Load the spooled batch task file into the task created in advance and remove the file.
+
+    The records get committed in batches so the progress can be seen on the task page and in the API.
+    If the loading fails, the loaded records get removed and the task is marked as failed.
+    """
+    task = Task.get(id=task_id)
+    batch_size = app.config["UPLOAD_BATCH_SIZE"]
+    try:
+        with open(path, "rb") as raw:
+            source = decoded_stream(raw)
+            if task.task_type == TaskType.AFFILIATION:
+                Task.load_from_csv(
+                    source, filename=task.filename, org=task.org, task=task, batch_size=batch_size)
+            else:
+                task.record_model.load_from_json(
+                    source, filename=task.filename, org=task.org, task=task, batch_size=batch_size)
+        Task.update(status=TaskStatus.LOADED).where(Task.id == task_id).execute()
+    except Exception as ex:
+        logger.exception(f"Failed to load the task file {task.filename} (task ID: {task_id})")
+        with db.atomic():
+            task.record_model.delete().where(task.record_model.task_id == task_id).execute()
+            Task.update(
+                status=TaskStatus.FAILED, load_error=str(ex), record_count=0,
+                updated_at=datetime.utcnow()).where(Task.id == task_id).execute()
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+EXPORT_TYPES = ("csv", "tsv", "json", "yaml")
+
+
+def get_task_export_path(task_id, export_type, version):
+    """Get the path of the compressed export of the task keyed by the content version of the task."""
+    return os.path.join(app.config["EXPORT_FOLDER"], f"task-{task_id}-{version}.{export_type}.gz")
+
+
+def queue_task_export(task_id, export_type, version):
+    """Queue building of the task export unless it is already queued (or being built)."""
+    job_id = f"task-export-{task_id}-{export_type}-{version}"
+    job = rq.get_queue().fetch_job(job_id)
+    if job is None or job.is_failed:
+        build_task_export.queue(task_id, export_type, job_id=job_id)
+
+
+def get_task_export_url(task, export_type):
+    """Get the external URL of the export of the task records.
+
+    The export of a big task gets queued to be built in advance, before the link gets followed.
+    """
+    if task.record_count >= app.config["EXPORT_ASYNC_THRESHOLD"]:
+        queue_task_export(task.id, export_type, task.export_version)
+    return flask.url_for(
+        "export_task",
+        task_id=task.id,
+        export_type=export_type,
+        _scheme="http" if EXTERNAL_SP else "https",
+        _external=True)
+
+
+@rq.job(timeout=3600)
+def build_task_export(task_id, export_type):
+    """Build the export of the task records and store it compressed in the export folder.
+
+    The export gets produced by the task record model view and the previous versions of
+    the same export get removed. Returns the path of the export.
+    """
+    task = Task.get(id=task_id)
+    version = task.export_version
+    path = get_task_export_path(task_id, export_type, version)
+    if os.path.exists(path):
+        return path
+
+    endpoint = task.record_model._meta.name
+    view = next(v for admin in app.extensions["admin"] for v in admin._views if v.endpoint == endpoint)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with app.test_request_context(f"{view.url}/export/{export_type}/", query_string=dict(task_id=task_id)):
+        # There is no user in the worker, so the export method of the view gets invoked directly,
+        # bypassing the access check of the exposed endpoint. The records are selected by the task ID:
+        export = type(view).export
+        resp = getattr(export, "__wrapped__", export)(view, export_type=export_type)
+        if resp.status_code != 200:
+            raise Exception(f"Failed to export the task {task} (ID: {task_id}) as {export_type}")
+        temp_path = f"{path}.{os.getpid()}"
+        with gzip.open(temp_path, "wb") as output:
+            for data in resp.iter_encoded():
+                output.write(data)
+    os.replace(temp_path, path)
+
+    for old_path in glob.glob(get_task_export_path(task_id, export_type, '*')):
+        if old_path != path:
+            os.remove(old_path)
+    return path
+
+
+def get_task_progress(task_id):
+    """Get the progress counters of the task (a single row lookup)."""
+    record_count, processed_count, error_count, completed_at = Task.select(
+        Task.record_count, Task.processed_count, Task.error_count,
+        Task.completed_at).where(Task.id == task_id).tuples().get()
+    return {
+        "id": task_id,
+        "total": record_count,
+        "processed": processed_count,
+        "errors": error_count,
+        "completed-at": completed_at and completed_at.isoformat(timespec="seconds"),
+    }
+
+
+def publish_task_progress(task_ids):
+    """Notify the task progress listeners (see iter_task_progress) that the tasks have changed."""
+    if not task_ids:
+        return
+    try:
+        pipeline = rq.connection.pipeline()
+        for task_id in task_ids:
+            pipeline.publish(f"task-progress:{task_id}", task_id)
+        pipeline.execute()
+    except Exception as ex:
+        logger.warning(f"Failed to publish the progress of the tasks {task_ids}: {ex}")
+
+
+def iter_task_progress(task_id, timeout=None, interval=None):
+    """Iterate over the progress of the task as Server-Sent Events.
+
+    The counters get sent right away and then every time they change. The processors publish
+    the changes of the tasks via Redis (see publish_task_progress). If Redis is not available,
+    the task gets checked every 'interval' seconds. The stream ends with the 'completed' event
+    or after 'timeout' seconds (the client reconnects then).
+    """
+    interval = interval or app.config["TASK_PROGRESS_INTERVAL"]
+    deadline = time.monotonic() + (timeout or app.config["TASK_PROGRESS_TIMEOUT"])
+    try:
+        pubsub = rq.connection.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(f"task-progress:{task_id}")
+    except Exception as ex:
+        logger.warning(f"Failed to subscribe to the progress of the task {task_id} (falling back to polling): {ex}")
+        pubsub = None
+
+    try:
+        yield f"retry: {interval * 1000}\n\n"
+        last_progress = None
+        while True:
+            progress = get_task_progress(task_id)
+            if progress != last_progress:
+                yield f"event: progress\ndata: {json.dumps(progress)}\n\n"
+                last_progress = progress
+            else:
+                yield ": keep-alive\n\n"
+            if progress["completed-at"]:
+                yield f"event: completed\ndata: {json.dumps(progress)}\n\n"
+                return
+            if time.monotonic() >= deadline:
+                return
+            if pubsub:
+                pubsub.get_message(timeout=interval)
+            else:
+                time.sleep(interval)
+    finally:
+        if pubsub:
+            pubsub.close()
+
+
+def task_progress_response(task_id):
+    """Create the streamed response with the progress events of the task."""
+    return flask.Response(
+        flask.stream_with_context(iter_task_progress(task_id)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
 def process_records(n):
     """Process first n records and run other batch tasks."""
     process_affiliation_records(n)
     process_funding_records(n)
     process_work_records(n)
     process_peer_review_records(n)
+    dispatch_mail.queue()
     # process_tasks(n)
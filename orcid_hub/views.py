@@ -3,16 +3,19 @@
 
 import copy
 import csv
+import gzip
 import json
 import mimetypes
 import os
 import secrets
+import struct
 import traceback
+from collections import defaultdict
 from datetime import datetime
+from functools import partial
 from io import BytesIO
 
 import requests
-import tablib
 import yaml
 from flask import (Response, abort, flash, g, jsonify, redirect, render_template, request,
                    send_file, send_from_directory, stream_with_context, url_for)
@@ -28,6 +31,7 @@ from flask_login import current_user, login_required
 from jinja2 import Markup
 from playhouse.shortcuts import model_to_dict
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import wrap_file
 from wtforms.fields import BooleanField
 from flask_rq2.job import FlaskJob
 
@@ -39,11 +43,13 @@ from .forms import (ApplicationFrom, BitmapMultipleValueField, CredentialForm, E
                     FileUploadForm, JsonOrYamlFileUploadForm, LogoForm, OrgRegistrationForm,
                     PartialDateField, RecordForm, UserInvitationForm, WebhookForm)
 from .login_provider import roles_required
-from .models import (Affiliation, AffiliationRecord, CharField, Client, File, FundingInvitees,
+from .models import (BULK_CHUNK_SIZE, Affiliation, AffiliationRecord, CharField, Client, File, FundingInvitees,
                      FundingRecord, Grant, GroupIdRecord, ModelException, OrcidApiCall, OrcidToken,
                      Organisation, OrgInfo, OrgInvitation, PartialDate, PeerReviewInvitee,
-                     PeerReviewRecord, Role, Task, TextField, Token, Url, User, UserInvitation,
-                     UserOrg, UserOrgAffiliation, WorkInvitees, WorkRecord, db, get_val)
+                     PeerReviewRecord, RecordEvent, RecordOutcome, Role, Task, TaskStatus, TaskType,
+                     TextField, Token, Url, User, UserInvitation, UserOrg, UserOrgAffiliation,
+                     WorkInvitees, WorkRecord, begin_task_touches, chunks, db, decoded_stream,
+                     end_task_touches, get_val, iterate)
 # NB! Should be disabled in production
 from .pyinfo import info
 from .utils import generate_confirmation_token, get_next_url, send_user_invitation
@@ -51,6 +57,19 @@ from .utils import generate_confirmation_token, get_next_url, send_user_invitati
 HEADERS = {"Accept": "application/vnd.orcid+json", "Content-type": "application/vnd.orcid+json"}
 
 
+@app.before_request
+def begin_request_task_touches():
+    """Defer the batch task touches of the records changed handling the request."""
+    request.defers_task_touches = begin_task_touches()
+
+
+@app.teardown_request
+def end_request_task_touches(exc):
+    """Flush the deferred batch task touches at the end of the request."""
+    if getattr(request, "defers_task_touches", False):
+        end_task_touches()
+
+
 @app.errorhandler(401)
 def unauthorized(e):
     """Handle Unauthorized (401)."""
@@ -139,16 +158,95 @@ def pyinfo():
     return render_template("pyinfo.html", **info)
 
 
+short_url_cache = utils.TTLCache(app.config["SHORT_URL_CACHE_SIZE"], app.config["SHORT_URL_CACHE_TTL"])
+
+
 @app.route("/u/<short_id>")
 def short_url(short_id):
-    """Redirect to the full URL."""
+    """Redirect to the full URL.
+
+    The short URLs never change, so they get cached to spare the DB queries on the
+    invitation link clicks. The redirect response can be cached only by the browser
+    (the location holds the invitation token, it shouldn't end up in shared caches).
+    """
+    url = short_url_cache.get(short_id)
+    if url is None:
+        try:
+            url = Url.get(short_id=short_id).url
+        except Url.DoesNotExist:
+            abort(404)
+        short_url_cache.set(short_id, url)
+    resp = redirect(utils.append_qs(url, **request.args) if request.args else url)
+    resp.cache_control.private = True
+    resp.cache_control.max_age = short_url_cache.ttl
+    return resp
+
+
+def get_accessible_task(task_id):
+    """Get the task if the current user has access to it (the task of the user organisation)."""
     try:
-        u = Url.get(short_id=short_id)
-        if request.args:
-            return redirect(utils.append_qs(u.url, **request.args))
-        return redirect(u.url)
-    except Url.DoesNotExist:
+        task = Task.get(id=task_id)
+    except Task.DoesNotExist:
+        abort(404)
+    if not current_user.has_role(Role.SUPERUSER) and task.org_id != current_user.organisation.id:
+        abort(403)
+    return task
+
+
+@app.route("/admin/task/<int:task_id>/progress")
+@roles_required(Role.SUPERUSER, Role.ADMIN)
+def task_progress(task_id):
+    """Stream the processing progress of the task (Server-Sent Events)."""
+    return utils.task_progress_response(get_accessible_task(task_id).id)
+
+
+@app.route("/admin/task/<int:task_id>/export/<export_type>")
+@roles_required(Role.SUPERUSER, Role.ADMIN)
+def export_task(task_id, export_type):
+    """Export the task records.
+
+    The exports of the big tasks get built once in the background (see utils.build_task_export)
+    and served from the export folder until the records of the task change. The export of
+    a small task gets produced on the fly by the task record model view.
+    """
+    if export_type not in utils.EXPORT_TYPES:
         abort(404)
+    task = get_accessible_task(task_id)
+
+    endpoint = task.record_model._meta.name
+    if task.record_count < app.config["EXPORT_ASYNC_THRESHOLD"]:
+        return redirect(url_for(endpoint + ".export", export_type=export_type, task_id=task.id))
+
+    version = task.export_version
+    path = utils.get_task_export_path(task.id, export_type, version)
+    if not os.path.exists(path):
+        utils.queue_task_export(task.id, export_type, version)
+        flash("The export is being prepared in the background. Please try again in a few minutes.", "info")
+        return redirect(url_for(endpoint + ".index_view", task_id=task.id))
+
+    filename = secure_filename(f"{endpoint}_task_{task.id}.{export_type}")
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    headers = {"Content-Disposition": f"attachment;filename={filename}", "Vary": "Accept-Encoding"}
+    if request.accept_encodings["gzip"]:
+        resp = Response(
+            wrap_file(request.environ, open(path, "rb")), mimetype=mimetype, headers=headers,
+            direct_passthrough=True)
+        resp.headers["Content-Encoding"] = "gzip"
+        resp.content_length = os.path.getsize(path)
+    else:
+        with open(path, "rb") as source:
+            # the size of the uncompressed content (modulo 2^32) is stored in the gzip trailer:
+            source.seek(-4, os.SEEK_END)
+            content_length, = struct.unpack("<I", source.read(4))
+
+        def generate():
+            with gzip.open(path, "rb") as source:
+                yield from iter(partial(source.read, 64 * 1024), b'')
+
+        resp = Response(generate(), mimetype=mimetype, headers=headers, direct_passthrough=True)
+        resp.content_length = content_length
+    resp.set_etag(f"{task.id}-{export_type}-{version}")
+    return resp.make_conditional(request)
 
 
 def read_uploaded_file(form):
@@ -162,6 +260,28 @@ def read_uploaded_file(form):
     return raw.decode("latin-1")
 
 
+def open_uploaded_file(form):
+    """Open the uploaded file as a text stream decoding it on the fly."""
+    return decoded_stream(request.files[form.file_.name].stream)
+
+
+def queue_uploaded_file(form, task_type):
+    """Queue loading of a large uploaded file in the background.
+
+    Returns the task in the "loading" state or None if the file is small enough to get loaded in place.
+    """
+    file_ = request.files[form.file_.name]
+    file_.stream.seek(0, os.SEEK_END)
+    size = file_.stream.tell()
+    file_.stream.seek(0)
+    if size < app.config["UPLOAD_ASYNC_THRESHOLD"]:
+        return None
+    task = utils.queue_task_file(file_.stream, secure_filename(file_.filename), task_type)
+    flash(f"The file '{task.filename}' is being loaded in the background. "
+          "Check the task page for the progress.", "info")
+    return task
+
+
 def orcid_link_formatter(view, context, model, name):
     """Format ORCID ID for ModelViews."""
     if not model.orcid:
@@ -169,6 +289,11 @@ def orcid_link_formatter(view, context, model, name):
     return Markup(f'<a href="{ORCID_BASE_URL}/{model.orcid}" target="_blank">{model.orcid}</a>')
 
 
+def status_log_formatter(view, context, model, name):
+    """Format the full processing log of a record (fetched only when the record is viewed)."""
+    return Markup("<br/>").join(str(e) for e in model.events) or model.status
+
+
 class AppModelView(ModelView):
     """ModelView customization."""
 
@@ -290,7 +415,7 @@ class AppModelView(ModelView):
         """Add URL query to the data select for foreign key and select data that user has access to."""
         query = super().get_query()
 
-        if current_user and not current_user.has_role(Role.SUPERUSER) and current_user.has_role(
+        if current_user.is_authenticated and not current_user.has_role(Role.SUPERUSER) and current_user.has_role(
                 Role.ADMIN):
             # Show only rows realted to the curretn organisation the user is admin for.
             # Skip this part for SUPERUSER.
@@ -307,6 +432,26 @@ class AppModelView(ModelView):
                     query = query.where(f == int(request.args[f.db_column]))
         return query
 
+    def _export_data(self):
+        """Get the exported rows.
+
+        The export query doesn't get executed up front, the rows get read as the export
+        is being produced through a server-side cursor (see models.iterate).
+        """
+        view_args = self._get_list_extra_args()
+        sort_column = self._get_column_by_idx(view_args.sort)
+        if sort_column is not None:
+            sort_column = sort_column[0]
+        count, query = self.get_list(
+            0,
+            sort_column,
+            view_args.sort_desc,
+            view_args.search,
+            view_args.filters,
+            execute=False,
+            page_size=self.export_max_rows)
+        return count, iterate(query)
+
     def _get_list_extra_args(self):
         """Workaournd for https://github.com/flask-admin/flask-admin/issues/1512."""
         view_args = super()._get_list_extra_args()
@@ -520,6 +665,9 @@ class TaskAdmin(AppModelView):
     roles_required = Role.SUPERUSER | Role.ADMIN
     list_template = "view_tasks.html"
     column_exclude_list = ("task_type", )
+    column_formatters = dict(
+        status=lambda v, c, m, p: TaskStatus(m.status).name.capitalize()
+        + (f" ({m.record_count} records loaded)" if m.is_loading else ''))
     can_edit = False
     can_create = False
     can_delete = True
@@ -556,6 +704,7 @@ class RecordModelView(AppModelView):
     can_export = True
 
     form_widget_args = {"external_id": {"readonly": True}, "task": {"readonly": True}}
+    column_formatters_detail = dict(AppModelView.column_formatters, status=status_log_formatter)
 
     def render(self, template, **kwargs):
         """Pass the task to the render function as an added argument."""
@@ -571,6 +720,22 @@ class RecordModelView(AppModelView):
                 return redirect(request.args.get("url") or url_for("task.index_view"))
         return super().render(template, **kwargs)
 
+    def after_model_change(self, form, model, is_created):
+        """Recalculate the task counters since the record status might have been changed."""
+        model.task.refresh_counts()
+        super().after_model_change(form, model, is_created)
+
+    def after_model_delete(self, model):
+        """Deduct the deleted record from the task counters."""
+        Task.add_counts(
+            model.task_id,
+            record_count=-1,
+            processed_count=-1 if model.processed_at else 0,
+            error_count=-1 if model.processed_at and model.has_error else 0)
+        RecordEvent.delete().where(
+            RecordEvent.record_type == model._meta.db_table, RecordEvent.record_id == model.id).execute()
+        super().after_model_delete(model)
+
     def is_accessible(self):
         """Verify if the task view is accessible for the current user."""
         if not super().is_accessible():
@@ -657,22 +822,24 @@ to the best of your knowledge, correct!""")
                     task_id = request.form.get('task_id')
                 task = Task.get(id=task_id)
 
-                count = self.model.update(
-                    processed_at=None, status=status).where(self.model.is_active,
-                                                            self.model.id.in_(ids)).execute()
+                fields = dict(processed_at=None)
+                if self.model == AffiliationRecord:
+                    fields.update(outcome=RecordOutcome.PENDING, error_code=None)
+                count = self.model.update_status(
+                    status, self.model.is_active, self.model.id.in_(ids), code="reset", **fields)
 
                 if self.model == FundingRecord:
-                    count = FundingInvitees.update(
-                        processed_at=None, status=status).where(
-                            FundingInvitees.funding_record.in_(ids)).execute()
+                    count = FundingInvitees.update_status(
+                        status, FundingInvitees.funding_record.in_(ids), code="reset",
+                        processed_at=None, outcome=RecordOutcome.PENDING, error_code=None)
                 elif self.model == WorkRecord:
-                    count = WorkInvitees.update(
-                        processed_at=None, status=status).where(
-                        WorkInvitees.work_record.in_(ids)).execute()
+                    count = WorkInvitees.update_status(
+                        status, WorkInvitees.work_record.in_(ids), code="reset",
+                        processed_at=None, outcome=RecordOutcome.PENDING, error_code=None)
                 elif self.model == PeerReviewRecord:
-                    count = PeerReviewInvitee.update(
-                        processed_at=None, status=status).where(
-                        PeerReviewInvitee.peer_review_record.in_(ids)).execute()
+                    count = PeerReviewInvitee.update_status(
+                        status, PeerReviewInvitee.peer_review_record.in_(ids), code="reset",
+                        processed_at=None, outcome=RecordOutcome.PENDING, error_code=None)
                 elif self.model == AffiliationRecord:
                     # Delete the userInvitation token for selected reset items.
                     for user_invitation in UserInvitation.select().where(UserInvitation.email.in_(
@@ -688,6 +855,7 @@ to the best of your knowledge, correct!""")
                 task.expires_at = None
                 task.expiry_email_sent_at = None
                 task.completed_at = None
+                task.refresh_counts()
                 task.save()
                 if self.model == FundingRecord:
                     flash(f"{count} Funding Invitee records were reset for batch processing.")
@@ -785,6 +953,7 @@ class InviteesModelAdmin(AppModelView):
     can_create = False
     can_delete = False
     can_view_details = True
+    column_formatters_detail = dict(AppModelView.column_formatters, status=status_log_formatter)
 
     def is_accessible(self):
         """Verify if the invitees view is accessible for the current user."""
@@ -801,26 +970,29 @@ class InviteesModelAdmin(AppModelView):
         with db.atomic():
             try:
                 status = " The record was reset at " + datetime.utcnow().isoformat(timespec="seconds")
-                count = self.model.update(
-                    processed_at=None, status=status).where(self.model.id.in_(ids)).execute()
+                count = self.model.update_status(
+                    status, self.model.id.in_(ids), code="reset",
+                    processed_at=None, outcome=RecordOutcome.PENDING, error_code=None)
                 if self.model == FundingInvitees:
                     funding_record_id = self.model.select().where(
                         self.model.id.in_(ids))[0].funding_record_id
-                    FundingRecord.update(
-                        processed_at=None, status=status).where(
-                            FundingRecord.is_active, FundingRecord.id == funding_record_id).execute()
+                    FundingRecord.update_status(
+                        status, FundingRecord.is_active, FundingRecord.id == funding_record_id, code="reset",
+                        processed_at=None)
+                    FundingRecord.get(id=funding_record_id).task.refresh_counts()
                 elif self.model == WorkInvitees:
                     work_record_id = self.model.select().where(
                         self.model.id.in_(ids))[0].work_record_id
-                    WorkRecord.update(
-                        processed_at=None, status=status).where(
-                        WorkRecord.is_active, WorkRecord.id == work_record_id).execute()
+                    WorkRecord.update_status(
+                        status, WorkRecord.is_active, WorkRecord.id == work_record_id, code="reset", processed_at=None)
+                    WorkRecord.get(id=work_record_id).task.refresh_counts()
                 elif self.model == PeerReviewInvitee:
                     peer_review_record_id = self.model.select().where(
                         self.model.id.in_(ids))[0].peer_review_record_id
-                    PeerReviewRecord.update(
-                        processed_at=None, status=status).where(
-                        PeerReviewRecord.is_active, PeerReviewRecord.id == peer_review_record_id).execute()
+                    PeerReviewRecord.update_status(
+                        status, PeerReviewRecord.is_active, PeerReviewRecord.id == peer_review_record_id,
+                        code="reset", processed_at=None)
+                    PeerReviewRecord.get(id=peer_review_record_id).task.refresh_counts()
             except Exception as ex:
                 db.rollback()
                 flash(f"Failed to activate the selected records: {ex}")
@@ -874,14 +1046,36 @@ class FundingWorkCommonModelView(RecordModelView):
         "csv",
     ]
 
-    def _export_tablib(self, export_type, return_url):
-        """Override export functionality to integrate funding/work/peer review invitees with external ids."""
-        if tablib is None:
-            flash(gettext('Tablib dependency not installed.'), 'error')
-            return redirect(return_url)
+    def iter_export_rows(self):
+        """Iterate over the exported records with their external IDs and invitees.
 
+        The records are read in chunks and the related rows get fetched per chunk,
+        so the memory use doesn't depend on the size of the task.
+        """
+        count, data = self._export_data()
+        for records in chunks(data, BULK_CHUNK_SIZE):
+            external_ids, invitees = self.prefetch_external_ids_invitees(records)
+            for row in records:
+                external_id_list, invitees_list = self.get_external_id_invitees(
+                    row, external_ids[row.id], invitees[row.id])
+                yield row, external_id_list, invitees_list
+
+    @staticmethod
+    def get_export_value(value):
+        """Convert the value into plain JSON/YAML value (dates as ISO strings, new lines replaced with spaces)."""
+        if isinstance(value, str):
+            return value.replace("\n", " ")
+        if isinstance(value, dict):
+            return {k: FundingWorkCommonModelView.get_export_value(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [FundingWorkCommonModelView.get_export_value(v) for v in value]
+        if hasattr(value, "isoformat"):
+            return value.isoformat()
+        return value
+
+    def _export_json_yaml(self, export_type):
+        """Export the records with their invitees as a stream of a JSON array or a YAML document."""
         filename = self.get_export_name(export_type)
-
         disposition = 'attachment;filename=%s' % (secure_filename(filename), )
 
         mimetype, encoding = mimetypes.guess_type(filename)
@@ -890,101 +1084,131 @@ class FundingWorkCommonModelView(RecordModelView):
         if encoding:
             mimetype = '%s; charset=%s' % (mimetype, encoding)
 
-        ds = tablib.Dataset(headers=[c[1] for c in self._export_columns])
-
-        count, data = self._export_data()
-
-        for row in data:
-            external_id_list, invitees_list = self.get_external_id_invitees(row)
-            for external_ids in external_id_list:
-                vals = []
-                vals.append(external_ids['value'])
-                vals.append(invitees_list)
-                ds.append(vals)
+        headers = [c[1] for c in self._export_columns]
 
-        try:
-            try:
-                ds.yaml = yaml.safe_dump(
-                    json.loads(ds.json.replace("]\\", "]").replace("\\n", " ")))
-                response_data = ds.export(format=export_type)
-            except AttributeError:
-                response_data = getattr(ds, export_type)
-        except (AttributeError, tablib.UnsupportedFormat):
-            flash(gettext('Export type "%(type)s not supported.', type=export_type), 'error')
-            return redirect(return_url)
+        def generate():
+            is_empty = True
+            for row, external_id_list, invitees_list in self.iter_export_rows():
+                for external_id in external_id_list:
+                    item = self.get_export_value(dict(zip(headers, (external_id["value"], invitees_list))))
+                    if export_type == "yaml":
+                        yield yaml.safe_dump([item])
+                    else:
+                        yield ("[" if is_empty else ", ") + json.dumps(item)
+                    is_empty = False
+            if export_type == "yaml":
+                if is_empty:
+                    yield yaml.safe_dump([])
+            else:
+                yield "[]" if is_empty else "]"
 
         return Response(
-            response_data,
+            stream_with_context(generate()),
             headers={'Content-Disposition': disposition},
             mimetype=mimetype,
         )
 
-    def get_external_id_invitees(self, row):
-        """Get funding/work/peer_review invitees with external ids."""
-        vals = []
-        invitees_list = []
-        external_id_list = []
-        record_id = "funding_record_id"
-        funding_work_peer_review_id = "funding id"
-        invitees = "funding_invitees"
-
+    def get_export_relations(self):
+        """Get the record foreign key column, the external ID column title and the invitee relation name."""
         if self.model == WorkRecord:
-            record_id = "work_record_id"
-            funding_work_peer_review_id = "work id"
-            invitees = "work_invitees"
+            return "work_record_id", "work id", "work_invitees"
         elif self.model == PeerReviewRecord:
-            record_id = "peer_review_record_id"
-            funding_work_peer_review_id = "Peer Review id"
-            invitees = "peer_review_invitee"
-
-        exclude_list = ['id', record_id, 'processed_at']
-        for c in self._export_columns:
-            if c[0] == invitees:
-                if self.model == WorkRecord:
-                    invitees_data = row.work_invitees
-                elif self.model == PeerReviewRecord:
-                    invitees_data = row.peer_review_invitee
+            return "peer_review_record_id", "Peer Review id", "peer_review_invitee"
+        return "funding_record_id", "funding id", "funding_invitees"
+
+    def prefetch_external_ids_invitees(self, records):
+        """Fetch the external IDs and the invitees of all the records at once (per chunk of the records).
+
+        Returns the lists of the external IDs and the invitees mapped to the record IDs.
+        """
+        _, _, invitees_name = self.get_export_relations()
+        external_ids, invitees = defaultdict(list), defaultdict(list)
+        for related, fk in ((external_ids, self.model._meta.reverse_rel["external_ids"]),
+                            (invitees, self.model._meta.reverse_rel[invitees_name])):
+            model = fk.model_class
+            for chunk in chunks([r.id for r in records], BULK_CHUNK_SIZE):
+                for r in model.select().where(fk << chunk).order_by(model.id):
+                    related[r._data[fk.name]].append(r)
+        return external_ids, invitees
+
+    def get_export_formatter(self, model, exclude=()):
+        """Get the formatter of the related model instances into the export dictionaries.
+
+        The column and the type formatters get resolved only once per model (and the type of the values).
+        """
+        formatters = vars(self).setdefault("_export_formatters", {})
+        formatter = formatters.get((model, exclude))
+        if formatter:
+            return formatter
+
+        type_formatters = {}
+
+        def format_value(value):
+            value_type = type(value)
+            if value_type not in type_formatters:
+                type_formatters[value_type] = next(
+                    (f for t, f in self.column_type_formatters_export.items() if isinstance(value, t)), None)
+            type_formatter = type_formatters[value_type]
+            return type_formatter(self, value) if type_formatter else value
+
+        def compile_column(name):
+            column_formatter = self.column_formatters_export.get(name)
+            choices = getattr(self, "_column_choices_map", {}).get(name)
+
+            def get_value(m):
+                if column_formatter:
+                    value = column_formatter(self, None, m, name)
                 else:
-                    invitees_data = row.funding_invitees
-
-                for f in invitees_data:
-                    invitees_rec = {}
-                    for col in f._meta.columns.keys():
-                        if col not in exclude_list:
-                            invitees_rec[col] = self._get_list_value(
-                                None,
-                                f,
-                                col,
-                                self.column_formatters_export,
-                                self.column_type_formatters_export,
-                            )
-                    invitees_list.append(invitees_rec)
-            elif c[0] == funding_work_peer_review_id:
-                external_id_relation_part_of = {}
-                for f in row.external_ids:
-                    external_id_rec = {}
-                    for col in f._meta.columns.keys():
-                        if col not in exclude_list:
-                            external_id_rec[col] = self._get_list_value(
-                                None,
-                                f,
-                                col,
-                                self.column_formatters_export,
-                                self.column_type_formatters_export,
-                            )
-                    # Get the first external id from extrnal id list with 'SELF' relationship for funding/work export
-                    if not external_id_list and external_id_rec.get(
-                            'relationship') and external_id_rec.get(
-                                'relationship').lower() == 'self':
-                        external_id_list.append(external_id_rec)
-                    elif not external_id_list and not external_id_relation_part_of and external_id_rec.get(
-                            'relationship').lower() == 'part_of':
-                        external_id_relation_part_of = copy.deepcopy(external_id_rec)
-                # Also if there no external id with relation 'Self' take first one from 'part_of'
-                if not external_id_list and external_id_relation_part_of:
-                    external_id_list.append(external_id_relation_part_of)
-            else:
-                vals.append(self.get_export_value(row, c[0]))
+                    value = self._get_field_value(m, name)
+                if choices:
+                    return choices.get(value) or value
+                return format_value(value)
+
+            return get_value
+
+        columns = [(c, compile_column(c)) for c in model._meta.columns.keys() if c not in exclude]
+
+        def formatter(instance):
+            return {c: get_value(instance) for c, get_value in columns}
+
+        formatters[(model, exclude)] = formatter
+        return formatter
+
+    def get_external_id_invitees(self, row, external_ids=None, invitees=None):
+        """Get funding/work/peer_review invitees with external ids.
+
+        The external IDs and the invitees of the record get fetched unless they are
+        passed in (see prefetch_external_ids_invitees).
+        """
+        invitees_list = []
+        external_id_list = []
+        record_id, funding_work_peer_review_id, invitees_name = self.get_export_relations()
+        exclude_list = ('id', record_id, 'processed_at')
+        columns = [c[0] for c in self._export_columns]
+
+        if invitees_name in columns:
+            if invitees is None:
+                invitees = getattr(row, invitees_name)
+            for f in invitees:
+                invitees_list.append(self.get_export_formatter(type(f), exclude_list)(f))
+
+        if funding_work_peer_review_id in columns:
+            if external_ids is None:
+                external_ids = row.external_ids
+            external_id_relation_part_of = {}
+            for f in external_ids:
+                external_id_rec = self.get_export_formatter(type(f), exclude_list)(f)
+                # Get the first external id from extrnal id list with 'SELF' relationship for funding/work export
+                if not external_id_list and external_id_rec.get(
+                        'relationship') and external_id_rec.get(
+                            'relationship').lower() == 'self':
+                    external_id_list.append(external_id_rec)
+                elif not external_id_list and not external_id_relation_part_of and external_id_rec.get(
+                        'relationship').lower() == 'part_of':
+                    external_id_relation_part_of = copy.deepcopy(external_id_rec)
+            # Also if there no external id with relation 'Self' take first one from 'part_of'
+            if not external_id_list and external_id_relation_part_of:
+                external_id_list.append(external_id_relation_part_of)
         return (external_id_list, invitees_list)
 
     @expose('/export/<export_type>/')
@@ -999,7 +1223,7 @@ class FundingWorkCommonModelView(RecordModelView):
         if export_type == 'csv' or export_type == 'tsv':
             return self._export_csv(return_url, export_type)
         else:
-            return self._export_tablib(export_type, return_url)
+            return self._export_json_yaml(export_type)
 
     def _export_csv(self, return_url, export_type):
         """Export a CSV or tsv of records as a stream."""
@@ -1007,8 +1231,6 @@ class FundingWorkCommonModelView(RecordModelView):
         if export_type == 'tsv':
             delimiter = "\t"
 
-        count, data = self._export_data()
-
         # https://docs.djangoproject.com/en/1.8/howto/outputting-csv/
         class Echo(object):
             """An object that implements just the write method of the file-like interface."""
@@ -1024,12 +1246,11 @@ class FundingWorkCommonModelView(RecordModelView):
             titles = [csv_encode(c) for c in self.column_csv_export_list]
             yield writer.writerow(titles)
 
-            for row in data:
-                external_id_list, invitees_list = self.get_external_id_invitees(row)
-                for external_ids in external_id_list:
+            for row, external_id_list, invitees_list in self.iter_export_rows():
+                for external_id in external_id_list:
                     for cont in invitees_list:
                         vals = []
-                        vals.append(external_ids['value'])
+                        vals.append(external_id['value'])
                         for col in self.column_csv_export_list[1:]:
                             vals.append(cont.get(col))
                         yield writer.writerow(vals)
@@ -1433,6 +1654,9 @@ def activate_all():
     _url = request.args.get("url") or request.referrer
     task_id = request.form.get('task_id')
     task = Task.get(id=task_id)
+    if task.is_loading:
+        flash("The task file is still being loaded. Please try again later.", "warning")
+        return redirect(_url)
     try:
         if task.task_type == 0:
             count = AffiliationRecord.update(is_active=True).where(
@@ -1470,9 +1694,9 @@ def reset_all():
         try:
             status = "The record was reset at " + datetime.now().isoformat(timespec="seconds")
             if task.task_type == 0:
-                count = AffiliationRecord.update(processed_at=None, status=status).where(
-                    AffiliationRecord.task_id == task_id,
-                    AffiliationRecord.is_active == True).execute()  # noqa: E712
+                count = AffiliationRecord.update_status(
+                    status, AffiliationRecord.task_id == task_id, AffiliationRecord.is_active == True,  # noqa: E712
+                    code="reset", processed_at=None, outcome=RecordOutcome.PENDING, error_code=None)
 
                 for user_invitation in UserInvitation.select().where(UserInvitation.task == task):
                     try:
@@ -1480,40 +1704,20 @@ def reset_all():
                     except UserInvitation.DoesNotExist:
                         pass
 
-            elif task.task_type == 1:
-                for funding_record in FundingRecord.select().where(FundingRecord.task_id == task_id,
-                                                                   FundingRecord.is_active == True):    # noqa: E712
-                    funding_record.processed_at = None
-                    funding_record.status = status
-
-                    FundingInvitees.update(
-                        processed_at=None, status=status).where(
-                        FundingInvitees.funding_record == funding_record.id).execute()
-                    funding_record.save()
-                    count = count + 1
-
-            elif task.task_type == 2:
-                for work_record in WorkRecord.select().where(WorkRecord.task_id == task_id,
-                                                                   WorkRecord.is_active == True):    # noqa: E712
-                    work_record.processed_at = None
-                    work_record.status = status
-
-                    WorkInvitees.update(
-                        processed_at=None, status=status).where(
-                        WorkInvitees.work_record == work_record.id).execute()
-                    work_record.save()
-                    count = count + 1
-            elif task.task_type == 3:
-                for peer_review_record in PeerReviewRecord.select().where(PeerReviewRecord.task_id == task_id,
-                                                                   PeerReviewRecord.is_active == True):    # noqa: E712
-                    peer_review_record.processed_at = None
-                    peer_review_record.status = status
-
-                    PeerReviewInvitee.update(
-                        processed_at=None, status=status).where(
-                        PeerReviewInvitee.peer_review_record == peer_review_record.id).execute()
-                    peer_review_record.save()
-                    count = count + 1
+            else:
+                record_model, invitee_model, fk = {
+                    1: (FundingRecord, FundingInvitees, FundingInvitees.funding_record),
+                    2: (WorkRecord, WorkInvitees, WorkInvitees.work_record),
+                    3: (PeerReviewRecord, PeerReviewInvitee, PeerReviewInvitee.peer_review_record),
+                }[task.task_type]
+                records = record_model.select(record_model.id).where(
+                    record_model.task_id == task_id, record_model.is_active == True)  # noqa: E712
+                invitee_model.update_status(
+                    status, fk << records, code="reset",
+                    processed_at=None, outcome=RecordOutcome.PENDING, error_code=None)
+                count = record_model.update_status(
+                    status, record_model.task_id == task_id, record_model.is_active == True,  # noqa: E712
+                    code="reset", processed_at=None)
         except Exception as ex:
             db.rollback()
             flash(f"Failed to reset the selected records: {ex}")
@@ -1522,6 +1726,7 @@ def reset_all():
             task.expires_at = None
             task.expiry_email_sent_at = None
             task.completed_at = None
+            task.refresh_counts()
             task.save()
             if task.task_type == 1:
                 flash(f"{count} Funding records were reset for batch processing.")
@@ -1783,8 +1988,10 @@ def load_researcher_affiliations():
     if form.validate_on_submit():
         filename = secure_filename(form.file_.data.filename)
         try:
-            task = Task.load_from_csv(read_uploaded_file(form), filename=filename)
-            flash(f"Successfully loaded {task.record_count} rows.")
+            task = queue_uploaded_file(form, TaskType.AFFILIATION)
+            if not task:
+                task = Task.load_from_csv(read_uploaded_file(form), filename=filename)
+                flash(f"Successfully loaded {task.record_count} rows.")
             return redirect(url_for("affiliationrecord.index_view", task_id=task.id))
         except (
                 ValueError,
@@ -1804,8 +2011,10 @@ def load_researcher_funding():
     if form.validate_on_submit():
         filename = secure_filename(form.file_.data.filename)
         try:
-            task = FundingRecord.load_from_json(read_uploaded_file(form), filename=filename)
-            flash(f"Successfully loaded {task.record_count} rows.")
+            task = queue_uploaded_file(form, TaskType.FUNDING)
+            if not task:
+                task = FundingRecord.load_from_json(open_uploaded_file(form), filename=filename)
+                flash(f"Successfully loaded {task.record_count} rows.")
             return redirect(url_for("fundingrecord.index_view", task_id=task.id))
         except Exception as ex:
             flash(f"Failed to load funding record file: {ex}", "danger")
@@ -1822,8 +2031,10 @@ def load_researcher_work():
     if form.validate_on_submit():
         filename = secure_filename(form.file_.data.filename)
         try:
-            task = WorkRecord.load_from_json(read_uploaded_file(form), filename=filename)
-            flash(f"Successfully loaded {task.record_count} rows.")
+            task = queue_uploaded_file(form, TaskType.WORK)
+            if not task:
+                task = WorkRecord.load_from_json(open_uploaded_file(form), filename=filename)
+                flash(f"Successfully loaded {task.record_count} rows.")
             return redirect(url_for("workrecord.index_view", task_id=task.id))
         except Exception as ex:
             flash(f"Failed to load work record file: {ex}", "danger")
@@ -1840,8 +2051,10 @@ def load_researcher_peer_review():
     if form.validate_on_submit():
         filename = secure_filename(form.file_.data.filename)
         try:
-            task = PeerReviewRecord.load_from_json(read_uploaded_file(form), filename=filename)
-            flash(f"Successfully loaded {task.record_count} rows.")
+            task = queue_uploaded_file(form, TaskType.PEER_REVIEW)
+            if not task:
+                task = PeerReviewRecord.load_from_json(open_uploaded_file(form), filename=filename)
+                flash(f"Successfully loaded {task.record_count} rows.")
             return redirect(url_for("peerreviewrecord.index_view", task_id=task.id))
         except Exception as ex:
             flash(f"Failed to load peer review record file: {ex}", "danger")
@@ -2101,7 +2314,7 @@ def invite_user():
         invited_user = User.select().where(User.email == email).first()
         if (invited_user and OrcidToken.select().where(
                     (OrcidToken.user_id == invited_user.id) & (OrcidToken.org_id == org.id) &
-                (OrcidToken.scope.contains("/activities/update"))).exists()):
+                OrcidToken.can_update_activities).exists()):
             try:
                 if affiliations & (Affiliation.EMP | Affiliation.EDU):
                     api = orcid_client.MemberAPI(org, invited_user)
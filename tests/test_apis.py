@@ -3,14 +3,16 @@
 
 import copy
 import json
+import re
 
 import pytest
+import yaml
 from flask import url_for
 from flask_login import login_user
 
 from orcid_hub.apis import yamlfy
 from orcid_hub.data_apis import plural
-from orcid_hub.models import Client, OrcidToken, Organisation, Task, TaskType, Token, User
+from orcid_hub.models import AffiliationRecord, Client, OrcidToken, Organisation, Task, TaskType, Token, User
 
 from unittest.mock import patch, MagicMock
 
@@ -235,6 +237,23 @@ def test_user_and_token_api(app_req_ctx, resource, version):
             assert resp.status_code == 200
             data = json.loads(resp.data)
             assert len(data) == 0
+        # keyset pagination following the "next" links:
+        ids, url = [], f"/api/{version}/{resource}?page_size=3"
+        while url:
+            with app_req_ctx(url, headers=dict(authorization="Bearer TEST")) as ctx:
+                resp = ctx.app.full_dispatch_request()
+                assert resp.status_code == 200
+                assert "Pagination-Page" not in resp.headers
+                ids.extend(r["id"] for r in json.loads(resp.data))
+                next_link = re.search(r'<([^>]+)>;rel="next"', resp.headers["Link"])
+                url = next_link and next_link.group(1)
+        assert len(ids) == 11
+        assert ids == sorted(ids)
+        with app_req_ctx(
+                f"/api/{version}/{resource}?cursor=ABC",
+                headers=dict(authorization="Bearer TEST")) as ctx:
+            resp = ctx.app.full_dispatch_request()
+            assert resp.status_code == 422
         with app_req_ctx(
                 f"/api/{version}/{resource}?from_date=ABCD",
                 headers=dict(authorization="Bearer TEST")) as ctx:
@@ -289,6 +308,47 @@ def test_user_and_token_api(app_req_ctx, resource, version):
         assert "error" in data
 
 
+def test_user_lookup_api(app_req_ctx):
+    """Test the bulk user lookup."""
+    user = User.get(email="researcher@test0.edu")
+    org2_user = User.get(email="researcher@org2.edu")
+    identifiers = [user.orcid, "abc123@some.org", user.email, "0000-0000-0000-0000", org2_user.email]
+    with app_req_ctx(
+            "/api/v1.0/users/lookup", method="POST", headers=dict(authorization="Bearer TEST"),
+            content_type="application/json", data=json.dumps(identifiers)) as ctx:
+        resp = ctx.app.full_dispatch_request()
+        assert resp.status_code == 200
+        data = json.loads(resp.data)
+        assert [r["identifier"] for r in data] == identifiers
+        assert [r["found"] for r in data] == [True, False, True, False, False]
+        assert data[0]["email"] == user.email
+        assert data[2]["orcid"] == user.orcid
+        assert data[0]["linked"] == OrcidToken.select().where(
+            OrcidToken.user_id == user.id, OrcidToken.org_id == user.organisation_id).exists()
+        assert "error" in data[3]
+
+    with app_req_ctx(
+            "/api/v1.0/users/lookup", method="POST", headers=dict(authorization="Bearer TEST"),
+            content_type="text/yaml", data=yaml.dump({"identifiers": [user.email]})) as ctx:
+        resp = ctx.app.full_dispatch_request()
+        assert resp.status_code == 200
+        data = json.loads(resp.data)
+        assert data[0]["found"]
+
+    with app_req_ctx(
+            "/api/v1.0/users/lookup", method="POST", headers=dict(authorization="Bearer TEST"),
+            content_type="application/json", data=json.dumps({"email": user.email})) as ctx:
+        resp = ctx.app.full_dispatch_request()
+        assert resp.status_code == 415
+
+    with app_req_ctx(
+            "/api/v1.0/users/lookup", method="POST", headers=dict(authorization="Bearer TEST"),
+            content_type="application/json", data=json.dumps(identifiers)) as ctx, patch.dict(
+                ctx.app.config, USER_LOOKUP_MAX_IDENTIFIERS=1):
+        resp = ctx.app.full_dispatch_request()
+        assert resp.status_code == 422
+
+
 @pytest.mark.parametrize("url", [
     "/spec",
     "/spec.json",
@@ -298,6 +358,16 @@ def test_spec(client, url):
     """Test API specs."""
     rv = client.get(url)
     assert rv.status_code == 200
+    assert rv.headers["ETag"]
+    assert "public" in rv.headers["Cache-Control"]
+
+    with patch("orcid_hub.apis.swagger") as swagger:
+        resp = client.get(url, headers={"If-None-Match": rv.headers["ETag"]})
+        assert resp.status_code == 304
+        resp = client.get(url)
+        assert resp.status_code == 200
+        assert resp.data == rv.data
+        swagger.assert_not_called()
 
 
 def test_yaml_spec(client):
@@ -522,6 +592,39 @@ def test_affiliation_api(client):
         f"/api/v1.0/affiliations/{task_id}",
         headers=dict(authorization=f"Bearer {access_token}"))
     assert "Last-Modified" in resp.headers
+    etag, last_modified = resp.headers["ETag"], resp.headers["Last-Modified"]
+
+    # conditional requests:
+    for method in (client.get, client.head):
+        resp = method(
+            f"/api/v1.0/affiliations/{task_id}",
+            headers={"authorization": f"Bearer {access_token}", "If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.headers["ETag"] == etag
+    resp = client.get(
+        f"/api/v1.0/affiliations/{task_id}",
+        headers={"authorization": f"Bearer {access_token}", "If-Modified-Since": last_modified})
+    assert resp.status_code == 304
+    resp = client.get(
+        f"/api/v1.0/affiliations/{task_id}",
+        headers={"authorization": f"Bearer {access_token}", "If-None-Match": '"OUTDATED"'})
+    assert resp.status_code == 200
+    assert len(json.loads(resp.data)["records"]) == 3
+
+    # the bulk status changes of the records change the entity tag as well:
+    AffiliationRecord.update_status("The record was reset", AffiliationRecord.task_id == task_id, code="reset")
+    resp = client.get(
+        f"/api/v1.0/affiliations/{task_id}",
+        headers={"authorization": f"Bearer {access_token}", "If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] != etag
+
+    resp = client.get("/api/v1.0/tasks", headers=dict(authorization=f"Bearer {access_token}"))
+    assert resp.status_code == 200
+    resp = client.get(
+        "/api/v1.0/tasks",
+        headers={"authorization": f"Bearer {access_token}", "If-None-Match": resp.headers["ETag"]})
+    assert resp.status_code == 304
 
     resp = client.head(
         "/api/v1.0/affiliations/999999999",
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 """Tests for batch processing."""
+import gzip
 from datetime import datetime
 from unittest.mock import Mock, patch
 
@@ -9,9 +10,9 @@ from peewee import Model, SqliteDatabase
 from playhouse.test_utils import test_database
 
 from orcid_hub import utils
-from orcid_hub.models import (Affiliation, AffiliationRecord, ModelException, OrcidToken,
+from orcid_hub.models import (Affiliation, AffiliationRecord, MailMessage, ModelException, OrcidToken,
                               Organisation, OrgInfo, PartialDate, PartialDateField, Role, Task,
-                              TaskType, User, UserOrg, UserOrgAffiliation, create_tables,
+                              TaskStatus, TaskType, User, UserOrg, UserOrgAffiliation, create_tables,
                               drop_tables)
 
 
@@ -33,8 +34,19 @@ def test_process_task_from_csv_with_failures(request_ctx):
         mock_msg().send = Mock(side_effect=Exception("FAILED TO SEND EMAIL"))
         utils.process_affiliation_records(10000)
         rec = AffiliationRecord.select().where(AffiliationRecord.task_id == task.id).first()
-        assert "FAILED TO SEND EMAIL" in rec.status
-        assert rec.processed_at is not None
+        # The invitation gets queued and the processing doesn't depend on the mail delivery:
+        assert "invitation sent" in rec.status
+        message = MailMessage.get(recipient_email="aaa.lnb@test.com")
+        assert message.sent_at is None
+
+        assert utils.dispatch_mail() == 0
+        message = MailMessage.get(id=message.id)
+        assert message.sent_at is None
+        assert message.attempts == 1
+        assert "FAILED TO SEND EMAIL" in message.error
+        # Retried only after a back-off:
+        assert utils.dispatch_mail() == 0
+        assert MailMessage.get(id=message.id).attempts == 1
 
 
 def test_upload_affiliation_with_wrong_country(request_ctx):
@@ -77,7 +89,7 @@ def test_process_tasks(request_ctx):
         assert kwargs["error_count"] == 0
         hostname = ctx.request.host
         assert kwargs["export_url"] == (
-            f"https://{hostname}/admin/affiliationrecord/export/csv/?task_id={task.id}")
+            f"https://{hostname}/admin/task/{task.id}/export/csv")
         assert kwargs["recipient"] == (
             super_user.name,
             super_user.email,
@@ -110,7 +122,7 @@ def test_process_tasks(request_ctx):
         assert kwargs["error_count"] == 0
         hostname = ctx.request.host
         assert kwargs["export_url"] == (
-            f"https://{hostname}/admin/fundingrecord/export/csv/?task_id={task.id}")
+            f"https://{hostname}/admin/task/{task.id}/export/csv")
         assert kwargs["recipient"] == (
             super_user.name,
             super_user.email,
@@ -145,3 +157,87 @@ def test_process_tasks(request_ctx):
             utils.process_tasks()
             utils.process_tasks()
             assert Task.select().count() == 0
+
+
+def test_load_task_file(request_ctx, tmpdir):
+    """Test loading of a large task file in the background."""
+    org = Organisation.get(name="TEST0")
+    super_user = User.get(email="admin@test0.edu")
+    source = (b"First name\tLast name\temail address\tOrganisation\tCampus/Department\tCity\t"
+              b"Course or Job title\tStart date\tEnd date\tStudent/Staff\tCountry\n"
+              b"FNA\tLBA\taaa.lnb123@test.com\tTEST1\tResearch\tWellington\tProgramme Manager\t"
+              b"2016-09\t\tStaff\tNew Zealand\n"
+              b"FNB\tLBB\tbbb.lnb123@test.com\tTEST1\tResearch\tWellington\tProgramme Manager\t"
+              b"2016-09\t\tStaff\tNew Zealand\n")
+    with request_ctx("/"), patch.dict(
+            utils.app.config, UPLOAD_FOLDER=str(tmpdir), UPLOAD_BATCH_SIZE=1), patch.object(
+                utils.load_task_file, "queue", side_effect=utils.load_task_file) as queue:
+        login_user(super_user)
+        task = utils.queue_task_file(source, filename="TEST.tsv", org=org)
+        queue.assert_called_once()
+        task = Task.get(id=task.id)
+        assert task.status == TaskStatus.LOADED
+        assert task.affiliation_records.count() == 2
+        assert not tmpdir.listdir()
+
+        task = utils.queue_task_file(
+            source + b"FNC\tLBC\tINVALID EMAIL\tTEST1\tResearch\tWellington\tManager\t2016-09\t\tStaff\tNZ\n",
+            filename="TEST_ERROR.tsv",
+            org=org)
+        task = Task.get(id=task.id)
+        assert task.status == TaskStatus.FAILED
+        assert "invalid email" in task.load_error
+        assert task.affiliation_records.count() == 0
+        assert not tmpdir.listdir()
+
+
+def test_task_export(request_ctx, tmpdir):
+    """Test the exports of the big tasks built in the background."""
+    org = Organisation.get(name="TEST0")
+    super_user = User.get(email="admin@test0.edu")
+    task = Task.load_from_csv(
+        "First name\tLast name\temail address\tOrganisation\tCampus/Department\tCity\t"
+        "Course or Job title\tStart date\tEnd date\tStudent/Staff\n"
+        "FNA\tLBA\taaa.export@test.com\tTEST1\tResearch\tWellington\tManager\t2016-09\t\tStaff\n",
+        filename="EXPORT.tsv",
+        org=org)
+    assert task.created_by is None  # the export doesn't depend on the user who uploaded the task
+
+    def get(**headers):
+        with request_ctx(f"/admin/task/{task.id}/export/csv", headers=headers) as ctx:
+            login_user(super_user)
+            return ctx.app.full_dispatch_request()
+
+    with patch.dict(utils.app.config, EXPORT_FOLDER=str(tmpdir), EXPORT_ASYNC_THRESHOLD=1), patch.object(
+            utils.rq, "get_queue") as get_queue, patch.object(
+                utils.build_task_export, "queue",
+                side_effect=lambda task_id, export_type, job_id: utils.build_task_export(
+                    task_id, export_type)) as queue:
+        get_queue.return_value.fetch_job.return_value = None
+
+        resp = get(**{"Accept-Encoding": "gzip"})
+        assert resp.status_code == 302
+        queue.assert_called_once()
+        path, = tmpdir.listdir()
+
+        resp = get(**{"Accept-Encoding": "gzip"})
+        assert resp.status_code == 200
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert resp.content_length == path.size()
+        data = gzip.decompress(resp.get_data())
+        assert b"aaa.export@test.com" in data
+        etag = resp.headers["ETag"]
+
+        assert get(**{"If-None-Match": etag}).status_code == 304
+        resp = get()
+        assert resp.status_code == 200
+        assert "Content-Encoding" not in resp.headers
+        assert resp.get_data() == data
+        assert resp.content_length == len(data)
+
+        AffiliationRecord.update_status(
+            "The record was reset", AffiliationRecord.task_id == task.id, code="reset")
+        assert get().status_code == 302
+        assert queue.call_count == 2
+        assert tmpdir.listdir() != [path]
+        assert len(tmpdir.listdir()) == 1
@@ -1,16 +1,23 @@
+import json
 from datetime import datetime
+from io import StringIO
 from itertools import product
+from unittest.mock import ANY, MagicMock, patch
 
 import pytest
 from peewee import Model, SqliteDatabase
 from playhouse.test_utils import test_database
+from pykwalify.errors import SchemaError
 
+from orcid_hub.failover import ServerSideCursorMixin
 from orcid_hub.models import (Affiliation, AffiliationRecord, BaseModel, BooleanField, ExternalId,
-                              FundingContributor, FundingRecord, FundingInvitees, ModelException, OrcidToken,
-                              Organisation, OrgInfo, PartialDate, PartialDateField, Role, Task,
-                              TextField, User, UserOrg, UserOrgAffiliation, WorkRecord, WorkContributor, WorkExternalId,
-                              WorkInvitees, PeerReviewRecord, PeerReviewInvitee, PeerReviewExternalId,
-                              create_tables, drop_tables, validate_orcid_id)
+                              FundingContributor, FundingRecord, FundingInvitees, IdentityMap, ModelException,
+                              OrcidToken, Organisation, OrgInfo, PartialDate, PartialDateField, RecordEvent,
+                              RecordOutcome, Role, RowSerializer, Task, TextField, Url, User, UserOrg,
+                              UserOrgAffiliation, WorkRecord, WorkContributor, WorkExternalId, WorkInvitees,
+                              PeerReviewRecord, PeerReviewInvitee,
+                              PeerReviewExternalId, chunks, create_tables, defer_task_touches, drop_tables,
+                              iter_yaml_json, iterate, validate_orcid_id)
 
 
 @pytest.fixture
@@ -29,7 +36,7 @@ def test_db():
             _db, (Organisation, User, UserOrg, OrgInfo, OrcidToken, UserOrgAffiliation, Task,
                   AffiliationRecord, ExternalId, FundingRecord, FundingContributor, FundingInvitees,
                   WorkRecord, WorkContributor, WorkExternalId, WorkInvitees, PeerReviewRecord, PeerReviewExternalId,
-                  PeerReviewInvitee),
+                  PeerReviewInvitee, RecordEvent, Url),
             fail_silently=True) as _test_db:
         yield _test_db
 
@@ -598,3 +605,232 @@ def test_base_model_to_dict():
 
     rec = TestTable.get(1)
     assert rec.test_field == "ABC123"
+
+
+def test_row_serializer(test_models):
+    """Test the column-projected row serialization."""
+    AffiliationRecord.update(
+        start_date=PartialDate(2017, 4), processed_at=datetime(2018, 1, 2, 3, 4, 5, 678)).where(
+            AffiliationRecord.id == 1).execute()
+    query = AffiliationRecord.select().order_by(AffiliationRecord.id)
+    exclude = [AffiliationRecord.task]
+
+    records = list(RowSerializer(AffiliationRecord, exclude=exclude).serialize(query))
+    assert records == [r.to_dict(recurse=False, to_dashes=True, exclude=exclude) for r in query]
+    assert records[0]["start-date"] == "2017-04"
+    assert records[0]["processed-at"] == datetime(2018, 1, 2, 3, 4, 5, 678)
+    assert "task" not in records[0]
+
+    records = list(RowSerializer(AffiliationRecord, dates_as_text=True).serialize(query))
+    assert records[0]["processed-at"] == "2018-01-02T03:04:05"
+    assert records[1]["processed-at"] is None
+    assert records[0]["task"] == 1
+
+    serializer = RowSerializer(AffiliationRecord, only=[AffiliationRecord.id, AffiliationRecord.email])
+    assert list(serializer.serialize(query))[0] == {"id": 1, "email": "Test_0"}
+
+
+def test_iter_yaml_json():
+    """Test incremental parsing of uploaded JSON and YAML files."""
+    source = json.dumps([{"id": i, "title": "T], {\"" * 10} for i in range(100)], indent=2)
+    records = list(iter_yaml_json("test.json", StringIO(source), chunk_size=16))
+    assert len(records) == 100
+    assert records[-1] == {"id": 99, "title": "T], {\"" * 10}
+    assert list(iter_yaml_json("test.json", " [ ] ")) == []
+
+    records = list(iter_yaml_json("test.yaml", StringIO("- id: 1\n- id: 2\n  title: &t ABC\n- title: *t\n")))
+    assert records == [{"id": 1}, {"id": 2, "title": "ABC"}, {"title": "ABC"}]
+    records = list(iter_yaml_json("test.yml", "---\nid: 1\n---\nid: 2\n"))
+    assert records == [{"id": 1}, {"id": 2}]
+
+    with pytest.raises(SchemaError):
+        list(iter_yaml_json("test.json", '{"id": 1}'))
+    with pytest.raises(ValueError):
+        list(iter_yaml_json("test.json", '[{"id": 1} {"id": 2}]'))
+
+
+def test_chunks():
+    """Test splitting up of iterables into chunks."""
+    assert list(chunks(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(chunks(iter(range(6)), 3)) == [[0, 1, 2], [3, 4, 5]]
+    assert list(chunks([], 3)) == []
+
+
+def test_iterate(test_models):
+    """Test the iteration over the query results through the server-side cursors."""
+    query = User.select().order_by(User.id)
+    emails = [u.email for u in query]
+    assert [u.email for u in iterate(query)] == emails
+    assert [u.email for u in iterate(query)] == emails  # the query has been executed
+
+    class Database(ServerSideCursorMixin, SqliteDatabase):
+        pass
+
+    # the named cursor gets emulated with the result of the query:
+    database = Database(":memory:", itersize=3)
+    sql, params = query.sql()
+    result = User._meta.database.execute_sql(sql, params)
+    cursor = MagicMock(description=result.description)
+    cursor.__iter__.return_value = iter(result.fetchall())
+    with patch.object(database, "get_conn") as get_conn:
+        get_conn.return_value.cursor.return_value = cursor
+        assert [u.email for u in database.iterate(query)] == emails
+    get_conn.return_value.cursor.assert_called_once_with(name=ANY, withhold=True)
+    cursor.execute.assert_called_once_with(sql, params)
+    assert cursor.itersize == 3
+    cursor.close.assert_called_once()
+
+
+def test_task_counters(test_models):
+    """Test maintenance of the task record counters."""
+    task = Task.get(id=1)
+    assert task.record_count == 0
+    task.refresh_counts()
+    assert task.record_count == 10
+    assert task.processed_count == 0
+    assert task.orcid_rec_count == 10
+    assert Task.get(id=1).record_count == 10
+    assert not task.check_completed()
+
+    AffiliationRecord.update(processed_at=datetime.utcnow()).where(
+        AffiliationRecord.id << [1, 2, 3]).execute()
+    AffiliationRecord.update(status="ERROR: something went wrong", outcome=RecordOutcome.ERROR).where(
+        AffiliationRecord.id == 3).execute()
+    Task.count_processed(AffiliationRecord, [1, 2, 3, 4])
+    task = Task.get(id=1)
+    assert task.processed_count == 3
+    assert task.error_count == 1
+    assert not task.check_completed()
+
+    AffiliationRecord.update(processed_at=datetime.utcnow()).where(
+        AffiliationRecord.task_id == 1, AffiliationRecord.processed_at.is_null()).execute()
+    Task.add_counts(1, processed_count=7)
+    task = Task.get(id=1)
+    assert task.check_completed()
+    task = Task.get(id=1)
+    assert task.completed_at is not None
+    assert task.processed_count == 10
+    assert task.error_count == 1
+
+    # backfill of the counters of the existing tasks:
+    Task.update(record_count=0, processed_count=0, error_count=0).execute()
+    assert Task.refresh_all_counts(Task.select().where(Task.record_count == 0)) == Task.select().count()
+    task = Task.get(id=1)
+    assert task.record_count == 10
+    assert task.processed_count == 10
+    assert task.error_count == 1
+
+
+def test_record_outcome(test_models):
+    """Test the processing outcome of the records."""
+    assert RecordOutcome.ERROR == 5
+    assert RecordOutcome.ERROR == "ERROR"
+    assert RecordOutcome(3) == RecordOutcome.UPDATED
+
+    ar = AffiliationRecord.get(id=1)
+    assert ar.outcome == RecordOutcome.PENDING
+    assert not ar.has_error
+    ar.add_status_line("Error: something went wrong")
+    assert not ar.has_error
+    ar.outcome, ar.error_code = RecordOutcome.ERROR, "HTTP-400"
+    ar.save()
+    ar = AffiliationRecord.get(id=1)
+    assert ar.has_error
+    assert ar.error_code == "HTTP-400"
+    assert AffiliationRecord.select().where(AffiliationRecord.error_condition()).count() == 1
+
+    wi = WorkInvitees.get(id=1)
+    assert wi.outcome == RecordOutcome.PENDING
+    WorkInvitees.update(outcome=RecordOutcome.INVITED).where(WorkInvitees.id == 1).execute()
+    assert WorkInvitees.select().where(WorkInvitees.outcome != RecordOutcome.INVITED).count() == 9
+    wr = WorkRecord.get(id=1)
+    wr.add_status_line("Error processing record.")
+    assert wr.has_error
+
+
+def test_record_event_log(test_models):
+    """Test the processing event log of the records."""
+    ar = AffiliationRecord.get(id=1)
+    ar.add_status_line("Employment record was created.", code="created")
+    ar.add_status_line("Employment record was updated.")
+    assert ar.status.endswith(": Employment record was updated.")
+    assert ar.events.count() == 0
+    ar.save()
+    assert [(e.code, e.message) for e in ar.events] == [("created", "Employment record was created."),
+                                                        (None, "Employment record was updated.")]
+    assert ar.status_log.endswith("Employment record was updated.")
+    assert len(ar.status_log.splitlines()) == 2
+
+    assert WorkInvitees.update_status("The invitation sent", WorkInvitees.email == "nobody@test.com") == 0
+    count = WorkInvitees.update_status(
+        "The invitation sent", WorkInvitees.work_record_id == 1, code="invited", outcome=RecordOutcome.INVITED)
+    assert count == WorkInvitees.select().where(WorkInvitees.work_record_id == 1).count()
+    assert RecordEvent.select().where(RecordEvent.record_type == "work_invitees").count() == count
+    wi = WorkInvitees.get(id=1)
+    assert wi.status == "The invitation sent"
+    assert wi.outcome == RecordOutcome.INVITED
+    assert [e.code for e in wi.events] == ["invited"]
+
+
+def test_url_shortening(test_models):
+    """Test the (bulk) URL shortening."""
+    u = Url.shorten("https://test.orcidhub.org.nz/invite/ABC")
+    assert len(u.short_id) == 5
+    assert u.url_hash == Url.get_url_hash(u.url)
+    assert Url.shorten("https://test.orcidhub.org.nz/invite/ABC").short_id == u.short_id
+
+    urls = [f"https://test.orcidhub.org.nz/invite/{n}" for n in range(100)] + [u.url]
+    short_urls = Url.shorten_many(urls)
+    assert set(short_urls) == set(urls)
+    assert short_urls[u.url].short_id == u.short_id
+    assert len(set(s.short_id for s in short_urls.values())) == 101
+    assert Url.select().count() == 101
+    assert Url.shorten_many(urls[:10]) == {url: short_urls[url] for url in urls[:10]}
+
+    short_ids = Url.generate_short_ids(10)
+    assert len(set(short_ids)) == 10
+    assert not Url.select().where(Url.short_id << short_ids).exists()
+    assert Url.shorten("https://test.orcidhub.org.nz/invite/XYZ", short_id=short_ids[0]).short_id == short_ids[0]
+
+    # The URLs shortened before the digests were introduced get backfilled:
+    Url.update(url_hash=None).where(Url.id == u.id).execute()
+    Url.refresh_url_hashes()
+    assert Url.get(Url.id == u.id).url_hash == Url.get_url_hash(u.url)
+    assert not Url.select().where(Url.url_hash.is_null()).exists()
+    assert Url.shorten(u.url).short_id == u.short_id
+
+
+def test_identity_map(test_models):
+    """Test the batch-scoped identity map."""
+    tasks = list(Task.select().where(Task.id << [1, 2, 3]))
+    identity_map = IdentityMap()
+    identity_map.attach(tasks, "org", "created_by")
+    identity_map.attach([None], "org")
+    org = identity_map.get(Organisation, 1)
+    assert all(t._obj_cache["org"] is org for t in tasks)
+    assert all(t.created_by is identity_map.get(User, 1) for t in tasks)
+    assert identity_map.load(Organisation, [1, None]) == {1: org}
+    assert identity_map.get(Organisation, 2).id == 2
+    assert identity_map.get(Organisation, 9999) is None
+
+
+def test_defer_task_touches(test_models):
+    """Test coalescing of the batch task touches."""
+    Task.update(updated_at=None).execute()
+    with defer_task_touches():
+        for ar in AffiliationRecord.select().where(AffiliationRecord.task_id == 1):
+            ar.is_active = True
+            ar.save()
+        with defer_task_touches():
+            ar = AffiliationRecord.get(id=2)
+            ar.status = "TEST"
+            ar.save()
+        assert Task.get(id=1).updated_at is None
+    assert Task.get(id=1).updated_at is not None
+    assert Task.get(id=2).updated_at is None
+
+    Task.update(updated_at=None).execute()
+    ar = AffiliationRecord.get(id=3)
+    ar.status = "TEST"
+    ar.save()
+    assert Task.get(id=1).updated_at is not None
@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 """Tests for util functions."""
 
+import json
 import logging
+import threading
+import time
+from datetime import datetime, timedelta
 from itertools import groupby
-from unittest.mock import Mock, patch
+from unittest.mock import Mock, PropertyMock, patch
 
 import pytest
 from flask import make_response
@@ -12,9 +16,9 @@ from peewee import JOIN
 
 from orcid_hub import utils
 from orcid_hub.models import (
-    AffiliationRecord, ExternalId, File, FundingContributor, FundingInvitees, FundingRecord,
-    OrcidToken, Organisation, Role, Task, User, UserInvitation, UserOrg, WorkRecord, WorkInvitees,
-    WorkExternalId, WorkContributor, PeerReviewRecord, PeerReviewInvitee, PeerReviewExternalId)
+    AffiliationRecord, ExternalId, File, FundingContributor, FundingInvitees, FundingRecord, MailMessage,
+    OrcidToken, Organisation, RecordOutcome, Role, Task, TaskType, User, UserInvitation, UserOrg, WorkRecord,
+    WorkInvitees, WorkExternalId, WorkContributor, PeerReviewRecord, PeerReviewInvitee, PeerReviewExternalId)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -903,9 +907,205 @@ def test_send_email(app):
                 subject="TEST")
 
 
+def test_ttl_cache():
+    """Test the bounded LRU cache with expiring entries."""
+    cache = utils.TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)  # evicts the least recently used entry "b"
+    assert len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+    with patch("time.monotonic", return_value=time.monotonic() + 61):
+        assert cache.get("a", "expired") == "expired"
+    assert len(cache) == 1
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_invitation_lookups(app):
+    """Test the per-batch lookups of the token holders and the reset invitees."""
+    org = Organisation.create(name="THE LOOKUP ORGANISATION", tuakiri_name="THE LOOKUP ORGANISATION")
+    u0 = User.create(email="lookup0@test.edu", name="TEST USER 0", organisation=org)
+    u1 = User.create(email="lookup1@test.edu", name="TEST USER 1", organisation=org)
+    OrcidToken.create(user=u0, org=org, scope="/read-limited,/activities/update", access_token="TOKEN0")
+    OrcidToken.create(user=u1, org=org, scope="/read-limited", access_token="TOKEN1")
+    assert utils.get_token_holders([(u0.id, org.id), (u1.id, org.id), (None, org.id)]) == {(u0.id, org.id)}
+    assert utils.get_token_holders([(u1.id, org.id), (None, org.id)]) == set()
+
+    t = Task.create(org=org, filename="xyz.json", created_by=u0, updated_by=u0, task_type=2)
+    wr = WorkRecord.create(task=t, title="Test titile", citation_type="bibtex", citation_value="", is_active=True)
+    for u in (u0, u1):
+        WorkInvitees.create(work_record=wr, email=u.email, first_name="TEST", visibility="PUBLIC")
+    emails = [u0.email, u1.email, "nobody@test.edu"]
+    assert utils.get_reset_emails(WorkInvitees, emails) == set()
+    WorkInvitees.update_status("Record was reset", WorkInvitees.email == u1.email, code="reset")
+    assert utils.get_reset_emails(WorkInvitees, emails) == {u1.email}
+    assert utils.get_reset_emails(WorkInvitees, emails, WorkInvitees.work_record_id == wr.id + 1) == set()
+    assert utils.get_reset_emails(WorkInvitees, []) == set()
+    # reset before the resets were logged:
+    WorkInvitees.update(status="Record was reset").where(WorkInvitees.email == u0.email).execute()
+    assert utils.get_reset_emails(WorkInvitees, emails) == {u0.email, u1.email}
+
+
+def test_select_invitee_batch(app):
+    """Test the selection of the batch of the invitees pending the processing."""
+    org = Organisation.create(name="THE BATCH ORGANISATION", tuakiri_name="THE BATCH ORGANISATION")
+    u0 = User.create(email="batch0@test.edu", name="TEST USER 0", orcid="0000-0002-0000-0000", organisation=org)
+    u1 = User.create(email="batch1@test.edu", name="TEST USER 1", orcid="0000-0002-0000-0001", organisation=org)
+    token = OrcidToken.create(user=u1, org=org, scope="/read-limited,/activities/update", access_token="BATCH1")
+    assert token.can_update_activities
+    t = Task.create(org=org, filename="xyz.json", created_by=u0, updated_by=u0, task_type=2)
+    wr = WorkRecord.create(task=t, title="Test titile", citation_type="bibtex", citation_value="", is_active=True)
+    # pending, matched by the email:
+    WorkInvitees.create(work_record=wr, email=u0.email, first_name="TEST0")
+    # invited and authorized since, matched by the ORCID iD:
+    WorkInvitees.create(work_record=wr, email="other@test.edu", orcid=u1.orcid, outcome=RecordOutcome.INVITED)
+    # invited, waiting for the authorization:
+    WorkInvitees.create(work_record=wr, email=u0.email, first_name="TEST1", outcome=RecordOutcome.INVITED)
+    # no matching user:
+    WorkInvitees.create(work_record=wr, email="nobody@test.edu")
+
+    tasks = utils.select_invitee_batch(WorkRecord, WorkInvitees, max_rows=20)
+    invitees = [t.work_record.work_invitees for t in tasks]
+    assert [(i.email, i.user.id) for i in invitees] == [
+        ("nobody@test.edu", None), (u0.email, u0.id), ("other@test.edu", u1.id)]
+    assert all(t.id == t.work_record.task_id for t in tasks)
+    assert len(utils.select_invitee_batch(WorkRecord, WorkInvitees, max_rows=1)) == 1
+
+    wr.is_active = False
+    wr.save()
+    assert utils.select_invitee_batch(WorkRecord, WorkInvitees) == []
+
+
+def test_email_skeletons():
+    """Test the compilation of the email base template into the cached skeletons."""
+    utils.get_email_skeletons.cache_clear()
+    base = "<p>Dear {EMAIL},</p><div>{MESSAGE}</div><a href='{BASE_URL}'>{{ORCID Hub}}</a>"
+    html, text = utils.get_email_skeletons(base)
+    assert utils.get_email_skeletons(base) == (html, text)
+    assert utils.get_email_skeletons.cache_info().hits == 1
+
+    values = dict(
+        EMAIL="test@test.com",
+        SUBJECT="TEST",
+        MESSAGE="<b>HELLO</b>",
+        LOGO="",
+        BASE_URL="https://test.orcidhub.org.nz",
+        INCLUDED_URL="")
+    assert utils.fill_email_skeleton(html, values) == base.format(**values)
+    values["MESSAGE"] = "**HELLO**"
+    text = utils.fill_email_skeleton(text, values)
+    assert "Dear test@test.com," in text
+    assert "**HELLO**" in text
+    assert "{ORCID Hub}" in text
+    assert "@@" not in text
+
+
+def test_smtp_backend_pooling(app):
+    """Test the reuse of the SMTP connections and DKIM key."""
+    with patch("orcid_hub.utils.SMTPBackend") as backend_cls, patch.object(utils, "_smtp", threading.local()):
+        backend = utils.get_smtp_backend()
+        backend_cls.assert_called_once_with(host=app.config["MAIL_SERVER"], port=app.config["MAIL_PORT"])
+        assert utils.get_smtp_backend() is backend
+        backend.close.assert_not_called()
+        backend_cls.assert_called_once()
+
+        # The server has most likely closed the idle connection:
+        utils._smtp.last_used -= app.config["MAIL_IDLE_TIMEOUT"] + 1
+        assert utils.get_smtp_backend() is backend
+        backend.close.assert_called_once()
+        backend_cls.assert_called_once()
+
+    utils.read_dkim_key.cache_clear()
+    with patch("builtins.open", wraps=open) as open_:
+        key = utils.read_dkim_key(__file__)
+        assert utils.read_dkim_key(__file__) == key
+        open_.assert_called_once()
+    assert utils.read_dkim_key("NON-EXISTING FILE...") is None
+
+
+def test_dispatch_mail(app):
+    """Test the delivery of the email messages queued in the outbox."""
+    MailMessage.insert_many(
+        dict(recipient_email=f"user{i}@{domain}", recipient_domain=domain, subject="TEST", html="<p>TEST</p>")
+        for i, domain in enumerate(["test.com", "test.com", "test.com", "other.org"])).execute()
+    with patch.dict(app.config, MAIL_DOMAIN_RATE_LIMIT=2), patch("emails.message.Message") as msg_cls:
+        assert utils.dispatch_mail() == 3
+        assert msg_cls.return_value.send.call_count == 3
+        assert MailMessage.select().where(MailMessage.sent_at.is_null()).count() == 1
+        # The rate limit of the domain has been reached:
+        assert utils.dispatch_mail() == 0
+        assert msg_cls.return_value.send.call_count == 3
+
+    MailMessage.update(sent_at=datetime(2018, 1, 1)).where(MailMessage.sent_at.is_null(False)).execute()
+    with patch("emails.message.Message") as msg_cls:
+        assert utils.dispatch_mail() == 1
+        _, kwargs = msg_cls.call_args
+        assert kwargs["subject"] == "TEST"
+    assert not MailMessage.select().where(MailMessage.sent_at.is_null()).exists()
+    MailMessage.delete().execute()
+
+    # A domain with a backlog doesn't hold up the others and the connections get closed:
+    MailMessage.insert_many(
+        dict(recipient_email=f"user{i}@{domain}", recipient_domain=domain, subject="TEST", html="<p>TEST</p>")
+        for i, domain in enumerate(["test.com", "test.com", "test.com", "other.org"])).execute()
+    with patch.dict(app.config, MAIL_DOMAIN_RATE_LIMIT=1), patch(
+            "emails.message.Message"), patch.object(utils, "SMTPBackend") as backend_cls:
+        assert utils.dispatch_mail(2) == 2
+        assert {m.recipient_domain for m in MailMessage.select().where(MailMessage.sent_at.is_null(False))} == {
+            "test.com", "other.org"}
+        backend_cls.return_value.close.assert_called()
+
+    # The messages leased by another run don't get sent again:
+    MailMessage.update(sent_at=None, scheduled_at=datetime.utcnow() + timedelta(minutes=10)).execute()
+    with patch("emails.message.Message") as msg_cls:
+        assert utils.dispatch_mail() == 0
+        msg_cls.return_value.send.assert_not_called()
+    MailMessage.delete().execute()
+
+
 def test_is_valid_url():
     """Test URL validation for call-back URLs."""
     assert utils.is_valid_url("http://www.orcidhub.org.nz/some_path")
     assert utils.is_valid_url("http://www.orcidhub.org.nz")
     assert not utils.is_valid_url("www.orcidhub.org.nz/some_path")
     assert not utils.is_valid_url(12345)
+
+
+def test_task_progress(app):
+    """Test the task progress event stream fed by the processors."""
+    org = Organisation.create(name="THE PROGRESS ORGANISATION", tuakiri_name="THE PROGRESS ORGANISATION")
+    task = Task.create(org=org, filename="progress.csv", task_type=TaskType.AFFILIATION, record_count=2)
+
+    def process(timeout):
+        Task.add_counts(task.id, processed_count=1)
+        if Task.get(id=task.id).processed_count == 2:
+            Task.update(completed_at=datetime.utcnow()).where(Task.id == task.id).execute()
+
+    with patch.object(type(utils.rq), "connection", new_callable=PropertyMock) as connection:
+        pubsub = connection.return_value.pubsub.return_value
+        pubsub.get_message.side_effect = process
+        events = list(utils.iter_task_progress(task.id, timeout=60, interval=1))
+        pubsub.subscribe.assert_called_once_with(f"task-progress:{task.id}")
+        pubsub.close.assert_called_once()
+
+        utils.publish_task_progress({task.id})
+        connection.return_value.pipeline.return_value.publish.assert_called_once_with(
+            f"task-progress:{task.id}", task.id)
+
+    assert events[0] == "retry: 1000\n\n"
+    assert [e.split("\n")[0] for e in events[1:]] == ["event: progress"] * 3 + ["event: completed"]
+    assert [json.loads(e.split("data: ")[1])["processed"] for e in events[1:]] == [0, 1, 2, 2]
+
+    # without Redis the task gets polled every 'interval' seconds until it's completed:
+    task = Task.create(org=org, filename="polled.csv", task_type=TaskType.AFFILIATION, record_count=2)
+    with patch.object(type(utils.rq), "connection", new_callable=PropertyMock, side_effect=Exception), patch.object(
+            utils.time, "sleep", side_effect=process) as sleep:
+        events = list(utils.iter_task_progress(task.id, timeout=60, interval=3))
+    assert sleep.call_count == 2
+    sleep.assert_called_with(3)
+    assert [e.split("\n")[0] for e in events[1:]] == ["event: progress"] * 3 + ["event: completed"]
+    assert [json.loads(e.split("data: ")[1])["processed"] for e in events[1:]] == [0, 1, 2, 2]
@@ -12,6 +12,7 @@ from unittest.mock import MagicMock, patch
 from io import BytesIO
 
 import pytest
+import yaml
 from flask import request, make_response
 from flask_login import login_user
 from peewee import SqliteDatabase
@@ -22,7 +23,7 @@ from orcid_hub import app, orcid_client, rq, views
 from orcid_hub.config import ORCID_BASE_URL
 from orcid_hub.forms import FileUploadForm
 from orcid_hub.models import UserOrgAffiliation  # noqa: E128
-from orcid_hub.models import (Affiliation, AffiliationRecord, Client, File, FundingRecord,
+from orcid_hub.models import (Affiliation, AffiliationRecord, Client, ExternalId, File, FundingInvitees, FundingRecord,
                               OrcidToken, Organisation, OrgInfo, Role, Task, Token, Url, User,
                               UserInvitation, UserOrg, PeerReviewRecord, WorkRecord)
 
@@ -457,11 +458,18 @@ def make_fake_response(text, *args, **kwargs):
 
 def test_short_url(request_ctx):
     """Test short url."""
+    views.short_url_cache.clear()
     short_url = Url.shorten("https://HOST/confirm/organisation/ABCD1234")
     with request_ctx("/u/" + short_url.short_id) as ctx:
         resp = ctx.app.full_dispatch_request()
         assert resp.status_code == 302
         assert resp.location == "https://HOST/confirm/organisation/ABCD1234"
+        assert resp.cache_control.private
+        assert not resp.cache_control.public
+        assert resp.cache_control.max_age == views.short_url_cache.ttl
+
+    # The following clicks get redirected from the cache:
+    Url.delete().where(Url.id == short_url.id).execute()
 
     with request_ctx("/u/" + short_url.short_id + "?param=PARAM123") as ctx:
         resp = ctx.app.full_dispatch_request()
@@ -473,6 +481,67 @@ def test_short_url(request_ctx):
         assert resp.status_code == 404
 
 
+def test_funding_record_export(request_ctx):
+    """Test the export of the funding records with the prefetched external IDs and invitees."""
+    admin = User.get(email="admin@test0.edu")
+    task = Task.create(org=admin.organisation, created_by=admin, filename="funding.json", task_type=1)
+    for n in range(3):
+        fr = FundingRecord.create(task=task, title=f"FUNDING #{n}", type="GRANT")
+        ExternalId.create(funding_record=fr, type="grant_number", value=f"PART-{n}", relationship="PART_OF")
+        if n != 1:
+            ExternalId.create(funding_record=fr, type="grant_number", value=f"GNS-{n}", relationship="SELF")
+        for i in range(2):
+            FundingInvitees.create(
+                funding_record=fr, identifier=f"{n}{i}", email=f"invitee{n}{i}@test0.edu",
+                first_name="FIRST", last_name="LAST", put_code=i or None)
+
+    with request_ctx(f"/admin/fundingrecord/export/csv/?task_id={task.id}") as ctx:
+        login_user(admin)
+        resp = ctx.app.full_dispatch_request()
+        assert resp.status_code == 200
+        lines = resp.data.decode().splitlines()
+    assert lines[0] == "funding id,identifier,email,first_name,last_name,orcid,put_code,status"
+    assert sorted(lines[1:]) == [
+        "GNS-0,00,invitee00@test0.edu,FIRST,LAST,,,",
+        "GNS-0,01,invitee01@test0.edu,FIRST,LAST,,1,",
+        "GNS-2,20,invitee20@test0.edu,FIRST,LAST,,,",
+        "GNS-2,21,invitee21@test0.edu,FIRST,LAST,,1,",
+        "PART-1,10,invitee10@test0.edu,FIRST,LAST,,,",
+        "PART-1,11,invitee11@test0.edu,FIRST,LAST,,1,",
+    ]
+
+    for export_type, load in (("json", json.loads), ("yaml", yaml.safe_load)):
+        with request_ctx(f"/admin/fundingrecord/export/{export_type}/?task_id={task.id}") as ctx:
+            login_user(admin)
+            resp = ctx.app.full_dispatch_request()
+            assert resp.status_code == 200
+            data = load(resp.data.decode())
+        # the keys are the column labels (as in the former tablib based export):
+        assert sorted(r["Funding Id"] for r in data) == ["GNS-0", "GNS-2", "PART-1"]
+        assert all([i["email"] for i in r["Funding Invitees"]] == [
+            f"invitee{r['Funding Id'][-1]}0@test0.edu", f"invitee{r['Funding Id'][-1]}1@test0.edu"] for r in data)
+
+    # a task without records gets exported as an empty list:
+    empty_task = Task.create(org=admin.organisation, created_by=admin, filename="empty.json", task_type=1)
+    with request_ctx(f"/admin/fundingrecord/export/json/?task_id={empty_task.id}") as ctx:
+        login_user(admin)
+        resp = ctx.app.full_dispatch_request()
+        assert resp.status_code == 200
+        assert json.loads(resp.data.decode()) == []
+
+    # the most recently created task has the largest ID, so the next one doesn't exist:
+    with request_ctx(f"/admin/fundingrecord/export/json/?task_id={empty_task.id + 1}") as ctx:
+        login_user(admin)
+        assert ctx.app.full_dispatch_request().status_code == 404
+
+    view = next(v for v in views.admin._views if isinstance(v, views.FundingRecordAdmin))
+    records = list(FundingRecord.select().where(FundingRecord.task == task))
+    external_ids, invitees = view.prefetch_external_ids_invitees(records)
+    for r in records:
+        assert view.get_external_id_invitees(r, external_ids[r.id], invitees[r.id]) == \
+            view.get_external_id_invitees(r)
+
+
 def test_load_org(request_ctx):
     """Test load organisation."""
     root = User.get(email="root@test0.edu")